@@ -0,0 +1,94 @@
+"""
+Пакетная конвертация против тех же строк, отправленных по одной через HTML-форму.
+
+Приложение вызывается напрямую через ASGI (без сети и БД): пользователь подменяется
+через dependency_overrides, а таблица курсов заполняется котировками заглушки провайдера.
+Нужны переменные окружения из src/.env.example.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_batch_convert --items 100000 --single-calls 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock
+
+import httpx
+
+from benchmarks.fake_upstream import QUOTES
+from src.auth.auth_config import current_user
+from src.auth.models import Role, User
+from src.auth.rbac import PermissionIndex
+from src.main import app, templates
+from src.pages import PageRenderer
+from src.rates.audit import AuditLog
+from src.rates.cache import RateCache
+from src.rates.table import RateRefresher, RateTable
+
+
+def prepare_app():
+    refresher = RateRefresher(provider=None)
+    refresher.table = RateTable.from_quotes(
+        "USD", {f"USD{code}": rate for code, rate in QUOTES.items()}, datetime.now(timezone.utc)
+    )
+    app.state.rate_refresher = refresher
+    app.state.rate_cache = RateCache(loader=AsyncMock())
+    app.state.permission_index = PermissionIndex()
+    app.state.permission_index.compile([Role(id=1, name="user", permissions=None)])
+    # Без БД журнал конвертаций отключен, измеряется только сама конвертация
+    app.state.audit_log = AuditLog(engine=None, enabled=False)
+    app.state.page_renderer = PageRenderer(templates, ("converter.html", "converter_for_admin.html"))
+    user = User(id=1, email="bench@example.com", username="bench", role_id=1, is_active=True)
+    app.dependency_overrides[current_user] = lambda: user
+
+
+def make_rows(count: int) -> list:
+    codes = list(QUOTES)
+    return [
+        {"from": random.choice(codes), "to": random.choice(codes), "amount": round(random.uniform(1, 1000), 2)}
+        for _ in range(count)
+    ]
+
+
+async def run_batch(client: httpx.AsyncClient, rows: list) -> float:
+    started = time.perf_counter()
+    response = await client.post("/convert-batch", json={"items": rows})
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.text
+    assert len(response.json()["results"]) == len(rows)
+    return elapsed
+
+
+async def run_single(client: httpx.AsyncClient, rows: list) -> float:
+    started = time.perf_counter()
+    for row in rows:
+        response = await client.post(
+            "/convert-for-user", data={"from_": row["from"], "to": row["to"], "amount": str(row["amount"])}
+        )
+        assert response.status_code == 200
+    return time.perf_counter() - started
+
+
+async def main(items: int, single_calls: int):
+    prepare_app()
+    rows = make_rows(items)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        batch = await run_batch(client, rows)
+        print(f"batch endpoint   {items} items in {batch:.2f}s -> {items / batch:,.0f} rows/s")
+        single = await run_single(client, rows[:single_calls])
+        print(f"single form      {single_calls} calls in {single:.2f}s -> {single_calls / single:,.0f} rows/s")
+        print(f"speedup          x{(single / single_calls) / (batch / items):.0f} per row")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--single-calls", type=int, default=100000)
+    args = parser.parse_args()
+    # Шаблоны подключаются относительно рабочей директории приложения
+    os.chdir(os.path.join(os.path.dirname(__file__), "..", "src"))
+    asyncio.run(main(args.items, args.single_calls))
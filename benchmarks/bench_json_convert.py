@@ -0,0 +1,84 @@
+"""
+Одиночные конвертации: HTML-форма против GET /convert (JSON) и условного запроса с 304.
+
+Приложение вызывается напрямую через ASGI, как в bench_batch_convert. Отдельно сравнивается
+сериализация ответа стандартным json и orjson.
+Нужны переменные окружения из src/.env.example.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_json_convert --calls 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import orjson
+
+from benchmarks.bench_batch_convert import make_rows, prepare_app
+from src.main import app
+from src.rates.service import build_result
+
+
+async def run_html(client: httpx.AsyncClient, rows: list) -> float:
+    started = time.perf_counter()
+    for row in rows:
+        response = await client.post(
+            "/convert-for-user", data={"from_": row["from"], "to": row["to"], "amount": str(row["amount"])}
+        )
+        assert response.status_code == 200
+    return time.perf_counter() - started
+
+
+async def run_json(client: httpx.AsyncClient, rows: list, etag: str = None) -> float:
+    # С etag клиент повторяет запросы с If-None-Match, как браузер с закэшированными ответами
+    headers = {"If-None-Match": etag} if etag else None
+    started = time.perf_counter()
+    for row in rows:
+        params = {"from": row["from"], "to": row["to"], "amount": row["amount"]}
+        response = await client.get("/convert", params=params, headers=headers)
+        assert response.status_code == (304 if etag else 200), response.text
+    return time.perf_counter() - started
+
+
+def run_serialization(calls: int) -> tuple:
+    result = build_result("USD", "EUR", 123.45, 0.9234, 1704067200)
+    started = time.perf_counter()
+    for _ in range(calls):
+        json.dumps(result).encode()
+    stdlib = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(calls):
+        orjson.dumps(result)
+    return stdlib, time.perf_counter() - started
+
+
+async def main(calls: int):
+    prepare_app()
+    rows = make_rows(calls)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        row = rows[0]
+        response = await client.get("/convert", params={"from": row["from"], "to": row["to"], "amount": 1})
+        etag = response.headers["etag"]  # у всех пар один снимок курсов и один ETag
+        for name, runner in (
+                ("HTML form POST", lambda: run_html(client, rows)),
+                ("JSON GET", lambda: run_json(client, rows)),
+                ("JSON GET, 304", lambda: run_json(client, rows, etag)),
+        ):
+            elapsed = await runner()
+            print(f"{name:<16} {calls} calls in {elapsed:.2f}s -> {calls / elapsed:,.0f} req/s")
+    stdlib, fast = run_serialization(calls * 50)
+    print(f"serialization    json {calls * 50 / stdlib:,.0f}/s, orjson {calls * 50 / fast:,.0f}/s "
+          f"(x{stdlib / fast:.1f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+    # Шаблоны подключаются относительно рабочей директории приложения
+    os.chdir(os.path.join(os.path.dirname(__file__), "..", "src"))
+    asyncio.run(main(args.calls))
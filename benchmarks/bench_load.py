@@ -0,0 +1,312 @@
+"""
+Сквозная нагрузка: регистрация, логин, обновление токенов и конвертации против запущенного приложения.
+
+Приложение стартует в отдельном процессе uvicorn с локальной заменой провайдера курсов
+(fake_upstream, задержка --latency) и локальной БД из переменных окружения src/.env.example.
+--concurrency виртуальных клиентов в течение --duration секунд выполняют операции
+в пропорциях --mix; первые --warmup секунд в результат не попадают.
+Для каждого маршрута выводятся p50/p95/p99, число запросов в секунду и ошибки.
+
+Результат - JSON (в stdout или --output) с коммитом и параметрами запуска. Запуски с одинаковыми
+параметрами и --seed сравнимы между коммитами: --compare baseline.json печатает разницу
+и завершается с кодом 1, если p95 или пропускная способность маршрута ухудшились больше чем на --threshold.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_load --concurrency 16 --duration 30 --output load.json
+    python -m benchmarks.bench_load --concurrency 16 --duration 30 --compare load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import httpx
+from sqlalchemy.dialects.postgresql import insert
+
+from benchmarks.fake_upstream import QUOTES, FakeUpstreamServer
+from src.auth.auth_config import get_refresh_strategy
+from src.auth.models import Role
+from src.database import engine
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+DEFAULT_MIX = "register=1,login=2,refresh=2,convert=10,convert_form=3"
+
+PASSWORD = "bench-password"
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class VirtualUser:
+    # Куки выставляются с флагом Secure, поэтому по http их приходится передавать вручную
+    def __init__(self, email: str):
+        self.email = email
+        self.id = None
+        self.cookies = {}
+
+    def remember(self, response: httpx.Response):
+        for name in ("access_token", "refresh_token"):
+            if name in response.cookies:
+                self.cookies[name] = response.cookies[name]
+
+    def headers(self, *names: str) -> dict:
+        return {"Cookie": "; ".join(f"{name}={self.cookies[name]}" for name in names if name in self.cookies)}
+
+
+def new_email(run_id: str) -> str:
+    return f"bench-{run_id}-{uuid.uuid4().hex[:12]}@example.com"
+
+
+async def register(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Response:
+    response = await client.post("/auth/register", json={
+        "email": user.email, "username": user.email.split("@")[0], "password": PASSWORD, "role_id": 1,
+    })
+    if response.status_code == 201:
+        user.id = response.json()["id"]
+    return response
+
+
+async def login(client: httpx.AsyncClient, user: VirtualUser) -> httpx.Response:
+    response = await client.post("/auth/login", data={"username": user.email, "password": PASSWORD})
+    user.remember(response)
+    return response
+
+
+async def op_register(client, users, rng, run_id):
+    return await register(client, VirtualUser(new_email(run_id)))
+
+
+async def op_login(client, users, rng, run_id):
+    return await login(client, rng.choice(users))
+
+
+async def op_refresh(client, users, rng, run_id):
+    user = rng.choice(users)
+    response = await client.post("/auth/refresh", headers=user.headers("refresh_token"))
+    user.remember(response)
+    return response
+
+
+async def op_convert(client, users, rng, run_id):
+    from_, to = rng.sample(list(QUOTES), 2)
+    params = {"from": from_, "to": to, "amount": round(rng.uniform(1, 1000), 2)}
+    return await client.get("/convert", params=params, headers=rng.choice(users).headers("access_token"))
+
+
+async def op_convert_form(client, users, rng, run_id):
+    from_, to = rng.sample(list(QUOTES), 2)
+    data = {"from_": from_, "to": to, "amount": str(round(rng.uniform(1, 1000), 2))}
+    return await client.post("/convert-for-user", data=data, headers=rng.choice(users).headers("access_token"))
+
+
+OPERATIONS = {
+    "register": (op_register, 201),
+    "login": (op_login, 204),
+    "refresh": (op_refresh, 200),
+    "convert": (op_convert, 200),
+    "convert_form": (op_convert_form, 200),
+}
+
+
+def percentile(ordered: list, q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(latencies: dict, errors: dict, elapsed: float) -> dict:
+    routes = {}
+    for name in sorted(set(latencies) | set(errors)):
+        ordered = sorted(latencies[name])
+        routes[name] = {
+            "requests": len(ordered),
+            "errors": sum(errors[name].values()),
+            "error_statuses": dict(errors[name]),
+            "rps": round(len(ordered) / elapsed, 2),
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 2) if ordered else None,
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 2) if ordered else None,
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 2) if ordered else None,
+        }
+    return routes
+
+
+async def drive(base_url: str, mix: dict, users: list, concurrency: int, duration: float, warmup: float,
+                seed: int, run_id: str) -> tuple:
+    latencies = defaultdict(list)
+    errors = defaultdict(lambda: defaultdict(int))
+    names, weights = list(mix), list(mix.values())
+    started = time.perf_counter()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    async def client_loop(client: httpx.AsyncClient, index: int):
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            name = rng.choices(names, weights)[0]
+            operation, expected = OPERATIONS[name]
+            try:
+                status = (await operation(client, users, rng, run_id)).status_code
+            except httpx.HTTPError as error:
+                status = type(error).__name__
+            if now >= measure_from:
+                if status == expected:
+                    latencies[name].append(time.perf_counter() - now)
+                else:
+                    errors[name][str(status)] += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client, index) for index in range(concurrency)))
+    return latencies, errors
+
+
+async def prepare_users(base_url: str, count: int, run_id: str) -> list:
+    # Роль по умолчанию для регистрации (UserManager.create выдает role_id=1)
+    async with engine.begin() as conn:
+        await conn.execute(insert(Role).values(id=1, name="user", permissions=None).on_conflict_do_nothing())
+    await engine.dispose()
+    users = [VirtualUser(new_email(run_id)) for _ in range(count)]
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        for user in users:
+            response = await register(client, user)
+            assert response.status_code == 201, response.text
+            response = await login(client, user)
+            assert response.status_code == 204, response.text
+            # /auth/login выдает только access токен, refresh токен выписывается так же, как в /auth/refresh
+            user.cookies["refresh_token"] = await get_refresh_strategy().write_token(SimpleNamespace(id=user.id))
+    return users
+
+
+async def wait_ready(base_url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/openapi.json")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError("application did not start")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> bool:
+    regressed = False
+    print(f"{'route':<14} {'p95 ms':>20} {'rps':>20}", file=sys.stderr)
+    for name, route in result["routes"].items():
+        base = baseline["routes"].get(name)
+        if not base or not route["p95_ms"] or not base["p95_ms"]:
+            continue
+        p95_change = route["p95_ms"] / base["p95_ms"] - 1
+        rps_change = route["rps"] / base["rps"] - 1 if base["rps"] else 0.0
+        worse = p95_change > threshold or rps_change < -threshold
+        regressed = regressed or worse
+        print(f"{name:<14} {base['p95_ms']:>8} -> {route['p95_ms']:<8}{p95_change:+.0%} "
+              f"{base['rps']:>8} -> {route['rps']:<8}{rps_change:+.0%}{'  REGRESSION' if worse else ''}",
+              file=sys.stderr)
+    if baseline.get("parameters") != result["parameters"]:
+        print("warning: baseline was recorded with different parameters", file=sys.stderr)
+    return regressed
+
+
+async def main(args) -> int:
+    mix = parse_mix(args.mix)
+    run_id = uuid.uuid4().hex[:8]
+    base_url = f"http://127.0.0.1:{args.port}"
+    with FakeUpstreamServer(latency=args.latency, port=args.upstream_port) as upstream:
+        env = dict(
+            os.environ,
+            CURRENCY_API_URL=upstream.url,
+            CURRENCY_API_KEY="bench",
+            BCRYPT_ROUNDS=str(args.bcrypt_rounds),
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(args.port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        )
+        try:
+            await wait_ready(base_url)
+            users = await prepare_users(base_url, args.users, run_id)
+            latencies, errors = await drive(
+                base_url, mix, users, args.concurrency, args.duration, args.warmup, args.seed, run_id,
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+    result = {
+        "commit": git_commit(),
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "latency": args.latency,
+            "mix": mix,
+            "users": args.users,
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "seed": args.seed,
+        },
+        "routes": summarize(latencies, errors, args.duration),
+    }
+    total = sum(route["requests"] for route in result["routes"].values())
+    result["total_rps"] = round(total / args.duration, 2)
+
+    for name, route in result["routes"].items():
+        print(f"{name:<14} {route['rps']:>9,.1f} req/s  p50 {route['p50_ms']} ms  p95 {route['p95_ms']} ms  "
+              f"p99 {route['p99_ms']} ms  errors {route['error_statuses'] or 0}", file=sys.stderr)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as file:
+            return 1 if compare(result, json.load(file), args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake provider latency, sec")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--users", type=int, default=20, help="users registered before the run")
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--upstream-port", type=int, default=8765)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON from a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,79 @@
+"""
+Пропускная способность логинов (проверок bcrypt) в зависимости от числа процессов пула.
+
+Для каждого размера пула запускает --logins одновременных проверок пароля и параллельно
+замеряет задержку event loop: пока хеш считается в самом loop, остальные запросы стоят.
+Первая строка - прежний вариант с verify_and_update прямо в async-коде.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_login_hashing --rounds 12 --logins 32 --workers 1,2,4
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from src.auth.hashing import HashingPool, get_password_helper
+
+
+async def measure(verify, logins: int) -> tuple:
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.perf_counter() - started - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.02)
+    started = time.perf_counter()
+    await asyncio.gather(*(verify() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    return elapsed, lag
+
+
+async def run_inline(rounds: int, logins: int, hashed: str) -> tuple:
+    helper = get_password_helper(rounds)
+
+    async def verify():
+        # Так выглядел UserManager.authenticate до переноса хеширования в пул процессов
+        helper.verify_and_update("password", hashed)
+
+    return await measure(verify, logins)
+
+
+async def run_pool(rounds: int, logins: int, hashed: str, workers: int) -> tuple:
+    pool = HashingPool(rounds=rounds, workers=workers, max_pending=logins)
+    try:
+        # Прогрев: процессы пула стартуют до замера
+        await asyncio.gather(*(pool.verify_and_update("password", hashed) for _ in range(workers)))
+        return await measure(lambda: pool.verify_and_update("password", hashed), logins)
+    finally:
+        pool.shutdown()
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--workers", default=",".join(str(n) for n in sorted({1, max(1, cores // 2), cores})))
+    args = parser.parse_args()
+
+    hashed = get_password_helper(args.rounds).hash("password")
+    print(f"bcrypt rounds={args.rounds}, {args.logins} concurrent logins, {cores} cores")
+    runs = [("inline (event loop)", run_inline(args.rounds, args.logins, hashed))]
+    for workers in (int(n) for n in args.workers.split(",")):
+        runs.append((f"pool, {workers} workers", run_pool(args.rounds, args.logins, hashed, workers)))
+    for name, runner in runs:
+        elapsed, lag = asyncio.run(runner)
+        print(f"{name:<22} {args.logins / elapsed:7.1f} logins/s   max event loop lag {lag * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Граф курсов: полный пересчет против инкрементного обновления при частых частичных обновлениях.
+
+Строится граф из --currencies валют и --sources источников: первый котирует все валюты к USD,
+остальные - случайную половину к своей базовой валюте (EUR, GBP, ...), часть экзотических валют
+есть только у них. Затем --updates раз приходит одна новая котировка случайной пары
+случайного источника, и сравнивается время RateGraph.update с полным rebuild.
+Отдельно - обновление таблицы одного источника целиком, снимок RateTable и проверка треугольников.
+БД и сеть не нужны.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_rate_graph --currencies 180 --updates 2000
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+from src.rates.graph import RateGraph
+from src.rates.providers import Quotes
+
+BASES = ("USD", "EUR", "GBP", "JPY", "CHF", "CNY")
+
+
+def make_sources(currencies: int, sources: int, rng: random.Random) -> tuple:
+    codes = list(BASES) + [f"X{i:03d}" for i in range(currencies - len(BASES))]
+    true = {code: rng.uniform(0.001, 1000) for code in codes}
+    true["USD"] = 1.0
+    exotic = set(rng.sample(codes[len(BASES):], len(codes) // 10))
+    pairs = {}
+    for n in range(sources):
+        base = BASES[n % len(BASES)]
+        quoted = [code for code in codes if code != base and (n == 0 and code not in exotic or n > 0)]
+        if n > 0:
+            quoted = rng.sample(quoted, len(quoted) // 2)
+        pairs[f"source{n}"] = (base, quoted)
+    return codes, true, pairs
+
+
+def quotes_for(name: str, base: str, quoted: list, true: dict, as_of: datetime, rng: random.Random) -> Quotes:
+    # Источники немного расходятся между собой
+    return Quotes(base, {base + code: true[code] / true[base] * (1 + rng.uniform(-5e-4, 5e-4)) for code in quoted},
+                  as_of, provider=name)
+
+
+def report(name: str, samples: list, baseline: float = None):
+    samples = sorted(samples)
+    mean = statistics.fmean(samples)
+    line = (f"{name:<34} mean {mean * 1e6:9.1f} us  p95 {samples[int(len(samples) * 0.95)] * 1e6:9.1f} us")
+    if baseline:
+        line += f"  (x{baseline / mean:.1f})"
+    print(line)
+
+
+def main(currencies: int, sources: int, updates: int, seed: int):
+    rng = random.Random(seed)
+    codes, true, pairs = make_sources(currencies, sources, rng)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    graph = RateGraph(base="USD")
+    for name, (base, quoted) in pairs.items():
+        graph.update_quotes(quotes_for(name, base, quoted, true, start, rng))
+    print(f"{len(graph.codes)} currencies, {len(graph.edges)} quotes from {sources} sources, "
+          f"{len(graph.table().codes)} reachable from USD")
+
+    rebuilds = []
+    for _ in range(20):
+        started = time.perf_counter()
+        graph.rebuild()
+        rebuilds.append(time.perf_counter() - started)
+    report("full rebuild", rebuilds)
+
+    names = list(pairs)
+    single = []
+    for k in range(updates):
+        name = rng.choice(names)
+        base, quoted = pairs[name]
+        code = rng.choice(quoted)
+        rate = true[code] / true[base] * (1 + rng.uniform(-5e-4, 5e-4))
+        started = time.perf_counter()
+        graph.update(base, code, rate, start + timedelta(seconds=k + 1), name)
+        single.append(time.perf_counter() - started)
+    report("single quote, incremental", single, statistics.fmean(rebuilds))
+    stats = graph.stats()
+    print(f"  tree changes {stats['tree_changes']}, rows updated per quote "
+          f"{stats['rows_updated'] / stats['updates']:.1f} of {len(graph.codes)}")
+
+    tables = []
+    for k, (name, (base, quoted)) in enumerate(list(pairs.items()) * 3):
+        quotes = quotes_for(name, base, quoted, true, start + timedelta(seconds=updates + k + 1), rng)
+        started = time.perf_counter()
+        graph.update_quotes(quotes)
+        tables.append(time.perf_counter() - started)
+    report("one source table, incremental", tables, statistics.fmean(rebuilds))
+
+    snapshots, checks = [], []
+    for _ in range(20):
+        graph._table = None
+        started = time.perf_counter()
+        graph.table()
+        snapshots.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        found = graph.check_consistency()
+        checks.append(time.perf_counter() - started)
+    report("RateTable snapshot", snapshots)
+    report("triangle consistency check", checks)
+    print(f"  {len(found)} triangles above {graph.max_deviation:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--currencies", type=int, default=180)
+    parser.add_argument("--sources", type=int, default=3)
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.currencies, args.sources, args.updates, args.seed)
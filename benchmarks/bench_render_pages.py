@@ -0,0 +1,103 @@
+"""
+HTML-страницы конвертера: полный рендер шаблона через Jinja2Templates против PageRenderer.
+
+Приложение вызывается напрямую через ASGI, как в bench_batch_convert. Для сравнения
+app.state.page_renderer подменяется рендером целого шаблона на каждый запрос (как было раньше).
+Нужны переменные окружения из src/.env.example.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_render_pages --calls 2000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+
+from benchmarks.bench_batch_convert import make_rows, prepare_app
+from src.auth.models import User
+from src.main import app, templates
+from src.pages import PageRenderer
+
+
+class FullRender:
+    # Прежний путь: весь шаблон со стилями рендерится на каждый запрос
+    def render(self, request, name, user=None, result=None):
+        return templates.TemplateResponse(name, {"request": request, "user": user, "result": result})
+
+
+async def run_page(client: httpx.AsyncClient, calls: int, headers: dict = None, status: int = 200) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        response = await client.get("/protected-user", headers=headers)
+        assert response.status_code == status
+    return time.perf_counter() - started
+
+
+async def run_form(client: httpx.AsyncClient, rows: list, headers: dict = None) -> float:
+    started = time.perf_counter()
+    for row in rows:
+        response = await client.post(
+            "/convert-for-user", data={"from_": row["from"], "to": row["to"], "amount": str(row["amount"])},
+            headers=headers,
+        )
+        assert response.status_code == 200
+    return time.perf_counter() - started
+
+
+def report(name: str, calls: int, elapsed: float, baseline: float = None):
+    line = f"{name:<28} {calls / elapsed:>9,.0f} req/s"
+    if baseline:
+        line += f"  (x{baseline / elapsed:.2f})"
+    print(line)
+
+
+async def main(calls: int, distinct: int):
+    prepare_app()
+    rows = make_rows(distinct)
+    # Повторяющиеся конвертации, чтобы часть фрагментов результата бралась из кэша
+    form_rows = [random.choice(rows) for _ in range(calls)]
+    renderer = app.state.page_renderer
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        identity = {"Accept-Encoding": "identity"}
+        app.state.page_renderer = FullRender()
+        full_page = await run_page(client, calls, identity)
+        full_form = await run_form(client, form_rows, identity)
+
+        app.state.page_renderer = renderer
+        report("GET page, full render", calls, full_page)
+        report("GET page, renderer", calls, await run_page(client, calls, identity), full_page)
+        report("GET page, renderer, gzip", calls, await run_page(client, calls, {"Accept-Encoding": "gzip"}),
+               full_page)
+        etag = (await client.get("/protected-user")).headers["etag"]
+        report("GET page, renderer, 304", calls, await run_page(client, calls, {"If-None-Match": etag}, 304),
+               full_page)
+        report("POST form, full render", calls, full_form)
+        report("POST form, renderer", calls, await run_form(client, form_rows, identity), full_form)
+        report("POST form, renderer, gzip", calls, await run_form(client, form_rows, {"Accept-Encoding": "gzip"}),
+               full_form)
+    print(f"renderer cache: {renderer.stats()}")
+
+    # Только рендер, без маршрута и ASGI
+    user = User(id=1, email="bench@example.com", username="bench", role_id=1, is_active=True)
+    template = templates.get_template("converter.html")
+    started = time.perf_counter()
+    for _ in range(calls):
+        template.render(user=user, result=None).encode()
+    full = time.perf_counter() - started
+    pages = PageRenderer(templates, ("converter.html",))
+    started = time.perf_counter()
+    for _ in range(calls):
+        pages.render_body("converter.html", user)
+    report("render only, full template", calls, full)
+    report("render only, renderer", calls, time.perf_counter() - started, full)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--distinct", type=int, default=200, help="distinct conversions in the form run")
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.distinct))
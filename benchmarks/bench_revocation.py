@@ -0,0 +1,85 @@
+"""
+Проверка отзыва токена: RevocationList в памяти против запроса к таблице revoked_token.
+
+В списке --revoked отозванных токенов; проверяются --calls случайных неотозванных jti (обычный
+запрос) и отозванные. Отдельно - полная проверка токена RevocableJWTStrategy.read_token
+(разбор и подпись JWT + список) и, с --db, тот же ответ запросом к БД по первичному ключу.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_revocation --revoked 100000 --calls 200000 --db
+"""
+import argparse
+import asyncio
+import secrets
+import statistics
+import time
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+from sqlalchemy import delete, insert, select
+
+from src.auth.models import RevokedToken, User
+from src.auth.revocation import RevocableJWTStrategy, RevocationList
+from src.database import async_session_maker, engine
+
+
+def per_call(name: str, func, keys: list):
+    started = time.perf_counter()
+    for key in keys:
+        func(key)
+    print(f"{name:<40} {(time.perf_counter() - started) / len(keys) * 1e9:8.0f} ns")
+
+
+async def database_lookup(revoked: list, keys: list):
+    async with engine.begin() as conn:
+        await conn.run_sync(RevokedToken.__table__.create, checkfirst=True)
+        await conn.execute(delete(RevokedToken))
+        await conn.execute(insert(RevokedToken), [
+            {"jti": jti, "user_id": 1, "expires_at": datetime.fromtimestamp(time.time() + 3600, tz=timezone.utc)}
+            for jti in revoked
+        ])
+    samples = []
+    async with async_session_maker() as session:
+        for jti in keys:
+            started = time.perf_counter()
+            await session.scalar(select(RevokedToken.jti).where(RevokedToken.jti == jti))
+            samples.append(time.perf_counter() - started)
+    async with engine.begin() as conn:
+        await conn.execute(delete(RevokedToken))
+    await engine.dispose()
+    print(f"{'revoked_token query by jti':<40} {statistics.fmean(samples) * 1e9:8.0f} ns")
+
+
+async def main(revoked_count: int, calls: int, db: bool):
+    revocations = RevocationList(capacity=revoked_count)
+    expires_at = time.time() + 3600
+    revoked = [secrets.token_hex(16) for _ in range(revoked_count)]
+    for jti in revoked:
+        revocations.add(jti, expires_at)
+    fresh = [secrets.token_hex(16) for _ in range(calls)]
+    print(f"{revoked_count} revoked tokens, Bloom filter {revocations.bloom.size / 8 / 1024:.0f} KiB, "
+          f"{revocations.bloom.hashes} hashes")
+    per_call("is_revoked, not revoked", revocations.is_revoked, fresh)
+    per_call("is_revoked, revoked", revocations.is_revoked, revoked[:calls])
+    print(f"  false positives {revocations.false_positives / len(fresh):.2%}")
+
+    user = User(id=1)
+    strategy = RevocableJWTStrategy(secret="secret", lifetime_seconds=3600, revocations=revocations)
+    manager = MagicMock(parse_id=int, get=AsyncMock(return_value=user))
+    tokens = [await strategy.write_token(user) for _ in range(min(calls, 20000))]
+    started = time.perf_counter()
+    for token in tokens:
+        await strategy.read_token(token, manager)
+    print(f"{'read_token (JWT decode + is_revoked)':<40} {(time.perf_counter() - started) / len(tokens) * 1e9:8.0f} ns")
+
+    if db:
+        await database_lookup(revoked[:1000], fresh[:2000])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--revoked", type=int, default=100000)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--db", action="store_true", help="also time the same check as a query to revoked_token")
+    args = parser.parse_args()
+    asyncio.run(main(args.revoked, args.calls, args.db))
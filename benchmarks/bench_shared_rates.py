@@ -0,0 +1,103 @@
+"""
+Общая таблица курсов в памяти (SharedRateFile) против таблицы в каждом процессе.
+
+1. Стоимость одного курса на горячем пути: RateTable.rate в процессе против
+   SharedRateFile.read() + rate по общей памяти.
+2. --readers процессов читают курсы, пока писатель публикует новую таблицу каждые --publish-ms мс.
+   В каждой таблице все курсы к USD равны номеру публикации, поэтому смешанный снимок (курс из
+   одной публикации, заголовок из другой) сразу виден; считаются такие чтения и повторы seqlock.
+БД и сеть не нужны.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_shared_rates --currencies 180 --readers 4 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from src.rates.shared import SharedRateFile, file_size
+from src.rates.table import RateTable
+
+
+def make_table(codes: list, generation: int) -> RateTable:
+    return RateTable.from_quotes("USD", {f"USD{code}": float(generation) for code in codes}, datetime.now(timezone.utc))
+
+
+def reader(path: str, codes: list, seconds: float, results):
+    shared = SharedRateFile(path)
+    rng = random.Random(os.getpid())
+    reads = mixed = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(1000):
+            table = shared.read()
+            rate = table.rate("USD", rng.choice(codes))
+            reads += 1
+            # Курс не может быть старше снимка, в котором его прочитали
+            if rate < table.generation - 1:
+                mixed += 1
+    results.put((reads, mixed, shared.retries))
+
+
+def lookup_cost(codes: list, calls: int, path: str):
+    table = make_table(codes, 1)
+    shared = SharedRateFile(path)
+    pairs = [("USD", random.choice(codes)) for _ in range(calls)]
+    started = time.perf_counter()
+    for from_, to in pairs:
+        table.rate(from_, to)
+    local = time.perf_counter() - started
+    started = time.perf_counter()
+    for from_, to in pairs:
+        shared.read().rate(from_, to)
+    remote = time.perf_counter() - started
+    print(f"RateTable.rate in process      {local / calls * 1e9:8.0f} ns")
+    print(f"shared read() + rate           {remote / calls * 1e9:8.0f} ns")
+
+
+def main(currencies: int, readers: int, seconds: float, publish_ms: float, calls: int):
+    codes = [f"C{i:03d}" for i in range(currencies - 1)]
+    with tempfile.TemporaryDirectory(dir="/dev/shm" if os.path.isdir("/dev/shm") else None) as directory:
+        path = os.path.join(directory, "rates")
+        writer = SharedRateFile(path, capacity=max(256, currencies))
+        writer.publish(make_table(codes, 1))
+        print(f"{currencies} currencies, file {file_size(writer.capacity) / 2 ** 20:.1f} MiB for the whole host")
+        lookup_cost(codes, calls, path)
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=reader, args=(path, codes, seconds, results)) for _ in range(readers)]
+        for process in processes:
+            process.start()
+        publishes, publish_time = 0, 0.0
+        deadline = time.perf_counter() + seconds + 1
+        while time.perf_counter() < deadline:
+            table = make_table(codes, writer.generation + 1)
+            started = time.perf_counter()
+            writer.publish(table)
+            publish_time += time.perf_counter() - started
+            publishes += 1
+            time.sleep(publish_ms / 1000)
+        totals = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        reads = sum(item[0] for item in totals)
+        print(f"publish                        {publish_time / publishes * 1e6:8.0f} us ({publishes} tables)")
+        print(f"{readers} readers                      {reads / seconds:8,.0f} reads/s, "
+              f"mixed snapshots {sum(item[1] for item in totals)}, seqlock retries {sum(item[2] for item in totals)}")
+        writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--currencies", type=int, default=180)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--publish-ms", type=float, default=1.0, help="pause between publications")
+    parser.add_argument("--calls", type=int, default=200000)
+    args = parser.parse_args()
+    main(args.currencies, args.readers, args.seconds, args.publish_ms, args.calls)
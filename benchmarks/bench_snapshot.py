@@ -0,0 +1,70 @@
+"""
+Снимок таблицы курсов на диске: через сколько после старта приложение отвечает курсами.
+
+1. save_snapshot - запись таблицы из --currencies валют (с матрицей свежести графа курсов и без нее).
+2. load_snapshot + первый курс - то, что делает lifespan при старте: mmap, проверка CRC32, таблица
+   поверх отображения файла. Для сравнения - разбор JSON-ответа провайдера той же таблицы
+   (без сетевой задержки, которая при старте обычно намного больше).
+БД и сеть не нужны.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_snapshot --currencies 180 --repeat 200
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from src.rates.snapshot import load_snapshot, save_snapshot
+from src.rates.table import RateTable
+
+
+def measure(func, repeat: int) -> list:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return sorted(samples)
+
+
+def report(name: str, samples: list):
+    print(f"{name:<34} mean {statistics.fmean(samples) * 1e6:9.1f} us  "
+          f"p95 {samples[int(len(samples) * 0.95)] * 1e6:9.1f} us")
+
+
+def main(currencies: int, repeat: int):
+    rng = random.Random(1)
+    quotes = {f"USDC{i:03d}": rng.uniform(0.001, 1000) for i in range(currencies - 1)}
+    as_of = datetime.now(timezone.utc)
+    table = RateTable.from_quotes("USD", quotes, as_of)
+    with_freshness = RateTable("USD", table.codes, table.matrix, as_of,
+                               np.full(table.matrix.shape, as_of.timestamp()))
+    payload = json.dumps({"success": True, "source": "USD", "timestamp": int(as_of.timestamp()), "quotes": quotes})
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, source in (("rates", table), ("graph rates", with_freshness)):
+            path = os.path.join(directory, name)
+            report(f"save {name}", measure(lambda: save_snapshot(source, path), repeat))
+            print(f"  file {os.path.getsize(path) / 1024:.0f} KiB")
+            report(f"load {name} + first rate", measure(lambda: load_snapshot(path).rate("USD", "C000"), repeat))
+
+    def from_provider_json():
+        data = json.loads(payload)
+        RateTable.from_quotes(data["source"], data["quotes"], as_of).rate("USD", "C000")
+
+    report("provider JSON -> RateTable", measure(from_provider_json, repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--currencies", type=int, default=180)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    main(args.currencies, args.repeat)
@@ -0,0 +1,113 @@
+"""
+Время холодного старта: от запуска процессов uvicorn до первого ответа каждого из них.
+
+Запускается --workers процессов одновременно (как воркеры gunicorn), каждый на своем порту.
+Режим current - версия схемы совпадает (обычный рестарт), migrate - перед запуском
+удаляется запись schema_version, и схему применяет один из воркеров.
+Отдельно внутри процесса сравнивается прежняя подготовка БД (синхронный движок,
+database_exists и create_all на каждый старт) с bootstrap_schema.
+Нужна тестовая БД и переменные окружения из src/.env.example.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_startup --workers 4 --runs 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from sqlalchemy import create_engine, delete
+
+from src.database import Base, engine
+from src.schema import bootstrap_schema, schema_version
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def legacy_create_clients_db():
+    # Прежний create_clients_db: отдельный синхронный движок и create_all на каждый старт
+    from sqlalchemy_utils import create_database, database_exists
+
+    sync_engine = create_engine(engine.url.set(drivername="postgresql+psycopg2"))
+    if not database_exists(sync_engine.url):
+        create_database(sync_engine.url)
+    Base.metadata.create_all(sync_engine)
+    sync_engine.dispose()
+
+
+async def reset_version():
+    async with engine.begin() as conn:
+        await conn.execute(delete(schema_version))
+    await engine.dispose()
+
+
+async def wait_ready(client: httpx.AsyncClient, port: int, started: float, timeout: float = 60.0) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            response = await client.get(f"http://127.0.0.1:{port}/openapi.json")
+            if response.status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"Worker on port {port} did not start")
+
+
+async def cold_start(workers: int, base_port: int) -> list:
+    ports = [base_port + i for i in range(workers)]
+    started = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port), "--log-level", "warning"],
+            cwd=ROOT, stdout=subprocess.DEVNULL,
+        )
+        for port in ports
+    ]
+    try:
+        async with httpx.AsyncClient() as client:
+            return await asyncio.gather(*(wait_ready(client, port, started) for port in ports))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    print(f"{name:<32} median {statistics.median(samples) * 1000:7.0f} ms, max {samples[-1] * 1000:7.0f} ms")
+
+
+async def main(workers: int, runs: int, base_port: int):
+    legacy, bootstrap = [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        await asyncio.to_thread(legacy_create_clients_db)
+        legacy.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await bootstrap_schema(engine, Base.metadata)
+        bootstrap.append(time.perf_counter() - started)
+        await engine.dispose()
+    report("schema, create_all every start", legacy)
+    report("schema, version matches", bootstrap)
+
+    for mode in ("current", "migrate"):
+        samples = []
+        for _ in range(runs):
+            if mode == "migrate":
+                await reset_version()
+            samples.extend(await cold_start(workers, base_port))
+        report(f"first request, {workers} workers, {mode}", samples)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=8600)
+    args = parser.parse_args()
+    asyncio.run(main(args.workers, args.runs, args.base_port))
@@ -0,0 +1,63 @@
+"""
+Пропускная способность конвертаций при конкурентных запросах к провайдеру.
+
+Сравнивает прежний вариант (синхронный requests.get внутри async-обработчика)
+с общим UpstreamClient на локальной заглушке провайдера.
+
+Запуск из корня проекта:
+    python -m benchmarks.bench_upstream_client --requests 500 --concurrency 100 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+import requests
+
+from benchmarks.fake_upstream import FakeUpstreamServer
+from src.rates.client import UpstreamClient
+
+
+async def run_blocking(url: str, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handler():
+        async with semaphore:
+            # Так выглядели convert-маршруты до перехода на UpstreamClient
+            requests.get(f"{url}/convert?to=EUR&from=USD&amount=100", headers={"apikey": "bench"}).json()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(total)))
+    return time.perf_counter() - started
+
+
+async def run_pooled(url: str, total: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    client = UpstreamClient(base_url=url, api_key="bench", max_concurrency=concurrency, max_connections=concurrency)
+
+    async def handler():
+        async with semaphore:
+            await client.convert("USD", "EUR", "100")
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(handler() for _ in range(total)))
+        return time.perf_counter() - started
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with FakeUpstreamServer(latency=args.latency) as server:
+        for name, runner in (("requests.get (blocking)", run_blocking), ("UpstreamClient (pooled)", run_pooled)):
+            elapsed = asyncio.run(runner(server.url, args.requests, args.concurrency))
+            print(f"{name:<26} {args.requests} conversions in {elapsed:.2f}s -> {args.requests / elapsed:.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
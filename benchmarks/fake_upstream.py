@@ -0,0 +1,112 @@
+"""
+Локальная замена провайдера курсов (apilayer) для бенчмарков.
+
+Отвечает в формате currency_data API на /convert и /live с настраиваемой задержкой
+и работает в отдельном процессе, чтобы не делить с тестируемым кодом ни event loop, ни GIL.
+"""
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+from urllib.parse import parse_qs
+
+import uvicorn
+
+# Котировки относительно USD
+QUOTES = {
+    "USD": 1.0,
+    "EUR": 0.92,
+    "GBP": 0.79,
+    "JPY": 149.5,
+    "CHF": 0.88,
+    "CNY": 7.24,
+    "RUB": 92.1,
+    "CAD": 1.36,
+}
+
+
+class FakeUpstream:
+    def __init__(self, latency: float = 0.05, quotes: dict = None):
+        self.latency = latency
+        self.quotes = dict(quotes or QUOTES)
+        # Счетчик в разделяемой памяти, чтобы его было видно из родительского процесса
+        self._calls = multiprocessing.Value("q", 0, lock=False)
+
+    @property
+    def calls(self) -> int:
+        return self._calls.value
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        self._calls.value += 1
+        await asyncio.sleep(self.latency)
+        query = {k: v[0] for k, v in parse_qs(scope["query_string"].decode()).items()}
+        path = scope["path"].rsplit("/", 1)[-1]
+        if path == "convert":
+            body = self._convert(query)
+        elif path == "live":
+            body = self._live(query)
+        else:
+            body = {"success": False, "error": {"code": 404, "info": "unknown endpoint"}}
+        payload = json.dumps(body).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    def _convert(self, query: dict) -> dict:
+        from_, to, amount = query["from"], query["to"], float(query.get("amount", 1))
+        rate = self.quotes[to] / self.quotes[from_]
+        return {
+            "success": True,
+            "query": {"from": from_, "to": to, "amount": amount},
+            "info": {"timestamp": int(time.time()), "quote": rate},
+            "result": amount * rate,
+        }
+
+    def _live(self, query: dict) -> dict:
+        source = query.get("source", "USD")
+        base = self.quotes[source]
+        return {
+            "success": True,
+            "timestamp": int(time.time()),
+            "source": source,
+            "quotes": {f"{source}{code}": value / base for code, value in self.quotes.items()},
+        }
+
+
+class FakeUpstreamServer:
+    """
+    Запускает FakeUpstream на 127.0.0.1 в дочернем процессе:
+
+        with FakeUpstreamServer(latency=0.05) as server:
+            client = UpstreamClient(base_url=server.url, api_key="bench")
+    """
+
+    def __init__(self, app: FakeUpstream = None, port: int = 8765, **kwargs):
+        self.app = app or FakeUpstream(**kwargs)
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self._process = multiprocessing.get_context("fork").Process(target=self._run, daemon=True)
+
+    def _run(self):
+        uvicorn.run(self.app, host="127.0.0.1", port=self.port, log_level="warning", backlog=4096)
+
+    def __enter__(self):
+        self._process.start()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=0.1).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("fake upstream did not start")
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.join()
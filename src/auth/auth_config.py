@@ -1,6 +1,7 @@
 from fastapi_users import FastAPIUsers
 from fastapi_users.authentication import (AuthenticationBackend,
                                           CookieTransport, JWTStrategy)
+from src.auth.revocation import RevocableJWTStrategy, RevocationList
 from src.config import settings
 
 from fastapi import Request
@@ -22,20 +23,30 @@ refresh_cookie_transport = CookieTransport(
     cookie_samesite="strict"  # Защита от CSRF
 )
 
+# Отозванные при выходе токены: проверка на каждом запросе без обращения к БД
+revocation_list = RevocationList(
+    interval=settings.REVOCATION_SYNC_INTERVAL,
+    prune_interval=settings.REVOCATION_PRUNE_INTERVAL,
+    capacity=settings.REVOCATION_BLOOM_CAPACITY,
+    error_rate=settings.REVOCATION_BLOOM_ERROR_RATE,
+)
+
 # Стратегия аутентификации для access токена (короткоживущий)
 def get_access_strategy() -> JWTStrategy:
-    return JWTStrategy(
+    return RevocableJWTStrategy(
         secret=settings.access_secret,
         lifetime_seconds=settings.access_exp,
-        algorithm=settings.algorithm
+        algorithm=settings.algorithm,
+        revocations=revocation_list,
     )
 
 # Стратегия аутентификации для refresh токена (долгоживущий)
 def get_refresh_strategy() -> JWTStrategy:
-    return JWTStrategy(
+    return RevocableJWTStrategy(
         secret=settings.refresh_secret,
         lifetime_seconds=settings.refresh_exp,
-        algorithm=settings.algorithm
+        algorithm=settings.algorithm,
+        revocations=revocation_list,
     )
 
 auth_backend = AuthenticationBackend(
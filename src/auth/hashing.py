@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+from fastapi_users.password import PasswordHelper
+from pwdlib import PasswordHash
+from pwdlib.hashers.bcrypt import BcryptHasher
+
+from src.metrics import password_hashing_duration
+
+
+@lru_cache
+def get_password_helper(rounds: int) -> PasswordHelper:
+    return PasswordHelper(PasswordHash((BcryptHasher(rounds=rounds),)))
+
+
+# Функции верхнего уровня, чтобы их можно было передать в процесс пула
+def _hash(rounds: int, password: str) -> str:
+    return get_password_helper(rounds).hash(password)
+
+
+def _verify_and_update(rounds: int, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return get_password_helper(rounds).verify_and_update(password, hashed_password)
+
+
+class HashingPool:
+    """
+    Хеширование и проверка паролей bcrypt в отдельном пуле процессов.
+
+    Один хеш с rounds=14 занимает около секунды процессора, поэтому в event loop его считать нельзя.
+    Число ожидающих и выполняемых задач ограничено max_pending: при переполнении запрос сразу
+    получает 503 вместо того, чтобы стоять в очереди дольше таймаута клиента.
+    """
+
+    def __init__(self, rounds: int = 14, workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 web_workers: int = 1):
+        self.rounds = rounds
+        # Пул есть в каждом веб-воркере: по умолчанию ядра делятся между ними, а не отдаются каждому целиком
+        self.workers = workers or max(1, (os.cpu_count() or 1) // max(web_workers, 1))
+        self.max_pending = max_pending or self.workers * 4
+        self.pending = 0
+        self.completed = 0
+        # Ошибки процесса пула и отмененные запросы (клиент отключился) в completed не входят
+        self.failed = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Процессы создаются при первом обращении; spawn не копирует в воркеры event loop и соединения
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def _run(self, operation: str, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many concurrent logins, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            with password_hashing_duration.time(operation):
+                result = await asyncio.get_running_loop().run_in_executor(self.executor, func, self.rounds, *args)
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", _hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run("verify", _verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
@@ -1,22 +1,29 @@
-from typing import Optional, Dict, Union
+from typing import Any, Optional, Dict, Union
 
 from fastapi import Depends, Request, Response, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_users import (BaseUserManager, IntegerIDMixin, exceptions, models,
                            schemas)
-from fastapi_users.password import PasswordHelper
-from pwdlib import PasswordHash
-from pwdlib.hashers.bcrypt import BcryptHasher
+from sqlalchemy.orm import selectinload
 
 from src.config import settings
+from .hashing import HashingPool, get_password_helper
 from .models import User
+from .user_cache import UserCache
 from .user_repository import get_user_db
 
-password_hash = PasswordHash((
-    BcryptHasher(rounds=14),
-))
+password_helper_bc = get_password_helper(settings.BCRYPT_ROUNDS)
 
-password_helper_bc = PasswordHelper(password_hash)
+# Хеширование паролей при регистрации и входе выполняется вне event loop
+hashing_pool = HashingPool(
+    rounds=settings.BCRYPT_ROUNDS,
+    workers=settings.HASH_WORKERS,
+    max_pending=settings.HASH_MAX_PENDING,
+    web_workers=settings.WEB_CONCURRENCY,
+)
+
+# Снимки пользователя с ролью для current_user и проверок ролей без запросов к БД
+user_cache = UserCache(ttl=settings.USER_CACHE_TTL, max_size=settings.USER_CACHE_MAX_SIZE)
 
 
 class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
@@ -24,6 +31,29 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     verification_token_secret = settings.email_verification_secret
     password_helper = password_helper_bc
 
+    async def get(self, id: models.ID) -> models.UP:
+        """
+        Вызывается для каждого запроса с токеном, поэтому пользователь берется из user_cache.
+        При промахе роль загружается вместе с пользователем одним обращением к сессии.
+        """
+        user = user_cache.get(id)
+        if user is not None:
+            return user
+        user = await self.user_db.session.get(User, id, options=[selectinload(User.role)])
+        if user is None:
+            raise exceptions.UserNotExists()
+        user_cache.put(user)
+        return user
+
+    async def _update(self, user: models.UP, update_dict: Dict[str, Any]) -> models.UP:
+        # Через _update проходят update, verify и reset_password
+        user = await super()._update(user, update_dict)
+        user_cache.invalidate(user.id)
+        return user
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        user_cache.invalidate(user.id)
+
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
@@ -45,7 +75,7 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
             else user_create.create_update_dict_superuser()
         )
         password = user_dict.pop("password")
-        user_dict["hashed_password"] = self.password_helper.hash(password)
+        user_dict["hashed_password"] = await hashing_pool.hash(password)
         user_dict["role_id"] = 1
 
         # Создаем пользователя в базе данных
@@ -89,14 +119,14 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
             user = await self.get_by_email(email)
         except exceptions.UserNotExists:
             # Защита от timing-атак: хешируем пароль даже если пользователь не существует
-            self.password_helper.hash(password)
+            await hashing_pool.hash(password)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid credentials"
             )
 
         # Проверка пароля и получение нового хеша (если алгоритм устарел)
-        verified, updated_password_hash = self.password_helper.verify_and_update(
+        verified, updated_password_hash = await hashing_pool.verify_and_update(
             password, user.hashed_password
         )
         if not verified:
@@ -108,6 +138,7 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
         # Если алгоритм хеширования устарел, обновляем хеш в БД
         if updated_password_hash is not None:
             await self.user_db.update(user, {"hashed_password": updated_password_hash})
+            user_cache.invalidate(user.id)
 
         return user
 
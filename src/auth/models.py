@@ -1,6 +1,6 @@
 from datetime import datetime
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable
-from sqlalchemy import JSON, TIMESTAMP, Boolean, ForeignKey, Integer, String
+from sqlalchemy import JSON, TIMESTAMP, Boolean, ForeignKey, Integer, String, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from src.database import Base
 
@@ -26,3 +26,18 @@ class User(SQLAlchemyBaseUserTable[int], Base):
     is_superuser: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     is_verified: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
 
+
+class RevokedToken(Base):
+    """
+    Отозванные токены (jti) до истечения их срока; просроченные строки удаляет RevocationList.
+
+    revoked_at ставит БД, по нему воркеры догружают новые отзывы (src/auth/revocation.py).
+    """
+    __tablename__ = "revoked_token"
+
+    jti: Mapped[str] = mapped_column(String(32), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, index=True)
+    revoked_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=False, server_default=func.now(), index=True,
+    )
@@ -0,0 +1,186 @@
+import asyncio
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fastapi import Depends, HTTPException, Request, status
+from sqlalchemy import select, text
+
+from src.database import async_session_maker
+from .auth_config import current_user
+from .models import Role, User
+
+ALL_PERMISSIONS = "*"
+
+# Права ролей, у которых колонка permissions не заполнена или пуста: такие роли сохраняют прежний доступ
+DEFAULT_ROLE_PERMISSIONS = {
+    "admin": [ALL_PERMISSIONS],
+    "user": ["convert", "convert:batch", "convert:bulk", "rates:export", "rates:stream"],
+}
+# Остальные роли без прав: форма конвертера была доступна любому вошедшему пользователю
+BASELINE_PERMISSIONS = ["convert"]
+
+# Отпечаток таблицы role: меняется при любом изменении названий или прав ролей
+ROLES_FINGERPRINT = text(
+    "SELECT md5(coalesce(string_agg(id || ':' || name || ':' || coalesce(permissions::text, ''), ',' ORDER BY id), ''))"
+    " FROM role"
+)
+
+
+def parse_permissions(value) -> List[str]:
+    """
+    :param value:
+        Содержимое Role.permissions: список прав ["convert", "convert:batch"]
+        или словарь {"convert:batch": true, "rates:ingest": false}.
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [str(name) for name, allowed in value.items() if allowed]
+    if isinstance(value, (list, tuple)):
+        return [str(name) for name in value]
+    raise ValueError(f"Unsupported permissions format: {value!r}")
+
+
+class PermissionIndex:
+    """
+    Права всех ролей, скомпилированные в битовые маски.
+
+    Каждому праву при первой встрече назначается номер бита, роль хранится как int-маска,
+    поэтому проверка - это поиск в двух словарях и побитовое И без обращения к БД.
+    Индекс перечитывает таблицу role, когда меняется ее отпечаток (md5 всех строк),
+    и сообщает on_change id ролей, права или название которых изменились.
+    """
+
+    def __init__(
+            self,
+            interval: float = 10.0,
+            on_change: Optional[Callable[[List[int]], None]] = None,
+    ):
+        self.interval = interval
+        self.on_change = on_change
+        self.bits: Dict[str, int] = {}
+        self.masks: Dict[int, int] = {}
+        self.names: Dict[int, str] = {}
+        self.fingerprint: Optional[str] = None
+        self.reloads = 0
+        self.last_error: Optional[str] = None
+        # Роли, права которых не удалось разобрать при последней компиляции
+        self.invalid_roles: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _bit(self, permission: str) -> int:
+        # Номера битов не переиспользуются между перезагрузками
+        if permission not in self.bits:
+            self.bits[permission] = len(self.bits)
+        return self.bits[permission]
+
+    def _mask(self, permissions: Iterable[str]) -> int:
+        mask = 0
+        for permission in permissions:
+            # Маска -1 содержит все биты, включая права, которых еще нет в индексе
+            mask = -1 if permission == ALL_PERMISSIONS else mask | 1 << self._bit(permission)
+            if mask == -1:
+                break
+        return mask
+
+    def compile(self, roles: Iterable[Role]) -> List[int]:
+        masks, names = {}, {}
+        errors = []
+        for role in roles:
+            names[role.id] = role.name
+            # Пустые права ({} или []) в существующих строках role значат то же, что незаполненная колонка
+            if not role.permissions:
+                masks[role.id] = self._mask(DEFAULT_ROLE_PERMISSIONS.get(role.name, BASELINE_PERMISSIONS))
+                continue
+            try:
+                masks[role.id] = self._mask(parse_permissions(role.permissions))
+            except ValueError as error:
+                # Одна испорченная роль не должна оставить без прав остальные: у нее остается
+                # прежняя маска, а при первой загрузке - права роли user
+                errors.append(f"role {role.id}: {error}")
+                previous = self.masks.get(role.id)
+                masks[role.id] = previous if previous is not None \
+                    else self._mask(DEFAULT_ROLE_PERMISSIONS["user"])
+        if errors:
+            print(f"Ошибка разбора прав ролей: {'; '.join(errors)}")
+        self.invalid_roles = errors
+        changed = [
+            role_id for role_id in masks.keys() | self.masks.keys()
+            if masks.get(role_id) != self.masks.get(role_id) or names.get(role_id) != self.names.get(role_id)
+        ]
+        self.masks, self.names = masks, names
+        return sorted(changed)
+
+    def has(self, role_id: Optional[int], permission: str) -> bool:
+        mask = self.masks.get(role_id, 0)
+        if mask == -1:
+            return True
+        bit = self.bits.get(permission)
+        return bit is not None and bool(mask >> bit & 1)
+
+    async def reload(self, force: bool = False) -> bool:
+        async with async_session_maker() as session:
+            fingerprint = await session.scalar(ROLES_FINGERPRINT)
+            if not force and fingerprint == self.fingerprint:
+                return False
+            roles = (await session.scalars(select(Role))).all()
+        changed = self.compile(roles)
+        self.fingerprint = fingerprint
+        self.reloads += 1
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reload()
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.last_error = str(error)
+                print(f"Ошибка перезагрузки прав ролей: {error}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "roles": len(self.masks),
+            "permissions": sorted(self.bits, key=self.bits.get),
+            "reloads": self.reloads,
+            "invalid_roles": self.invalid_roles,
+            "last_error": self.last_error,
+        }
+
+
+def get_permission_index(request: Request) -> PermissionIndex:
+    return request.app.state.permission_index
+
+
+def require_permission(permission: str):
+    """
+    Зависимость для маршрута: пропускает пользователя, если у его роли есть право permission.
+
+    Пример: @router.post("/convert-batch", dependencies=[Depends(require_permission("convert:batch"))])
+    """
+
+    async def check_permission(
+            user: User = Depends(current_user),
+            index: PermissionIndex = Depends(get_permission_index),
+    ) -> User:
+        if not index.has(user.role_id, permission):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Permission required: {permission}")
+        return user
+
+    return check_permission
@@ -0,0 +1,258 @@
+import asyncio
+import math
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+
+import jwt
+from fastapi_users import exceptions, models
+from fastapi_users.authentication import JWTStrategy
+from fastapi_users.jwt import decode_jwt, generate_jwt
+from fastapi_users.manager import BaseUserManager
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database import async_session_maker
+from .models import RevokedToken
+
+
+class BloomFilter:
+    """
+    Битовый массив на capacity ключей: "нет" - точный ответ, "да" - ложное с вероятностью около error_rate.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @staticmethod
+    def _hash(key: str):
+        # Двойное хеширование из одного hash(): значения различаются между процессами,
+        # но фильтр строится в каждом процессе заново
+        value = hash(key)
+        return value & 0xFFFFFFFF, (value >> 32 & 0xFFFFFFFF) | 1
+
+    def add(self, key: str):
+        first, step = self._hash(key)
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (first + i * step) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        # Для отсутствующего ключа обычно хватает одного-двух битов
+        first, step = self._hash(key)
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (first + i * step) % size
+            if not bits[position >> 3] >> (position & 7) & 1:
+                return False
+        return True
+
+
+class RevocationList:
+    """
+    Отозванные токены в памяти воркера: фильтр Блума перед точным словарем jti -> срок действия.
+
+    Почти все проверяемые токены не отозваны, и для них ответ дает фильтр; словарь проверяется
+    только при попадании в фильтр. Отзывы пишутся в таблицу revoked_token, другие воркеры
+    догружают их раз в interval секунд по revoked_at. Токены с истекшим сроком удаляются из
+    словаря и таблицы раз в prune_interval: после истечения токен отклоняется и без списка.
+    """
+
+    def __init__(
+            self,
+            interval: float = 2.0,
+            prune_interval: float = 300.0,
+            capacity: int = 100000,
+            error_rate: float = 0.01,
+            overlap: float = 5.0,
+            clock: Callable[[], float] = time.time,
+    ):
+        self.interval = interval
+        self.prune_interval = prune_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Выборки перекрываются на overlap секунд: отзыв, начатый до прошлой выборки,
+        # мог закоммититься уже после нее
+        self.overlap = overlap
+        self.clock = clock
+        self.revoked: Dict[str, float] = {}
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.since: Optional[datetime] = None
+        self.checks = 0
+        self.bloom_hits = 0
+        self.false_positives = 0
+        self.revocations = 0
+        self.syncs = 0
+        self.pruned = 0
+        self.last_error: Optional[str] = None
+        self._pruned_at = clock()
+        self._task: Optional[asyncio.Task] = None
+
+    def is_revoked(self, jti: Optional[str]) -> bool:
+        # Токены, выданные до появления jti, отозвать нельзя - они действуют до истечения срока
+        if jti is None:
+            return False
+        self.checks += 1
+        if jti not in self.bloom:
+            return False
+        self.bloom_hits += 1
+        if jti in self.revoked:
+            return True
+        self.false_positives += 1
+        return False
+
+    def add(self, jti: str, expires_at: float) -> bool:
+        if expires_at <= self.clock() or jti in self.revoked:
+            return False
+        self.revoked[jti] = expires_at
+        if len(self.revoked) > self.bloom.capacity:
+            self._rebuild()
+        else:
+            self.bloom.add(jti)
+        return True
+
+    def _rebuild(self):
+        # Из фильтра Блума нельзя удалить ключ, поэтому после очистки и при переполнении он строится заново
+        bloom = BloomFilter(max(self.capacity, 2 * len(self.revoked)), self.error_rate)
+        for jti in self.revoked:
+            bloom.add(jti)
+        self.bloom = bloom
+
+    def prune(self) -> int:
+        now = self.clock()
+        expired = [jti for jti, expires_at in self.revoked.items() if expires_at <= now]
+        for jti in expired:
+            del self.revoked[jti]
+        if expired:
+            self._rebuild()
+        self.pruned += len(expired)
+        self._pruned_at = now
+        return len(expired)
+
+    async def revoke(self, jti: str, expires_at: float, user_id: int):
+        """
+        Отзывает токен: строка в revoked_token для всех воркеров и сразу - в списке этого воркера.
+
+        :param expires_at:
+            Срок действия токена (claim "exp", unix time); до него отзыв и хранится.
+        """
+        async with async_session_maker() as session:
+            await session.execute(insert(RevokedToken).values(
+                jti=jti, user_id=user_id, expires_at=datetime.fromtimestamp(expires_at, tz=timezone.utc),
+            ).on_conflict_do_nothing())
+            await session.commit()
+        self.add(jti, expires_at)
+        self.revocations += 1
+
+    async def sync(self) -> int:
+        """
+        Догружает отзывы, появившиеся с прошлой синхронизации (при первом вызове - все действующие).
+
+        :return:
+            number of revocations new to this worker
+        """
+        async with async_session_maker() as session:
+            now = await session.scalar(select(func.now()))
+            query = select(RevokedToken.jti, RevokedToken.expires_at).where(RevokedToken.expires_at > now)
+            if self.since is not None:
+                query = query.where(RevokedToken.revoked_at > self.since)
+            rows = (await session.execute(query)).all()
+        self.since = now - timedelta(seconds=self.overlap)
+        self.syncs += 1
+        return sum(self.add(jti, expires_at.timestamp()) for jti, expires_at in rows)
+
+    async def prune_expired(self) -> int:
+        self.prune()
+        async with async_session_maker() as session:
+            result = await session.execute(delete(RevokedToken).where(RevokedToken.expires_at <= func.now()))
+            await session.commit()
+        return result.rowcount
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+                if self.clock() - self._pruned_at >= self.prune_interval:
+                    await self.prune_expired()
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.last_error = str(error)
+                print(f"Ошибка синхронизации отозванных токенов: {error}")
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "revoked": len(self.revoked),
+            "bloom_bits": self.bloom.size,
+            "bloom_hashes": self.bloom.hashes,
+            "checks": self.checks,
+            "bloom_hits": self.bloom_hits,
+            "false_positives": self.false_positives,
+            "revocations": self.revocations,
+            "syncs": self.syncs,
+            "pruned": self.pruned,
+            "last_error": self.last_error,
+        }
+
+
+class RevocableJWTStrategy(JWTStrategy):
+    """
+    JWTStrategy, которая пишет в токен случайный jti и отклоняет токены из RevocationList.
+    destroy_token (выход, обновление пары токенов) отзывает токен до истечения его срока.
+    """
+
+    def __init__(self, *args, revocations: RevocationList, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.revocations = revocations
+
+    def decode(self, token: str) -> Optional[dict]:
+        try:
+            return decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+        except jwt.PyJWTError:
+            return None
+
+    async def read_token(
+            self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]
+    ) -> Optional[models.UP]:
+        if token is None:
+            return None
+        data = self.decode(token)
+        if data is None or data.get("sub") is None or self.revocations.is_revoked(data.get("jti")):
+            return None
+        try:
+            return await user_manager.get(user_manager.parse_id(data["sub"]))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+
+    async def write_token(self, user: models.UP) -> str:
+        data = {"sub": str(user.id), "aud": self.token_audience, "jti": secrets.token_hex(16)}
+        return generate_jwt(data, self.encode_key, self.lifetime_seconds, algorithm=self.algorithm)
+
+    async def destroy_token(self, token: str, user: models.UP) -> None:
+        data = self.decode(token)
+        # Чужой, просроченный или выданный без jti токен отзывать нечего
+        if data is None or data.get("jti") is None or data.get("exp") is None:
+            return
+        await self.revocations.revoke(data["jti"], data["exp"], user.id)
@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from .models import Role, User
+
+
+@dataclass
+class CachedUser:
+    user: dict
+    role: Optional[dict]
+    cached_at: float
+
+
+def _columns(instance) -> dict:
+    return {column.key: getattr(instance, column.key) for column in inspect(type(instance)).column_attrs}
+
+
+class UserCache:
+    """
+    Кэш снимков пользователя вместе с ролью по id с TTL и вытеснением по LRU.
+
+    Хранятся только значения колонок, а на каждое попадание собирается новый detached-объект
+    User: запросы не делят между собой один экземпляр, а изменения такого объекта
+    в сессии сохраняются обычным UPDATE. Инвалидация действует в пределах воркера,
+    в остальных воркерах устаревший снимок живет не дольше ttl.
+    """
+
+    def __init__(self, ttl: float = 30.0, max_size: int = 10000, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._entries: "OrderedDict[int, CachedUser]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int) -> Optional[User]:
+        entry = self._entries.get(user_id)
+        if entry is None or self.clock() - entry.cached_at >= self.ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return self._restore(entry)
+
+    def put(self, user: User):
+        # Роль должна быть уже загружена: ленивая загрузка в async-сессии недоступна
+        role = inspect(user).attrs.role.loaded_value
+        self._entries[user.id] = CachedUser(
+            user=_columns(user),
+            role=_columns(role) if isinstance(role, Role) else None,
+            cached_at=self.clock(),
+        )
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def _restore(entry: CachedUser) -> User:
+        user = User(**entry.user)
+        user.role = Role(**entry.role) if entry.role is not None else None
+        # Объекты получают identity по первичному ключу, а текущие значения считаются сохраненными
+        if user.role is not None:
+            make_transient_to_detached(user.role)
+        make_transient_to_detached(user)
+        return user
+
+    def invalidate(self, user_id: int):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_role(self, role_id: int):
+        # Изменение роли затрагивает всех пользователей с этой ролью
+        for user_id in [user_id for user_id, entry in self._entries.items() if entry.user["role_id"] == role_id]:
+            self.invalidate(user_id)
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -1,9 +1,13 @@
+import time
 from typing import AsyncGenerator
 from sqlalchemy import MetaData, NullPool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from src.config import settings
+from src.metrics import db_pool_acquire_duration
 
 
 metadata = MetaData()
@@ -12,8 +16,52 @@ class Base(DeclarativeBase):
     metadata = metadata  # Явная привязка
 
 
-# Создаем асинхронный движок для подключения к базе данных с использованием NullPool (без пула соединений)
-engine = create_async_engine(settings.ASYNC_DATABASE_URL, poolclass=NullPool, echo=True)
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений, который дополнительно считает время ожидания свободного соединения.
+    """
+    checkouts = 0
+    wait_total = 0.0
+    wait_max = 0.0
+    timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            TimedAsyncQueuePool.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            TimedAsyncQueuePool.checkouts += 1
+            TimedAsyncQueuePool.wait_total += waited
+            TimedAsyncQueuePool.wait_max = max(TimedAsyncQueuePool.wait_max, waited)
+            db_pool_acquire_duration.observe(waited)
+
+
+def create_engine_from_settings():
+    # DB_POOL_SIZE=0 отключает пул (NullPool), например за внешним пулером вроде pgbouncer
+    options = {
+        "echo": settings.DB_ECHO,
+        "connect_args": {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+    }
+    if settings.DB_POOL_SIZE <= 0:
+        return create_async_engine(settings.ASYNC_DATABASE_URL, poolclass=NullPool, **options)
+    return create_async_engine(
+        settings.ASYNC_DATABASE_URL,
+        poolclass=TimedAsyncQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        **options,
+    )
+
+
+# Создаем асинхронный движок с пулом соединений, параметры пула берутся из Settings
+engine = create_engine_from_settings()
 
 # Создаем фабрику асинхронных сессий с использованием ранее созданного движка
 async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
@@ -22,3 +70,25 @@ async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session_maker() as session:
         yield session
+
+
+def pool_stats() -> dict:
+    """
+    Текущее состояние пула соединений текущего воркера.
+    """
+    pool = engine.pool
+    if not isinstance(pool, TimedAsyncQueuePool):
+        return {"pool": type(pool).__name__}
+    checkouts = TimedAsyncQueuePool.checkouts
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "checkouts": checkouts,
+        "wait_avg_ms": TimedAsyncQueuePool.wait_total / checkouts * 1000 if checkouts else 0.0,
+        "wait_max_ms": TimedAsyncQueuePool.wait_max * 1000,
+        "timeouts": TimedAsyncQueuePool.timeouts,
+    }
@@ -1,52 +1,196 @@
+import hmac
+import os
 from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Literal, Optional
 
-import requests
-from fastapi import FastAPI, Request, Form, Depends, APIRouter
+from fastapi import FastAPI, Request, Form, Depends, APIRouter, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine
 from sqlalchemy.ext.asyncio import AsyncSession
-from starlette.responses import HTMLResponse
-from sqlalchemy_utils import database_exists, create_database
+from starlette.responses import HTMLResponse, StreamingResponse
 
-from src.auth.manager import get_user_manager
+from src.auth.manager import get_user_manager, hashing_pool, user_cache
 from src.config import settings
-from src.database import Base, engine, get_async_session
+from src.database import Base, engine, get_async_session, pool_stats
+from src.metrics import MetricsMiddleware, metrics
+from src.pages import PageRenderer
+from src.profiling import Profiler, ProfilerMiddleware
+from src.schema import SchemaMismatchError, bootstrap_schema
 from src.auth.auth_config import fastapi_users, auth_backend, current_user, \
-    refresh_backend, get_refresh_strategy, get_access_strategy
+    refresh_backend, get_refresh_strategy, get_access_strategy, revocation_list
 from src.auth.schemas import UserRead, UserCreate, TokenPair
 from src.auth.models import User, Role
-
-from fastapi import Response, status
-from fastapi.responses import JSONResponse
+from src.auth.rbac import PermissionIndex, get_permission_index, require_permission
+from src.rates.audit import AuditLog
+from src.rates.bulk import BulkConverter, BulkStreamingResponse, bulk_stats
+from src.rates.cache import RateCache
+from src.rates.export import RateExporter, parse_pairs
+from src.rates.graph import RateGraph
+from src.rates.history import convert_at, ingest_rates, parse_moment, table_rows, to_utc_naive
+from src.rates.http_cache import not_modified, snapshot_headers
+from src.rates.client import PROVIDERS
+from src.rates.models import Rate
+from src.rates.providers import ProviderRouter
+from src.rates.schemas import BatchConvertRequest, BatchConvertResponse, RateHistoryItem
+from src.rates.service import convert, convert_batch, normalize_code
+from src.rates.shared import SharedRateRefresher
+from src.rates.snapshot import RateSnapshots, SnapshotProvider
+from src.rates.stream import RateBroadcaster
+from src.rates.table import RateRefresher
+
+from fastapi import Response, status, HTTPException
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from fastapi_users import models
 
 
-templates = Jinja2Templates(directory="templates")
+# Профилирование включается администратором на ограниченное окно, по умолчанию выключено
+profiler = Profiler(max_duration=settings.PROFILER_MAX_DURATION, max_stacks=settings.PROFILER_MAX_STACKS)
+
+templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
 
 async def create_clients_db():
-    print("До create_all:", Base.metadata.tables.keys())
-    # Создаем временный синхронный движок для проверки/создания БД
-    sync_url = engine.url.set(drivername="postgresql+psycopg2")  # меняем на синхронный драйвер
-    sync_engine = create_engine(sync_url)
-
-    if not database_exists(sync_engine.url):
-        create_database(sync_engine.url)
-    sync_engine.dispose()  # закрываем синхронное соединение
+    # DDL выполняется только при изменении моделей, обычный старт воркера - один SELECT версии схемы
     try:
-        async with engine.begin() as conn:
-            # Синхронно создает все таблицы из моделей, наследующих Base
-            await conn.run_sync(Base.metadata.create_all)
-        print("Таблицы базы данных успешно созданы")
+        if await bootstrap_schema(engine, Base.metadata):
+            print("Схема базы данных обновлена:", list(Base.metadata.tables.keys()))
+    except SchemaMismatchError:
+        # Со схемой, которая расходится с моделями, воркер не стартует
+        raise
     except Exception as e:
         print(f"Ошибка при создании таблиц: {e}")
 
 
+def invalidate_role_users(role_ids: List[int]):
+    # Снимки пользователей в кэше содержат роль, после изменения роли их нужно перечитать
+    for role_id in role_ids:
+        user_cache.invalidate_role(role_id)
+
+
+async def record_rate_history(table):
+    # Каждая загруженная таблица курсов сохраняется в историю для конвертаций на дату
+    await ingest_rates(engine, table_rows(table))
+
+
 # Инициализация FastAPI с lifespan
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_clients_db()
+    # Шаблоны конвертера компилируются один раз, на запрос рендерятся только имя и результат
+    app.state.page_renderer = PageRenderer(
+        templates,
+        ("converter.html", "converter_for_admin.html"),
+        max_size=settings.PAGE_CACHE_MAX_SIZE,
+        compress_min_size=settings.PAGE_COMPRESS_MIN_SIZE,
+    )
+    # Права ролей компилируются один раз при старте и перечитываются при изменении таблицы role
+    app.state.permission_index = PermissionIndex(
+        interval=settings.RBAC_RELOAD_INTERVAL,
+        on_change=invalidate_role_users,
+    )
+    try:
+        await app.state.permission_index.reload(force=True)
+    except Exception as e:
+        print(f"Ошибка загрузки прав ролей: {e}")
+    app.state.permission_index.start()
+    # Отозванные токены загружаются до первого запроса, дальше догружаются в фоне
+    try:
+        await revocation_list.sync()
+    except Exception as e:
+        print(f"Ошибка загрузки отозванных токенов: {e}")
+    revocation_list.start()
+    # Провайдеры курсов в порядке приоритета, у каждого один клиент с пулом соединений;
+    # в офлайн-режиме единственный провайдер - файл снимка
+    providers = [SnapshotProvider.from_settings(settings)] if settings.RATE_OFFLINE else \
+        [PROVIDERS[name.strip()](settings) for name in settings.RATE_PROVIDERS.split(",")]
+    app.state.rate_provider = ProviderRouter(
+        providers,
+        hedge=settings.RATE_HEDGE_ENABLED,
+        hedge_delay=settings.RATE_HEDGE_DELAY,
+        max_error_rate=settings.RATE_PROVIDER_MAX_ERROR_RATE,
+        failure_threshold=settings.RATE_BREAKER_FAILURES,
+        reset_timeout=settings.RATE_BREAKER_RESET_TIMEOUT,
+    )
+    app.state.rate_cache = RateCache(
+        loader=app.state.rate_provider.fetch_rate,
+        ttl=settings.RATE_CACHE_TTL,
+        max_size=settings.RATE_CACHE_MAX_SIZE,
+        stale_ttl=settings.RATE_CACHE_STALE_TTL,
+    )
+    # Подписчики потока курсов получают обновления от того же фонового обновления таблицы
+    app.state.rate_broadcaster = RateBroadcaster(
+        queue_size=settings.RATE_STREAM_QUEUE_SIZE,
+        max_subscribers=settings.RATE_STREAM_MAX_SUBSCRIBERS,
+    )
+
+    # Последняя удачная таблица на диске, чтобы после рестарта отвечать курсами до ответа провайдера
+    app.state.rate_snapshots = RateSnapshots(
+        settings.RATE_SNAPSHOT_PATH,
+        interval=settings.RATE_SNAPSHOT_INTERVAL,
+        read_only=settings.RATE_OFFLINE,
+    ) if settings.RATE_SNAPSHOT_PATH else None
+
+    async def on_rate_table(table):
+        app.state.rate_broadcaster.publish(table)
+        if app.state.rate_snapshots is not None:
+            await app.state.rate_snapshots.save(table)
+        if settings.RATE_HISTORY_ENABLED:
+            await record_rate_history(table)
+
+    # Граф курсов объединяет котировки всех провайдеров и считает недостающие пары через промежуточные валюты
+    app.state.rate_graph = RateGraph(
+        base=settings.RATE_TABLE_SOURCE,
+        max_deviation=settings.RATE_GRAPH_MAX_DEVIATION,
+    ) if settings.RATE_GRAPH_ENABLED else None
+    # Фоновое обновление полной таблицы курсов, из которой отвечают convert-маршруты
+    app.state.rate_refresher = RateRefresher(
+        app.state.rate_provider,
+        source=settings.RATE_TABLE_SOURCE,
+        interval=settings.RATE_REFRESH_INTERVAL,
+        jitter=settings.RATE_REFRESH_JITTER,
+        max_backoff=settings.RATE_REFRESH_MAX_BACKOFF,
+        on_refresh=on_rate_table,
+        graph=app.state.rate_graph,
+    )
+    if settings.RATE_SHARED_TABLE_ENABLED:
+        # К провайдеру ходит один воркер на хост, остальные читают его таблицу из общей памяти
+        async def on_shared_table(table):
+            app.state.rate_broadcaster.publish(table)
+
+        app.state.rate_refresher = SharedRateRefresher(
+            app.state.rate_refresher,
+            settings.RATE_SHARED_TABLE_PATH,
+            capacity=settings.RATE_SHARED_TABLE_CAPACITY,
+            poll_interval=settings.RATE_SHARED_TABLE_POLL,
+            on_update=on_shared_table,
+        )
+    if app.state.rate_snapshots is not None:
+        table = app.state.rate_snapshots.load()
+        if table is not None:
+            await app.state.rate_refresher.restore(table)
+            print(f"Таблица курсов загружена из снимка: {len(table.codes)} валют на {table.as_of.isoformat()}")
+    app.state.rate_refresher.start()
+    # Журнал конвертаций пишется в фоне пачками, маршруты только ставят записи в очередь
+    app.state.audit_log = AuditLog(
+        engine,
+        queue_size=settings.AUDIT_QUEUE_SIZE,
+        batch_size=settings.AUDIT_BATCH_SIZE,
+        flush_interval=settings.AUDIT_FLUSH_INTERVAL,
+        overflow=settings.AUDIT_OVERFLOW,
+        block_timeout=settings.AUDIT_BLOCK_TIMEOUT,
+        enabled=settings.AUDIT_ENABLED,
+    )
+    app.state.audit_log.start()
     yield
+    await app.state.permission_index.stop()
+    await revocation_list.stop()
+    await app.state.rate_refresher.stop()
+    await app.state.rate_provider.aclose()
+    # Оставшиеся в очереди записи журнала дописываются до закрытия пула соединений
+    await app.state.audit_log.stop()
+    profiler.stop()
+    hashing_pool.shutdown()
+    await engine.dispose()
 
 app = FastAPI(
     title='Currency Conversion',
@@ -54,8 +198,12 @@ app = FastAPI(
 )
 
 
+# Выход - свой маршрут /auth/logout ниже: он отзывает и access, и refresh токен
+login_router = fastapi_users.get_auth_router(auth_backend)
+login_router.routes = [route for route in login_router.routes if route.path != "/logout"]
+
 app.include_router(
-    fastapi_users.get_auth_router(auth_backend),
+    login_router,
     prefix="/auth",
     tags=["Authentication"],
 )
@@ -87,55 +235,77 @@ app.add_middleware(
                    "Authorization"],
 )
 
+# Отметка запросов, выбранных для профилирования; пока окно не открыто, только проверка profiler.session
+app.add_middleware(ProfilerMiddleware, profiler=profiler)
+
+# Гистограмма задержек по маршрутам; добавлена последней, поэтому внешняя и учитывает время CORSMiddleware
+app.add_middleware(MetricsMiddleware)
+
 
 # Добавляем новые маршруты для работы с токенами
 auth_router = APIRouter(prefix="/auth", tags=["Authentication"])
 
 
+def with_cookies(response: Response, *sources: Response) -> Response:
+    # Транспорт fastapi-users возвращает свой ответ с Set-Cookie, переносим куки в общий ответ
+    for source in sources:
+        response.raw_headers.extend(header for header in source.raw_headers if header[0] == b"set-cookie")
+    return response
+
+
 @auth_router.post("/refresh", response_model=TokenPair)
 async def refresh_token(
-        response: Response,
+        request: Request,
         user: models.UP = Depends(current_user)
 ):
-    # Генерируем новую пару токенов
-    access_token = await auth_backend.login(strategy=get_access_strategy(), user=user)
-    refresh_token = await refresh_backend.login(strategy=get_refresh_strategy(), user=user)
-
-    # Устанавливаем куки
-    await auth_backend.transport.get_login_response(access_token, response)
-    await refresh_backend.transport.get_login_response(refresh_token, response)
-
-    return JSONResponse(
-        status_code=status.HTTP_200_OK,
-        content={"message": "Tokens have been updated successfully!"},
+    # Предъявленный refresh токен одноразовый: отзываем его, чтобы украденная копия не выпускала новые пары
+    token = request.cookies.get(refresh_backend.transport.cookie_name)
+    if token is not None:
+        await refresh_backend.get_strategy().destroy_token(token, user)
+    # Генерируем новую пару токенов, backend.login сразу выставляет куки
+    access_response = await auth_backend.login(strategy=get_access_strategy(), user=user)
+    refresh_response = await refresh_backend.login(strategy=get_refresh_strategy(), user=user)
+    return with_cookies(
+        JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={"message": "Tokens have been updated successfully!"},
+        ),
+        access_response, refresh_response,
     )
 
 
 @auth_router.post("/access-token")
 async def get_access_token(
-        response: Response,
         user: models.UP = Depends(current_user)
 ):
     # Генерируем только access токен
-    access_token = await auth_backend.login(strategy=get_access_strategy(), user=user)
-    await auth_backend.transport.get_login_response(access_token, response)
-    return JSONResponse(
-        status_code=status.HTTP_200_OK,
-        content={"message": "Access token successfully updated!"},
+    access_response = await auth_backend.login(strategy=get_access_strategy(), user=user)
+    return with_cookies(
+        JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={"message": "Access token successfully updated!"},
+        ),
+        access_response,
     )
 
 
 @auth_router.post("/logout")
 async def logout(
-        response: Response,
+        request: Request,
         user: models.UP = Depends(current_user),
 ):
-    # Удаляем куки с токенами
-    await auth_backend.transport.get_logout_response(response)
-    await refresh_backend.transport.get_logout_response(response)
-    return JSONResponse(
-        status_code=status.HTTP_200_OK,
-        content={"message": "Successfully logged out"},
+    # Отзываем оба токена до истечения срока и удаляем куки
+    for backend in (auth_backend, refresh_backend):
+        token = request.cookies.get(backend.transport.cookie_name)
+        if token is not None:
+            await backend.get_strategy().destroy_token(token, user)
+    return with_cookies(
+        JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={"message": "Successfully logged out"},
+        ),
+        await auth_backend.transport.get_logout_response(),
+        await refresh_backend.transport.get_logout_response(),
     )
 
 
@@ -147,36 +317,53 @@ router = APIRouter(
 )
 
 
-async def is_admin(user: User = Depends(current_user), session: AsyncSession = Depends(get_async_session)
-                   ) -> bool:
-    await session.refresh(user, ["role"])  # Явно обновляем связь
-    return user.role.name == "admin"
+def get_rate_cache(request: Request) -> RateCache:
+    return request.app.state.rate_cache
+
+
+def get_rate_refresher(request: Request) -> RateRefresher:
+    return request.app.state.rate_refresher
+
+
+def get_rate_broadcaster(request: Request) -> RateBroadcaster:
+    return request.app.state.rate_broadcaster
+
+
+def get_audit_log(request: Request) -> AuditLog:
+    return request.app.state.audit_log
+
+
+def get_page_renderer(request: Request) -> PageRenderer:
+    return request.app.state.page_renderer
+
+
+async def is_admin(user: User = Depends(current_user)) -> bool:
+    # Роль приходит вместе с пользователем из user_cache, отдельный запрос к БД не нужен
+    if user.role is None or user.role.name != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin role required")
+    return True
 
 
 @router.get("/protected-user", response_class=HTMLResponse)
-async def protected_user_route(request: Request, user: User = Depends(current_user)):
-    return templates.TemplateResponse(
-        "converter.html",
-        {
-            "request": request,
-            "user": user
-        }
-    )
+async def protected_user_route(request: Request, user: User = Depends(current_user),
+                               pages: PageRenderer = Depends(get_page_renderer)):
+    return pages.render(request, "converter.html", user)
 
 
 @router.get("/protected-admin", response_class=HTMLResponse, dependencies=[Depends(is_admin)])
-async def protected_admin_route(request: Request, user: User = Depends(current_user)):
-    return templates.TemplateResponse(
-        "converter_for_admin.html",
-        {
-            "request": request,
-            "user": user
-        }
-    )
+async def protected_admin_route(request: Request, user: User = Depends(current_user),
+                                pages: PageRenderer = Depends(get_page_renderer)):
+    return pages.render(request, "converter_for_admin.html", user)
 
 
 @router.post("/convert-for-user", response_class=HTMLResponse)
-async def protected_user_route(request: Request, user: User = Depends(current_user), from_: str = Form(...), to: str = Form(...), amount: str = Form(...)):
+async def protected_user_route(request: Request, user: User = Depends(current_user), from_: str = Form(...), to: str = Form(...), amount: str = Form(...),
+                               permissions: PermissionIndex = Depends(get_permission_index),
+                               rate_cache: RateCache = Depends(get_rate_cache),
+                               refresher: RateRefresher = Depends(get_rate_refresher),
+                               audit_log: AuditLog = Depends(get_audit_log),
+                               pages: PageRenderer = Depends(get_page_renderer),
+                               date: Optional[str] = Form(None), session: AsyncSession = Depends(get_async_session)):
     """
     :param from_:
         This option is intended for the currency we are converting.
@@ -187,22 +374,37 @@ async def protected_user_route(request: Request, user: User = Depends(current_us
     :param amount:
         Number of currencies convertible.
 
+    :param date:
+        Optional moment (ISO date or datetime, UTC) to convert at; answered from the rate history
+        with the latest rate at or before it. A bare date means the end of that day.
+
     :return:
         json response
     """
+    # Форма отвечает страницей, а не JSON-ошибкой require_permission
+    if not permissions.has(user.role_id, "convert"):
+        response = pages.render(request, "converter.html", user)
+        response.status_code = status.HTTP_403_FORBIDDEN
+        return response
     try:
-        url = f"https://api.apilayer.com/currency_data/convert?to={to}&from={from_}&amount={amount}"
-        headers = {"apikey": settings.CURRENCY_API_KEY}
-        response = requests.get(url, headers=headers)
-        result = response.json()
-        return templates.TemplateResponse("converter.html", {"request": request, "user": user, "result": result})
+        if date:
+            result = await convert_at(session, from_, to, amount, parse_moment(date), settings.RATE_TABLE_SOURCE)
+        else:
+            result = await convert(rate_cache, from_, to, amount, refresher.table, refresher.max_age)
+        await audit_log.record(user.id, result)
+        return pages.render(request, "converter.html", user, result)
     except Exception as error:
         return templates.TemplateResponse("converter.html", {"request": request, "error": str(error)})
 
 
 
 @router.post("/convert-for-admin", response_class=HTMLResponse, dependencies=[Depends(is_admin)])
-async def protected_admin_route(request: Request, user: User = Depends(current_user), from_: str = Form(...), to: str = Form(...), amount: str = Form(...)):
+async def protected_admin_route(request: Request, user: User = Depends(current_user), from_: str = Form(...), to: str = Form(...), amount: str = Form(...),
+                                rate_cache: RateCache = Depends(get_rate_cache),
+                                refresher: RateRefresher = Depends(get_rate_refresher),
+                                audit_log: AuditLog = Depends(get_audit_log),
+                                pages: PageRenderer = Depends(get_page_renderer),
+                                date: Optional[str] = Form(None), session: AsyncSession = Depends(get_async_session)):
     """
     :param from_:
         This option is intended for the currency we are converting.
@@ -213,30 +415,423 @@ async def protected_admin_route(request: Request, user: User = Depends(current_u
     :param amount:
         Number of currencies convertible.
 
+    :param date:
+        Optional moment (ISO date or datetime, UTC) to convert at; answered from the rate history
+        with the latest rate at or before it. A bare date means the end of that day.
+
     :return:
         json response
     """
     try:
-        url = f"https://api.apilayer.com/currency_data/convert?to={to}&from={from_}&amount={amount}"
-        headers = {"apikey": settings.CURRENCY_API_KEY}
-        response = requests.get(url, headers=headers)
-        result = response.json()
-        return templates.TemplateResponse("converter_for_admin.html", {"request": request, "user": user, "result": result})
+        if date:
+            result = await convert_at(session, from_, to, amount, parse_moment(date), settings.RATE_TABLE_SOURCE)
+        else:
+            result = await convert(rate_cache, from_, to, amount, refresher.table, refresher.max_age)
+        await audit_log.record(user.id, result)
+        return pages.render(request, "converter_for_admin.html", user, result)
     except Exception as error:
         return templates.TemplateResponse("converter_for_admin.html", {"request": request, "error": str(error)})
 
+
+@router.get("/convert", response_class=ORJSONResponse)
+async def convert_json_route(request: Request, to: str, amount: float, from_: str = Query(..., alias="from"),
+                             user: User = Depends(require_permission("convert")),
+                             rate_cache: RateCache = Depends(get_rate_cache),
+                             refresher: RateRefresher = Depends(get_rate_refresher),
+                             audit_log: AuditLog = Depends(get_audit_log)):
+    """
+    :param from:
+        Currency we are converting from.
+
+    :param to:
+        Currency we are converting to.
+
+    :param amount:
+        Number of currencies convertible.
+
+    :return:
+        json response in the provider format with ETag, Last-Modified and Cache-Control
+        derived from the rate table version; If-None-Match / If-Modified-Since get 304
+    """
+    table = refresher.table
+    headers = None
+    if table is not None:
+        max_age = 0 if table.age() > refresher.max_age else refresher.interval - table.age()
+        headers = snapshot_headers(table, max_age)
+        # Снимок не менялся - отвечаем 304 без конвертации и сериализации
+        if not_modified(request, headers):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        result = await convert(rate_cache, from_, to, amount, table, refresher.max_age)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    except Exception as error:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Currency provider error: {error}")
+    if "timestamp" not in result["info"]:
+        # Курс взят из кэша пар, а не из снимка: валидаторы снимка к нему не относятся
+        headers = {"Cache-Control": "no-cache"}
+    await audit_log.record(user.id, result)
+    return ORJSONResponse(result, headers=headers)
+
+
+@router.post("/convert-batch", response_model=BatchConvertResponse)
+async def convert_batch_route(payload: BatchConvertRequest, user: User = Depends(require_permission("convert:batch")),
+                              rate_cache: RateCache = Depends(get_rate_cache),
+                              refresher: RateRefresher = Depends(get_rate_refresher),
+                              audit_log: AuditLog = Depends(get_audit_log)):
+    """
+    :param payload:
+        List of conversion items: {"from": "USD", "to": "EUR", "amount": 100}.
+
+    :return:
+        json response with one result per item, in the same order;
+        items with an unknown currency get "error" instead of "result"
+    """
+    results = await convert_batch(rate_cache, payload.items, refresher.table)
+    await audit_log.record_many(user.id, results)
+    # Результаты уже собраны в dict, повторная валидация через response_model не нужна
+    return JSONResponse(content={"results": results})
+
+
+@router.post("/convert-bulk", response_class=BulkStreamingResponse)
+async def convert_bulk_route(request: Request, to: str, from_column: str = "currency", amount_column: str = "amount",
+                             format: Optional[str] = None,
+                             user: User = Depends(require_permission("convert:bulk")),
+                             rate_cache: RateCache = Depends(get_rate_cache),
+                             refresher: RateRefresher = Depends(get_rate_refresher),
+                             audit_log: AuditLog = Depends(get_audit_log)):
+    """
+    :param to:
+        Comma-separated target currencies, e.g. EUR,GBP; one "<amount_column>_<TO>" column is added per currency.
+
+    :param from_column:
+        Column (or NDJSON key) with the source currency code.
+
+    :param amount_column:
+        Column (or NDJSON key) with the amount to convert.
+
+    :param format:
+        csv or ndjson; taken from the Content-Type (text/csv, application/x-ndjson) when omitted.
+
+    :return:
+        the uploaded file streamed back chunk by chunk with the converted-amount columns added
+    """
+    if format is None:
+        format = "ndjson" if "ndjson" in request.headers.get("content-type", "") else "csv"
+    try:
+        converter = BulkConverter(
+            request, rate_cache, refresher.table,
+            targets=[normalize_code(code) for code in to.split(",") if code.strip()],
+            fmt=format,
+            from_column=from_column,
+            amount_column=amount_column,
+            chunk_rows=settings.BULK_CHUNK_ROWS,
+            audit_log=audit_log,
+            user_id=user.id,
+        )
+        await converter.start()
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    return BulkStreamingResponse(converter.stream(), media_type=converter.media_type)
+
+
+@router.post("/rates/history", dependencies=[Depends(is_admin)])
+async def ingest_rate_history(items: List[RateHistoryItem]):
+    """
+    :param items:
+        Historical rates to backfill: {"base": "USD", "quote": "EUR", "timestamp": "...", "rate": 0.92}.
+
+    :return:
+        json response with the number of ingested rows
+    """
+    count = await ingest_rates(engine, ((item.base, item.quote, item.timestamp, item.rate) for item in items))
+    return JSONResponse(status_code=status.HTTP_200_OK, content={"ingested": count})
+
+
+@router.get("/rates/history/export", response_class=StreamingResponse)
+async def export_rate_history(pairs: str, start: datetime, end: datetime, format: str = "ndjson",
+                              interval: Optional[str] = None,
+                              user: User = Depends(require_permission("rates:export"))):
+    """
+    :param pairs:
+        Comma-separated currency pairs, e.g. USDEUR,USD/GBP.
+
+    :param start:
+        Start of the range (UTC), inclusive.
+
+    :param end:
+        End of the range (UTC), inclusive.
+
+    :param format:
+        ndjson or csv.
+
+    :param interval:
+        Optional downsampling bucket (minute, hour, day, week, month); rows become OHLC candles.
+
+    :return:
+        streamed rate history ordered by pair and time
+    """
+    try:
+        exporter = RateExporter(
+            parse_pairs(pairs), to_utc_naive(start), to_utc_naive(end), fmt=format, interval=interval,
+            page_size=settings.RATE_EXPORT_PAGE_SIZE, batch_size=settings.RATE_EXPORT_BATCH_SIZE,
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    return StreamingResponse(exporter.stream(), media_type=exporter.media_type)
+
+
+@router.get("/rates/stream", response_class=StreamingResponse)
+async def stream_rates(request: Request, pairs: str, user: User = Depends(require_permission("rates:stream")),
+                       broadcaster: RateBroadcaster = Depends(get_rate_broadcaster),
+                       session: AsyncSession = Depends(get_async_session)):
+    """
+    :param pairs:
+        Comma-separated currency pairs, e.g. USDEUR,USD/GBP.
+
+    :return:
+        Server-Sent Events stream: an "rates" event with the current rates of the pairs
+        right away and after every rate table refresh. A slow client skips intermediate updates.
+    """
+    try:
+        subscription = broadcaster.subscribe(parse_pairs(pairs))
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+    except OverflowError as error:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error))
+    # Сессия запроса (через нее мог загружаться пользователь) живет до конца ответа:
+    # закрываем ее сразу, чтобы долгое соединение не держало соединение из пула БД
+    await session.close()
+    return StreamingResponse(
+        broadcaster.events(subscription, settings.RATE_STREAM_HEARTBEAT, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 """
 Если пользователь не аутентифицирован, current_user в is_admin() выбросит 401 Unauthorized;
 Затем выполняется проверка user.role.name == "admin";
 Если проверка не проходит, возвращается 403 Forbidden;
 
-FastAPI автоматически возвращает 403 Forbidden, если зависимость в dependencies=[...] вернула False.
-Это часть встроенной логики Depends() для удобства реализации RBAC (Role Based Access Control (рус. Управление доступом на основе ролей)).
+Значение, которое вернула зависимость из dependencies=[...], FastAPI игнорирует, поэтому is_admin
+выбрасывает HTTPException 403 сам. Так реализуется RBAC (Role Based Access Control (рус. Управление доступом на основе ролей)).
 """
 
 app.include_router(router)
 
 
+stats_router = APIRouter(
+    prefix="/stats",
+    tags=["Monitoring"]
+)
+
+
+@stats_router.get("/rate-cache", dependencies=[Depends(is_admin)])
+async def rate_cache_stats(rate_cache: RateCache = Depends(get_rate_cache)):
+    # Счетчики попаданий/промахов кэша курсов для мониторинга
+    return rate_cache.stats()
+
+
+@stats_router.get("/db-pool", dependencies=[Depends(is_admin)])
+async def db_pool_stats():
+    # Занятые соединения, переполнение и время ожидания соединения в пуле этого воркера
+    return pool_stats()
+
+
+@stats_router.get("/rate-table", dependencies=[Depends(is_admin)])
+async def rate_table_stats(refresher: RateRefresher = Depends(get_rate_refresher)):
+    # Момент, на который актуальны курсы в памяти ("rates as of"), и состояние обновления
+    return refresher.stats()
+
+
+@stats_router.get("/rate-graph", dependencies=[Depends(is_admin)])
+async def rate_graph_stats(request: Request):
+    # Валюты и котировки в графе курсов, число перестроений дерева и несогласованные треугольники
+    graph = getattr(request.app.state, "rate_graph", None)
+    if graph is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rate graph is disabled")
+    return graph.stats()
+
+
+@stats_router.get("/rate-snapshot", dependencies=[Depends(is_admin)])
+async def rate_snapshot_stats(request: Request):
+    # Файл снимка курсов: сколько раз сохранен, размер, версии загруженной и сохраненной таблиц, ошибки
+    snapshots = getattr(request.app.state, "rate_snapshots", None)
+    if snapshots is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Rate snapshots are disabled")
+    return snapshots.stats()
+
+
+@stats_router.get("/rate-providers", dependencies=[Depends(is_admin)])
+async def rate_provider_stats(request: Request):
+    # Задержки (p50/p95), доля ошибок и страхующие запросы по каждому провайдеру курсов
+    return request.app.state.rate_provider.stats()
+
+
+@stats_router.get("/rate-stream", dependencies=[Depends(is_admin)])
+async def rate_stream_stats(broadcaster: RateBroadcaster = Depends(get_rate_broadcaster)):
+    # Число подписчиков потока курсов и пропущенных медленными клиентами обновлений
+    return broadcaster.stats()
+
+
+@stats_router.get("/bulk-convert", dependencies=[Depends(is_admin)])
+async def bulk_convert_stats():
+    # Потоковые конвертации выгрузок: число, прерванные клиентом, строки и скорость в строках в секунду
+    return bulk_stats.stats()
+
+
+@stats_router.get("/audit", dependencies=[Depends(is_admin)])
+async def audit_log_stats(audit_log: AuditLog = Depends(get_audit_log)):
+    # Очередь журнала конвертаций: записано, отброшено при переполнении и потеряно при ошибках БД
+    return audit_log.stats()
+
+
+@stats_router.get("/pages", dependencies=[Depends(is_admin)])
+async def page_renderer_stats(pages: PageRenderer = Depends(get_page_renderer)):
+    # Попадания в кэш фрагментов страниц конвертера, ответы 304 и сжатые ответы
+    return pages.stats()
+
+
+@stats_router.get("/user-cache", dependencies=[Depends(is_admin)])
+async def user_cache_stats():
+    # Доля запросов, для которых пользователь и роль взяты из кэша без обращения к БД
+    return user_cache.stats()
+
+
+@stats_router.get("/permissions", dependencies=[Depends(is_admin)])
+async def permission_index_stats(request: Request):
+    # Известные права, число ролей в индексе и ошибки перезагрузки
+    return request.app.state.permission_index.stats()
+
+
+@stats_router.get("/password-hashing", dependencies=[Depends(is_admin)])
+async def password_hashing_stats():
+    # Загрузка пула хеширования паролей и число логинов, получивших 503
+    return hashing_pool.stats()
+
+
+@stats_router.get("/token-revocation", dependencies=[Depends(is_admin)])
+async def token_revocation_stats():
+    # Отозванные токены в памяти воркера, попадания в фильтр Блума и ложные срабатывания, синхронизации
+    return revocation_list.stats()
+
+
+app.include_router(stats_router)
+
+
+profiler_router = APIRouter(
+    prefix="/profiler",
+    tags=["Monitoring"]
+)
+
+
+@profiler_router.post("/start", dependencies=[Depends(is_admin)])
+async def start_profiling(
+    request: Request,
+    mode: Literal["sample", "trace"] = Query("sample"),
+    route: Optional[str] = Query(None),
+    percent: float = Query(100.0, gt=0, le=100),
+    duration: float = Query(30.0, gt=0),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+):
+    """
+    Открывает окно профилирования запросов.
+
+    :param mode:
+        sample - periodic stack sampling (low overhead), trace - every call via sys.setprofile (exact, slow)
+    :param route:
+        Route template to profile, e.g. /convert; all routes if omitted
+    :param percent:
+        Share of matching requests to profile
+    :param duration:
+        Window length in seconds, capped by PROFILER_MAX_DURATION
+    :param interval_ms:
+        Sampling interval for mode=sample
+    """
+    routes = []
+    if route is not None:
+        routes = [item for item in request.app.router.routes if getattr(item, "path", None) == route]
+        if not routes:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown route: {route}")
+    try:
+        session = profiler.start(mode, routes, route, percent / 100, duration, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return session.stats()
+
+
+@profiler_router.post("/stop", dependencies=[Depends(is_admin)])
+async def stop_profiling():
+    # Закрывает окно досрочно, собранные стеки остаются доступны в /profiler/report
+    session = profiler.stop()
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profiling is not running")
+    return session.stats()
+
+
+@profiler_router.get("", dependencies=[Depends(is_admin)])
+async def profiling_status():
+    # Текущее или последнее окно профилирования
+    session = profiler.poll()
+    return session.stats() if session is not None else {"active": False}
+
+
+@profiler_router.get("/report", response_class=PlainTextResponse, dependencies=[Depends(is_admin)])
+async def profiling_report():
+    """
+    Агрегированные стеки вызовов текущего или последнего окна в collapsed-формате:
+    строка на стек "GET /convert;кадр;кадр вес", вес - число сэмплов (sample) или микросекунды (trace).
+    Подходит для flamegraph.pl, speedscope и inferno.
+    """
+    session = profiler.poll()
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No profiling data")
+    return PlainTextResponse(session.collapsed())
+
+
+app.include_router(profiler_router)
+
+
+def collect_app_stats():
+    # Значения кэшей, пулов и очередей для /metrics: те же stats(), что отдают маршруты /stats
+    yield "db_pool", pool_stats()
+    yield "user_cache", user_cache.stats()
+    yield "password_hashing", hashing_pool.stats()
+    yield "token_revocation", revocation_list.stats()
+    yield "bulk_convert", bulk_stats.stats()
+    for prefix, name in (("rate_cache", "rate_cache"), ("rate_table", "rate_refresher"),
+                         ("rate_stream", "rate_broadcaster"), ("rate_graph", "rate_graph"),
+                         ("rate_snapshot", "rate_snapshots"), ("audit", "audit_log"),
+                         ("pages", "page_renderer"), ("permissions", "permission_index")):
+        # До старта lifespan объектов в app.state еще нет
+        source = getattr(app.state, name, None)
+        if source is not None:
+            yield prefix, source.stats()
+    provider = getattr(app.state, "rate_provider", None)
+    if provider is not None:
+        for name, stats in provider.stats()["providers"].items():
+            yield "rate_provider", stats, {"provider": name}
+
+
+metrics.collector(collect_app_stats)
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_endpoint(request: Request):
+    """
+    Метрики в текстовом формате Prometheus: гистограммы задержек и значения кэшей/пулов этого воркера.
+
+    :param request:
+        If METRICS_TOKEN is set, the Authorization header must be "Bearer <METRICS_TOKEN>"
+    """
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(request.headers.get("authorization", ""), expected):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,184 @@
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы корзин гистограмм в секундах: от обращения к памяти до медленного провайдера
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами в формате Prometheus.
+
+    observe - поиск корзины bisect и два сложения, без блокировок: все вызовы идут из одного
+    event loop (или из потока пула соединений, где потеря единичного наблюдения не страшна).
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # Значения меток -> [счетчики корзин..., +Inf, сумма]
+        self.series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> "Timer":
+        return Timer(self, labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(series[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса. Гистограммы обновляются на горячем пути, а значения кэшей и пулов
+    (gauges) снимаются функциями-источниками только в момент запроса /metrics.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.collectors: List[Callable[[], Iterable[tuple]]] = []
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, documentation, labels, buckets)
+        return self.histograms[name]
+
+    def collector(self, collect: Callable[[], Iterable[tuple]]):
+        """
+        collect возвращает пары ("префикс", stats()) или тройки с метками ("префикс", stats(), {"метка": "значение"});
+        числовые поля stats становятся gauge "<префикс>_<поле>".
+        """
+        self.collectors.append(collect)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        samples: Dict[str, List[str]] = {}
+        for collect in self.collectors:
+            for prefix, stats, *labels in collect():
+                labels = labels[0] if labels else {}
+                for name, value in gauges(prefix, stats):
+                    samples.setdefault(name, []).append(
+                        f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}"
+                    )
+        for name, values in samples.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(values)
+        return "\n".join(lines) + "\n"
+
+
+def gauges(prefix: str, stats: dict) -> Iterable[Tuple[str, float]]:
+    # Вложенные словари (например, circuit у провайдера) разворачиваются в <префикс>_<ключ>_<поле>
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from gauges(f"{prefix}_{key}", value)
+        elif isinstance(value, bool):
+            yield f"{prefix}_{key}", int(value)
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}_{key}", value
+
+
+metrics = MetricsRegistry()
+
+http_request_duration = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ("method", "route", "status"),
+)
+upstream_request_duration = metrics.histogram(
+    "upstream_request_duration_seconds", "Rate provider call latency", ("provider", "method", "outcome"),
+)
+password_hashing_duration = metrics.histogram(
+    "password_hashing_duration_seconds", "bcrypt hash/verify latency including pool queueing", ("operation",),
+)
+db_pool_acquire_duration = metrics.histogram(
+    "db_pool_acquire_duration_seconds", "Time to check a connection out of the pool",
+)
+template_render_duration = metrics.histogram(
+    "template_render_duration_seconds", "Converter page render time", ("template",),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: длительность каждого HTTP-запроса по шаблону маршрута (/convert, а не /convert?...),
+    методу и статусу. Шаблон берется из scope["route"] после маршрутизации, поэтому число рядов
+    ограничено числом маршрутов; запросы без маршрута попадают в route="unmatched".
+    """
+
+    def __init__(self, app, histogram: Optional[Histogram] = None):
+        self.app = app
+        self.histogram = histogram or http_request_duration
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            self.histogram.observe(
+                time.perf_counter() - started,
+                scope["method"], route.path if route is not None else "unmatched", status,
+            )
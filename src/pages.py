@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fastapi.templating import Jinja2Templates
+from jinja2 import Template
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+
+from src.metrics import template_render_duration
+from src.rates.http_cache import not_modified
+
+# Блоки шаблона, которые зависят от запроса; все остальное - статическая оболочка страницы
+FRAGMENTS = ("greeting", "result", "stale")
+
+
+class CompiledPage:
+    """
+    Шаблон, разрезанный на статические части и места для блоков FRAGMENTS.
+
+    parts[i] - готовые байты оболочки перед slots[i] (последняя часть - после всех блоков),
+    поэтому страница собирается склейкой байтов без прохода по всему шаблону.
+    """
+
+    __slots__ = ("name", "template", "parts", "slots")
+
+    def __init__(self, name: str, template: Template, parts: List[bytes], slots: List[str]):
+        self.name = name
+        self.template = template
+        self.parts = parts
+        self.slots = slots
+
+
+def compile_page(templates: Jinja2Templates, name: str) -> CompiledPage:
+    template = templates.env.get_template(name)
+    context = template.new_context({})
+    for block in FRAGMENTS:
+        if block in template.blocks:
+            # Вместо содержимого блока оболочка получает маркер, по которому потом режется
+            context.blocks[block] = [lambda ctx, block=block: iter([f"\x00{block}\x00"])]
+    pieces = re.split("\x00(%s)\x00" % "|".join(FRAGMENTS), "".join(template.root_render_func(context)))
+    parts = [piece.encode() for piece in pieces[::2]]
+    slots = pieces[1::2]
+    return CompiledPage(name, template, parts, slots)
+
+
+def result_snapshot(result: Optional[dict]) -> tuple:
+    # Все значения, которые выводит блок result, и только они; возраст устаревшего курса - в блоке stale
+    if not result:
+        return ()
+    return result["query"]["from"], result["query"]["to"], result["result"]
+
+
+class PageRenderer:
+    """
+    Страницы конвертера без полного рендера шаблона на каждый запрос.
+
+    Шаблоны один раз компилируются при старте в статическую оболочку (CompiledPage).
+    На запрос подставляются только блоки greeting (имя пользователя), result и stale; готовые блоки
+    greeting и result кэшируются по шаблону (т.е. роли) и имени пользователя или снимку результата в LRU
+    не больше max_size записей, в нем же хранятся сжатые gzip версии страниц. Ответ получает ETag, GET с совпадающим
+    If-None-Match получает 304.
+    """
+
+    def __init__(self, templates: Jinja2Templates, names: Tuple[str, ...], max_size: int = 1024,
+                 compress_min_size: int = 1024):
+        self.pages: Dict[str, CompiledPage] = {name: compile_page(templates, name) for name in names}
+        self.max_size = max_size
+        self.compress_min_size = compress_min_size
+        self.cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.compressed = 0
+
+    def _cached(self, key: tuple, build) -> bytes:
+        value = self.cache.get(key)
+        if value is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = build()
+        self.cache[key] = value
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _block(page: CompiledPage, block: str, context: dict) -> bytes:
+        return "".join(page.template.blocks[block](page.template.new_context(context))).encode()
+
+    def render_body(self, name: str, user=None, result: Optional[dict] = None) -> bytes:
+        with template_render_duration.time(name):
+            return self._render_body(name, user, result)
+
+    def _render_body(self, name: str, user, result: Optional[dict]) -> bytes:
+        page = self.pages[name]
+        chunks = []
+        for part, block in zip(page.parts, page.slots):
+            chunks.append(part)
+            if block == "result":
+                chunks.append(self._cached(
+                    ("result", name, result_snapshot(result)),
+                    lambda: self._block(page, "result", {"result": result}),
+                ))
+            elif block == "stale":
+                # Возраст курса меняется каждую секунду, поэтому кэшируется только пустой блок свежего результата
+                if result and result["info"].get("stale"):
+                    chunks.append(self._block(page, "stale", {"result": result}))
+                else:
+                    chunks.append(self._cached(("stale", name), lambda: self._block(page, "stale", {"result": None})))
+            else:
+                # Приветствие выводит только имя пользователя
+                chunks.append(self._cached(
+                    ("greeting", name, getattr(user, "username", None)),
+                    lambda: self._block(page, "greeting", {"user": user}),
+                ))
+        chunks.append(page.parts[-1])
+        return b"".join(chunks)
+
+    def response(self, request: Request, body: bytes) -> Response:
+        """
+        HTML-ответ с ETag по содержимому; сжатый gzip, если клиент его принимает.
+        """
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+        if request.method == "GET" and not_modified(request, headers):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        if len(body) >= self.compress_min_size and "gzip" in request.headers.get("accept-encoding", ""):
+            self.compressed += 1
+            body = self._cached(("gzip", etag), lambda: gzip.compress(body, compresslevel=6))
+            headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(body, headers=headers)
+
+    def render(self, request: Request, name: str, user=None, result: Optional[dict] = None) -> Response:
+        return self.response(request, self.render_body(name, user, result))
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "pages": list(self.pages),
+            "size": len(self.cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / requests if requests else 0.0,
+            "not_modified": self.not_modified,
+            "compressed": self.compressed,
+        }
@@ -0,0 +1,265 @@
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Optional
+
+from starlette.routing import Match
+
+SAMPLE = "sample"
+TRACE = "trace"
+
+# Стеки сверх лимита сводятся в одну строку, чтобы долгое профилирование не съело память
+TRUNCATED = ("[truncated]",)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@lru_cache(maxsize=4096)
+def short_path(filename: str) -> str:
+    if filename.startswith(ROOT):
+        return os.path.relpath(filename, ROOT)
+    _, marker, tail = filename.rpartition("site-packages" + os.sep)
+    return tail if marker else os.path.basename(filename)
+
+
+def frame_label(item) -> str:
+    # ";" разделяет кадры в collapsed-формате и не должен встречаться в имени
+    if isinstance(item, str):
+        label = item
+    elif isinstance(item, types.CodeType):
+        label = f"{item.co_qualname} ({short_path(item.co_filename)}:{item.co_firstlineno})"
+    else:
+        label = f"{getattr(item, '__module__', None) or 'builtins'}.{getattr(item, '__qualname__', repr(item))}"
+    return label.replace(";", ":")
+
+
+def route_label(scope) -> str:
+    # Шаблон пути, как в метриках: маршрутизация еще не выполнена, поэтому маршрут ищется здесь
+    for route in scope["app"].router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            return f"{scope['method']} {route.path}"
+    return f"{scope['method']} unmatched"
+
+
+class ProfileSession:
+    """
+    Одно окно профилирования.
+
+    Стек каждого наблюдения обрезается по кадру ProfilerMiddleware выбранного запроса,
+    поэтому в отчет попадают только выбранные запросы, даже если параллельно в том же
+    event loop выполняются другие. Кадры обработчиков, вынесенных в пул потоков
+    (синхронные зависимости), в стек запроса не входят.
+
+    sample - отдельный поток раз в interval снимает стеки всех потоков (sys._current_frames),
+    вес стека - число попаданий. trace - sys.setprofile в потоке event loop на время выбранных
+    запросов, вес стека - микросекунды между событиями вызова/возврата (точно, но медленно).
+    """
+
+    def __init__(self, mode: str = SAMPLE, routes: list = (), route: Optional[str] = None, rate: float = 1.0,
+                 duration: float = 30.0, interval: float = 0.005, max_stacks: int = 20000):
+        if mode not in (SAMPLE, TRACE):
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        self.mode = mode
+        self.routes = list(routes)
+        self.route = route
+        self.rate = rate
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.started = time.monotonic()
+        self.deadline = self.started + duration
+        self.finished: Optional[float] = None
+        self.stacks: Dict[tuple, int] = defaultdict(int)
+        # Кадр middleware выбранного запроса -> метка запроса ("GET /convert")
+        self.active: Dict[types.FrameType, str] = {}
+        self.requests = 0
+        self.samples = 0
+        self._last_stack: Optional[tuple] = None
+        self._last = 0
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        if mode == SAMPLE:
+            self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+            self._sampler.start()
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def selects(self, scope) -> bool:
+        if self.routes and not any(route.matches(scope)[0] == Match.FULL for route in self.routes):
+            return False
+        return self.rate >= 1 or random.random() < self.rate
+
+    def enter(self, marker: types.FrameType, label: str):
+        if self.finished is not None:
+            return
+        if self.mode == TRACE and not self.active:
+            self._last_stack = None
+            sys.setprofile(self._profile)
+        self.active[marker] = label
+        self.requests += 1
+
+    def leave(self, marker: types.FrameType):
+        self.active.pop(marker, None)
+        if self.mode == TRACE and not self.active and sys.getprofile() == self._profile:
+            sys.setprofile(None)
+            self._last_stack = None
+
+    def close(self):
+        if self.finished is not None:
+            return
+        self.finished = time.monotonic()
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if sys.getprofile() == self._profile:
+            sys.setprofile(None)
+        self.active.clear()
+
+    def _stack(self, frame) -> Optional[tuple]:
+        codes = []
+        active = self.active
+        while frame is not None:
+            label = active.get(frame)
+            if label is not None:
+                codes.append(label)
+                codes.reverse()
+                return tuple(codes)
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        return None
+
+    def _add(self, stack: tuple, weight: int):
+        if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+            stack = TRUNCATED
+        self.stacks[stack] += weight
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval) and not self.expired:
+            if not self.active:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = self._stack(frame)
+                if stack is not None:
+                    self._add(stack, 1)
+                    self.samples += 1
+
+    def _profile(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        if self._last_stack is not None:
+            self._add(self._last_stack, now - self._last)
+            self.samples += 1
+        if event == "return":
+            frame = frame.f_back
+        stack = self._stack(frame) if frame is not None else None
+        if stack is not None and event == "c_call":
+            stack += (arg,)
+        self._last_stack = stack
+        # Время самого обработчика события не относится ни к одному стеку
+        self._last = time.perf_counter_ns()
+
+    def collapsed(self) -> str:
+        """
+        Стеки в collapsed-формате ("кадр;кадр;кадр вес" на строку) для flamegraph.pl, speedscope и аналогов.
+        """
+        divider = 1000 if self.mode == TRACE else 1
+        lines = []
+        for stack, weight in sorted(self.stacks.items(), key=lambda item: item[1], reverse=True):
+            weight //= divider
+            if weight:
+                lines.append(";".join(frame_label(item) for item in stack) + f" {weight}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def stats(self) -> dict:
+        now = self.finished or time.monotonic()
+        return {
+            "active": self.finished is None,
+            "mode": self.mode,
+            "route": self.route,
+            "percent": self.rate * 100,
+            "interval_ms": self.interval * 1000 if self.mode == SAMPLE else None,
+            "elapsed": round(now - self.started, 3),
+            "remaining": round(max(self.deadline - now, 0.0), 3) if self.finished is None else 0.0,
+            "requests": self.requests,
+            "in_flight": len(self.active),
+            "samples" if self.mode == SAMPLE else "events": self.samples,
+            "stacks": len(self.stacks),
+            "weight_unit": "samples" if self.mode == SAMPLE else "microseconds",
+        }
+
+
+class Profiler:
+    """
+    Профилирование по запросу администратора. Пока окно не открыто, session = None,
+    и ProfilerMiddleware только сравнивает его с None.
+    """
+
+    def __init__(self, max_duration: float = 300.0, max_stacks: int = 20000):
+        self.max_duration = max_duration
+        self.max_stacks = max_stacks
+        self.session: Optional[ProfileSession] = None
+        # Последнее завершенное окно, чтобы отчет можно было забрать после его закрытия
+        self.last: Optional[ProfileSession] = None
+
+    def start(self, mode: str = SAMPLE, routes: list = (), route: Optional[str] = None, rate: float = 1.0,
+              duration: float = 30.0, interval: float = 0.005) -> ProfileSession:
+        self.poll()
+        if self.session is not None:
+            raise RuntimeError("Profiling is already running")
+        self.session = ProfileSession(
+            mode, routes, route, rate, min(duration, self.max_duration), interval, self.max_stacks,
+        )
+        return self.session
+
+    def stop(self) -> Optional[ProfileSession]:
+        session = self.session
+        if session is not None:
+            session.close()
+            self.session = None
+            self.last = session
+        return session
+
+    def poll(self) -> Optional[ProfileSession]:
+        # Окно закрывается по времени при первом обращении после дедлайна
+        if self.session is not None and self.session.expired:
+            self.stop()
+        return self.session or self.last
+
+
+class ProfilerMiddleware:
+    """
+    ASGI-middleware, которое отмечает выбранные для профилирования запросы.
+    При выключенном профилировании - одна проверка атрибута на запрос.
+    """
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        session = self.profiler.session
+        if session is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if session.expired:
+            self.profiler.stop()
+            await self.app(scope, receive, send)
+            return
+        if not session.selects(scope):
+            await self.app(scope, receive, send)
+            return
+        marker = sys._getframe()
+        session.enter(marker, route_label(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session.leave(marker)
+
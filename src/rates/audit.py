@@ -0,0 +1,229 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.rates.models import ConversionAudit
+
+AuditRecord = Tuple[int, str, str, float, float, float, datetime]
+
+COLUMNS = ("user_id", "base", "quote", "amount", "rate", "result", "created_at")
+
+# Политики переполнения очереди
+BLOCK = "block"
+DROP = "drop"
+
+
+async def write_records(engine: AsyncEngine, records: List[AuditRecord]):
+    """
+    Запись пачки в conversion_audit: для asyncpg через COPY, для остальных драйверов - executemany.
+    """
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+        if hasattr(driver, "copy_records_to_table"):
+            await driver.copy_records_to_table(ConversionAudit.__tablename__, records=records, columns=COLUMNS)
+        else:
+            await conn.execute(insert(ConversionAudit), [dict(zip(COLUMNS, record)) for record in records])
+            await conn.commit()
+
+
+class AuditLog:
+    """
+    Журнал конвертаций с отложенной записью.
+
+    Маршруты только кладут запись в ограниченную очередь, фоновая задача пишет их в БД пачками:
+    как только набралось batch_size записей или через flush_interval секунд после первой записи пачки.
+
+    Переполнение очереди (БД не успевает или недоступна) обрабатывается по политике overflow:
+    block - запрос ждет места в очереди не дольше block_timeout, затем запись отбрасывается;
+    drop - запись отбрасывается сразу, запрос не ждет никогда.
+    Неудачная пачка повторяется retries раз с растущей паузой, после чего отбрасывается;
+    все потери видны в stats. При остановке очередь дописывается до конца.
+    """
+
+    def __init__(
+            self,
+            engine: AsyncEngine,
+            queue_size: int = 10000,
+            batch_size: int = 500,
+            flush_interval: float = 1.0,
+            overflow: str = BLOCK,
+            block_timeout: float = 1.0,
+            retries: int = 3,
+            enabled: bool = True,
+    ):
+        if overflow not in (BLOCK, DROP):
+            raise ValueError(f"Unknown audit overflow policy: {overflow}")
+        self.engine = engine
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.retries = retries
+        self.enabled = enabled
+        self.enqueued = 0
+        self.blocked = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.last_flush_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._closed = False
+        self._warned = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def _put(self, record: AuditRecord, deadline: float) -> bool:
+        if self._closed:
+            # Фоновая задача уже дописывает очередь и завершается - запись некому сохранить
+            self.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+            return True
+        except asyncio.QueueFull:
+            pass
+        timeout = deadline - time.monotonic()
+        if self.overflow == BLOCK and timeout > 0:
+            self.blocked += 1
+            try:
+                await asyncio.wait_for(self.queue.put(record), timeout)
+                self.enqueued += 1
+                return True
+            except asyncio.TimeoutError:
+                pass
+        self.dropped += 1
+        if not self._warned:
+            # Одно предупреждение до следующей успешной записи, чтобы не засыпать лог
+            print(f"Очередь журнала конвертаций переполнена ({self.queue.maxsize}), записи отбрасываются")
+            self._warned = True
+        return False
+
+    async def record(self, user_id: int, result: dict):
+        """
+        Запись одной конвертации в формате build_result.
+        """
+        if not self.enabled:
+            return
+        query = result["query"]
+        await self._put(
+            (user_id, query["from"], query["to"], query["amount"], result["info"]["quote"], result["result"],
+             datetime.now(timezone.utc).replace(tzinfo=None)),
+            time.monotonic() + self.block_timeout,
+        )
+
+    async def record_many(self, user_id: int, results: Iterable[dict]):
+        """
+        Записи пакетной конвертации (строки convert_batch, строки с ошибкой пропускаются).
+        Весь пакет ждет места в очереди не дольше одного block_timeout.
+        """
+        if not self.enabled:
+            return
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        deadline = time.monotonic() + self.block_timeout
+        for item in results:
+            if item["result"] is not None:
+                await self._put(
+                    (user_id, item["from"], item["to"], item["amount"], item["rate"], item["result"], created_at),
+                    deadline,
+                )
+
+    async def flush(self, batch: List[AuditRecord]):
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                await write_records(self.engine, batch)
+            except Exception as error:
+                self.last_error = str(error)
+                if attempt < self.retries:
+                    await asyncio.sleep(self.flush_interval * 2 ** attempt)
+                    continue
+                self.failed += len(batch)
+                print(f"Ошибка записи журнала конвертаций, потеряно записей: {len(batch)}: {error}")
+                return
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.written += len(batch)
+            self.batches += 1
+            self._warned = False
+            return
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self.queue.get()
+            if record is None:
+                return
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        record = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if record is None:
+                    # Сигнал остановки из stop(): пишем накопленное и выходим
+                    stopping = True
+                    break
+                batch.append(record)
+            await self.flush(batch)
+            if stopping:
+                return
+
+    def start(self):
+        self._closed = False
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Остановка с дописыванием очереди: новые записи отбрасываются, фоновая задача
+        записывает все, что уже в очереди, но не дольше timeout секунд.
+        """
+        if self._task is None:
+            return
+        self._closed = True
+
+        async def drain():
+            await self.queue.put(None)
+            await self._task
+
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            lost = self.queue.qsize()
+            self.failed += lost
+            print(f"Журнал конвертаций не дописан за {timeout} сек, потеряно записей: {lost}")
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "overflow": self.overflow,
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "enqueued": self.enqueued,
+            "blocked": self.blocked,
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "last_flush_ms": self.last_flush_ms,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,276 @@
+import codecs
+import csv
+import io
+import json
+import time
+from typing import AsyncIterator, List, Optional
+
+import numpy as np
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import StreamingResponse
+
+from src.rates.audit import AuditLog
+from src.rates.cache import RateCache
+from src.rates.service import normalize_code, rates_for_rows
+from src.rates.table import RateTable
+
+ERROR_COLUMN = "conversion_error"
+
+
+class BulkStreamingResponse(StreamingResponse):
+    """
+    Потоковый ответ, который формируется по ходу чтения тела запроса.
+
+    Стандартный StreamingResponse параллельно слушает receive() в ожидании отключения клиента
+    и забрал бы себе куски загружаемого файла, поэтому здесь отключение обрабатывает сам
+    генератор: чтение тела прерывается ClientDisconnect.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def read_lines(request: Request) -> AsyncIterator[str]:
+    # Тело запроса декодируется по кускам, в памяти держится только незавершенная строка
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+    async for block in request.stream():
+        # Только по \n (\r\n остается в конце строки): splitlines резал бы и по \x0b, \x1c, \u2028 внутри значений
+        lines = (tail + decoder.decode(block, final=not block)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if tail:
+        yield tail
+
+
+async def csv_records(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    # Запись CSV может занимать несколько строк, если перенос строки стоит внутри кавычек
+    record, quotes = "", 0
+    async for line in lines:
+        record += line
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            yield record
+            record, quotes = "", 0
+    if record:
+        yield record
+
+
+class BulkStats:
+    """
+    Пропускная способность потоковой конвертации в этом воркере: строки и время всех выгрузок
+    и скорость последней (для /stats/bulk-convert и /metrics).
+    """
+
+    def __init__(self):
+        self.conversions = 0
+        self.disconnected = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.last_rows = 0
+        self.last_rows_per_second = 0.0
+
+    def record(self, rows: int, elapsed: float, finished: bool):
+        self.conversions += 1
+        if not finished:
+            self.disconnected += 1
+        self.rows += rows
+        self.seconds += elapsed
+        self.last_rows = rows
+        self.last_rows_per_second = rows / elapsed if elapsed else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "conversions": self.conversions,
+            "disconnected": self.disconnected,
+            "rows": self.rows,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows / self.seconds, 1) if self.seconds else 0.0,
+            "last_rows": self.last_rows,
+            "last_rows_per_second": round(self.last_rows_per_second, 1),
+        }
+
+
+bulk_stats = BulkStats()
+
+
+class BulkConverter:
+    """
+    Конвертация выгрузки (CSV или NDJSON) кусками по chunk_rows строк.
+
+    К каждой строке добавляются колонки "<amount_column>_<TO>" для всех валют из targets
+    и колонка conversion_error. Все строки считаются по одному снимку таблицы курсов.
+    Сконвертированные строки каждого куска записываются в журнал конвертаций одной пачкой.
+    """
+
+    media_types = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+    def __init__(
+            self,
+            request: Request,
+            cache: RateCache,
+            table: Optional[RateTable],
+            targets: List[str],
+            fmt: str = "csv",
+            from_column: str = "currency",
+            amount_column: str = "amount",
+            chunk_rows: int = 10000,
+            audit_log: Optional[AuditLog] = None,
+            user_id: Optional[int] = None,
+            throughput: Optional[BulkStats] = None,
+    ):
+        if fmt not in self.media_types:
+            raise ValueError(f"Unsupported format: {fmt}")
+        if not targets:
+            raise ValueError("At least one target currency is required")
+        self.request = request
+        self.cache = cache
+        self.table = table
+        self.targets = targets
+        self.fmt = fmt
+        self.from_column = from_column
+        self.amount_column = amount_column
+        self.chunk_rows = chunk_rows
+        self.audit_log = audit_log
+        self.user_id = user_id
+        self.throughput = throughput if throughput is not None else bulk_stats
+        self.output_columns = [f"{amount_column}_{code}" for code in targets]
+        self.rows = 0
+        self._records: Optional[AsyncIterator[str]] = None
+        self._header: Optional[list] = None
+
+    @property
+    def media_type(self) -> str:
+        return self.media_types[self.fmt]
+
+    async def start(self):
+        """
+        Для CSV читает заголовок до начала ответа, чтобы ошибку в колонках вернуть как 400.
+        """
+        lines = read_lines(self.request)
+        if self.fmt == "ndjson":
+            self._records = lines
+            return
+        self._records = csv_records(lines)
+        try:
+            first = await self._records.__anext__()
+        except StopAsyncIteration:
+            raise ValueError("Empty file")
+        self._header = next(csv.reader([first]))
+        for column in (self.from_column, self.amount_column):
+            if column not in self._header:
+                raise ValueError(f"Column not found: {column}")
+
+    async def _convert(self, froms: list, amounts: list) -> tuple:
+        # Одна векторная операция на кусок и на каждую целевую валюту
+        values = np.empty(len(amounts), dtype=np.float64)
+        errors = [None] * len(amounts)
+        for i, amount in enumerate(amounts):
+            try:
+                values[i] = float(amount)
+            except (TypeError, ValueError):
+                values[i] = np.nan
+            # NaN и бесконечность тоже ошибка строки: они не попадают ни в ответ, ни в журнал
+            if not np.isfinite(values[i]):
+                values[i] = np.nan
+                errors[i] = f"Invalid amount: {amount}"
+
+        columns, column_rates = [], []
+        for target in self.targets:
+            rates, pair_index, pair_errors = await rates_for_rows(
+                self.cache, froms, [target] * len(froms), self.table
+            )
+            columns.append((values * rates).tolist())
+            column_rates.append(rates.tolist())
+            if any(pair_errors):
+                for i, pair in enumerate(pair_index.tolist()):
+                    if pair_errors[pair] and errors[i] is None:
+                        errors[i] = pair_errors[pair]
+        if self.audit_log is not None:
+            # Одна пачка на кусок; при переполнении очереди действует та же политика block/drop, что и для пакета
+            amounts_list = values.tolist()
+            await self.audit_log.record_many(self.user_id, (
+                {"from": froms[i], "to": target, "amount": amounts_list[i], "rate": rates[i], "result": column[i]}
+                for target, rates, column in zip(self.targets, column_rates, columns)
+                for i in range(len(froms)) if errors[i] is None
+            ))
+        results = [
+            ["" if value != value else value for value in row]  # nan -> пустое значение
+            for row in zip(*columns)
+        ]
+        return results, errors
+
+    async def _chunks(self) -> AsyncIterator[list]:
+        chunk = []
+        async for record in self._records:
+            if not record.strip():
+                continue
+            chunk.append(record)
+            if len(chunk) >= self.chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            # Тело запроса прочитано целиком - теперь можно проверить отключение клиента
+            if await self.request.is_disconnected():
+                raise ClientDisconnect()
+            yield chunk
+
+    async def _csv_chunk(self, records: list) -> str:
+        rows = list(csv.reader(records))
+        from_index = self._header.index(self.from_column)
+        amount_index = self._header.index(self.amount_column)
+        froms = [normalize_code(row[from_index]) if len(row) > from_index else "" for row in rows]
+        amounts = [row[amount_index] if len(row) > amount_index else None for row in rows]
+        results, errors = await self._convert(froms, amounts)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(row + converted + [error or ""] for row, converted, error in zip(rows, results, errors))
+        return buffer.getvalue()
+
+    async def _ndjson_chunk(self, records: list) -> str:
+        rows, parse_errors = [], []
+        for record in records:
+            try:
+                row = json.loads(record)
+                error = None if isinstance(row, dict) else "Invalid JSON line: expected an object"
+            except ValueError as exc:
+                row, error = None, f"Invalid JSON line: {exc}"
+            # Неразобранная строка возвращается клиенту как есть, чтобы ее можно было найти и исправить
+            rows.append(row if error is None else {"raw": record.rstrip("\r\n")})
+            parse_errors.append(error)
+        froms = [normalize_code(str(row.get(self.from_column, ""))) for row in rows]
+        amounts = [row.get(self.amount_column) for row in rows]
+        results, errors = await self._convert(froms, amounts)
+        errors = [parse_error or error for parse_error, error in zip(parse_errors, errors)]
+
+        lines = []
+        for row, converted, error in zip(rows, results, errors):
+            for column, value in zip(self.output_columns, converted):
+                row[column] = None if value == "" else value
+            row[ERROR_COLUMN] = error
+            lines.append(json.dumps(row, ensure_ascii=False))
+        return "\n".join(lines) + "\n"
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        started = time.perf_counter()
+        finished = False
+        try:
+            if self.fmt == "csv":
+                buffer = io.StringIO()
+                csv.writer(buffer).writerow(self._header + self.output_columns + [ERROR_COLUMN])
+                yield buffer.getvalue().encode()
+            async for records in self._chunks():
+                convert_chunk = self._csv_chunk if self.fmt == "csv" else self._ndjson_chunk
+                yield (await convert_chunk(records)).encode()
+                self.rows += len(records)
+            finished = True
+        except ClientDisconnect:
+            pass
+        finally:
+            elapsed = time.perf_counter() - started
+            self.throughput.record(self.rows, elapsed, finished)
+            status = "завершена" if finished else "прервана, клиент отключился"
+            print(f"Потоковая конвертация {status}: {self.rows} строк за {elapsed:.2f} с "
+                  f"({self.throughput.last_rows_per_second:.0f} строк/с)")
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Tuple
+
+from src.rates.breaker import CircuitOpenError
+
+Pair = Tuple[str, str]
+
+
+@dataclass
+class CachedRate:
+    rate: float
+    fetched_at: float
+
+
+@dataclass
+class RateLookup:
+    rate: float
+    age: float
+    stale: bool = False
+
+
+class RateCache:
+    """
+    Кэш курсов по валютной паре с TTL и вытеснением по LRU.
+
+    Одновременные промахи по одной паре схлопываются в один запрос к провайдеру
+    (single-flight): первый запрос запускает загрузку, остальные ждут ее результат.
+
+    Курс старше ttl, но моложе ttl + stale_ttl отдается сразу с пометкой stale
+    (stale-while-revalidate), а свежий курс загружается в фоне. Так при сбое провайдера
+    или разомкнутом предохранителе ответы не ждут провайдера и не нагружают его повторами.
+    """
+
+    def __init__(
+            self,
+            loader: Callable[[str, str], Awaitable[float]],
+            ttl: float = 60.0,
+            max_size: int = 1024,
+            stale_ttl: float = 3600.0,
+            clock: Callable[[], float] = time.monotonic,
+    ):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._entries: "OrderedDict[Pair, CachedRate]" = OrderedDict()
+        self._in_flight: Dict[Pair, asyncio.Future] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.revalidation_errors = 0
+
+    async def get_rate(self, from_: str, to: str) -> float:
+        return (await self.lookup(from_, to)).rate
+
+    async def lookup(self, from_: str, to: str) -> RateLookup:
+        key = (from_, to)
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self.clock() - entry.fetched_at
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return RateLookup(entry.rate, age)
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.stale_hits += 1
+                if key not in self._in_flight:
+                    self._start_load(key).add_done_callback(self._revalidated)
+                return RateLookup(entry.rate, age, stale=True)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return RateLookup(await asyncio.shield(in_flight), 0.0)
+
+        self.misses += 1
+        return RateLookup(await asyncio.shield(self._start_load(key)), 0.0)
+
+    def _start_load(self, key: Pair) -> asyncio.Future:
+        # Загрузка идет отдельной задачей: отмена запроса-инициатора не должна ломать остальных ожидающих
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key))
+            self._in_flight[key] = task
+        return task
+
+    def _revalidated(self, task: asyncio.Future):
+        if task.cancelled() or task.exception() is None:
+            return
+        self.revalidation_errors += 1
+        if not isinstance(task.exception(), CircuitOpenError):
+            print(f"Ошибка фонового обновления курса: {task.exception()}")
+
+    async def _load(self, key: Pair) -> float:
+        try:
+            rate = await self.loader(*key)
+            self._store(key, rate)
+            return rate
+        finally:
+            del self._in_flight[key]
+
+    def _store(self, key: Pair, rate: float):
+        self._entries[key] = CachedRate(rate=rate, fetched_at=self.clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "revalidation_errors": self.revalidation_errors,
+        }
@@ -0,0 +1,113 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+import aiohttp
+
+from src.rates.providers import Quotes, RateProvider, RateRequestError
+
+
+class UpstreamClient(RateProvider):
+    """
+    Общий асинхронный клиент для запросов к провайдеру курсов валют (apilayer).
+
+    Создается один раз в lifespan приложения и переиспользует пул keep-alive соединений,
+    поэтому запросы к провайдеру не блокируют event loop и не открывают новое
+    TCP/TLS соединение на каждую конвертацию.
+    """
+
+    name = "apilayer"
+
+    def __init__(
+            self,
+            base_url: str,
+            api_key: str,
+            timeout: float = 5.0,
+            max_connections: int = 100,
+            keepalive_timeout: float = 30.0,
+            max_concurrency: int = 50,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._headers = {"apikey": api_key}
+        self._max_connections = max_connections
+        self._keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Ограничиваем количество одновременных запросов к провайдеру
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @classmethod
+    def from_settings(cls, settings) -> "UpstreamClient":
+        return cls(
+            base_url=settings.CURRENCY_API_URL,
+            api_key=settings.CURRENCY_API_KEY,
+            timeout=settings.UPSTREAM_TIMEOUT,
+            max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+            keepalive_timeout=settings.UPSTREAM_KEEPALIVE_TIMEOUT,
+            max_concurrency=settings.UPSTREAM_MAX_CONCURRENCY,
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, т.к. aiohttp требует запущенный event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_connections,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get_json(self, path: str, params: dict, timeout: Optional[float] = None) -> dict:
+        """
+        :param path:
+            Path relative to the provider base url.
+
+        :param params:
+            Query parameters.
+
+        :param timeout:
+            Per-call timeout in seconds, overrides the client default.
+
+        :return:
+            decoded json response
+        """
+        call_timeout = aiohttp.ClientTimeout(total=self.timeout if timeout is None else timeout)
+        async with self._semaphore:
+            async with self.session.get(f"{self.base_url}{path}", params=params, timeout=call_timeout) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def convert(self, from_: str, to: str, amount: str) -> dict:
+        return await self.get_json("/convert", {"to": to, "from": from_, "amount": amount})
+
+    async def fetch_rate(self, from_: str, to: str) -> float:
+        """
+        Курс одной пары: конвертируем единицу валюты и берем котировку из ответа.
+        """
+        result = await self.convert(from_, to, "1")
+        if not result.get("success", True):
+            raise RateRequestError(result.get("error", {}).get("info", "Currency provider error"))
+        return float(result["info"]["quote"])
+
+    async def fetch_table(self, source: str) -> Quotes:
+        data = await self.get_json("/live", {"source": source})
+        if not data.get("success", True):
+            raise RateRequestError(data.get("error", {}).get("info", "Currency provider error"))
+        as_of = datetime.fromtimestamp(data.get("timestamp", time.time()), tz=timezone.utc)
+        return Quotes(source=data.get("source", source), quotes=data["quotes"], as_of=as_of, provider=self.name)
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+# Доступные провайдеры курсов: имя из настройки RATE_PROVIDERS -> фабрика от настроек
+PROVIDERS: Dict[str, Callable[..., RateProvider]] = {
+    UpstreamClient.name: UpstreamClient.from_settings,
+}
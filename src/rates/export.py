@@ -0,0 +1,158 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from sqlalchemy import func, literal, select, text, tuple_
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database import get_async_session
+from src.rates.models import Rate
+from src.rates.service import normalize_code
+
+# Допустимые интервалы агрегации: аргумент date_trunc и шаг между корзинами
+INTERVALS = {
+    "minute": "1 minute",
+    "hour": "1 hour",
+    "day": "1 day",
+    "week": "1 week",
+    "month": "1 month",
+}
+
+RAW_COLUMNS = ("base", "quote", "timestamp", "rate")
+OHLC_COLUMNS = ("base", "quote", "timestamp", "open", "high", "low", "close", "count")
+
+
+def parse_pairs(value: str) -> List[Tuple[str, str]]:
+    """
+    :param value:
+        Comma-separated pairs: USDEUR,USD/GBP.
+    """
+    pairs = []
+    for item in value.split(","):
+        code = normalize_code(item).replace("/", "")
+        if len(code) != 6:
+            raise ValueError(f"Invalid currency pair: {item}")
+        pairs.append((code[:3], code[3:]))
+    if not pairs:
+        raise ValueError("At least one currency pair is required")
+    return pairs
+
+
+class RateExporter:
+    """
+    Потоковая выгрузка истории курсов по набору пар за период.
+
+    Данные читаются страницами с keyset-пагинацией по (base, quote, timestamp) вместо OFFSET,
+    а каждая страница - пачками через серверный курсор, так что в памяти Python
+    одновременно находится не больше одной пачки. При заданном interval свечи OHLC
+    считаются на стороне Postgres.
+    """
+
+    media_types = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+    def __init__(
+            self,
+            pairs: List[Tuple[str, str]],
+            start: datetime,
+            end: datetime,
+            fmt: str = "ndjson",
+            interval: Optional[str] = None,
+            page_size: int = 50000,
+            batch_size: int = 5000,
+    ):
+        if fmt not in self.media_types:
+            raise ValueError(f"Unsupported format: {fmt}")
+        if interval is not None and interval not in INTERVALS:
+            raise ValueError(f"Unsupported interval: {interval}")
+        if start > end:
+            raise ValueError("start must not be later than end")
+        self.pairs = pairs
+        self.start = start
+        self.end = end
+        self.fmt = fmt
+        self.interval = interval
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.columns = OHLC_COLUMNS if interval else RAW_COLUMNS
+
+    @property
+    def media_type(self) -> str:
+        return self.media_types[self.fmt]
+
+    def _query(self, after: Optional[tuple]):
+        key = tuple_(Rate.base, Rate.quote, Rate.timestamp)
+        conditions = [
+            tuple_(Rate.base, Rate.quote).in_(self.pairs),
+            Rate.timestamp >= self.start,
+            Rate.timestamp <= self.end,
+        ]
+        if not self.interval:
+            if after is not None:
+                conditions.append(key > tuple_(*after))
+            return (
+                select(Rate.base, Rate.quote, Rate.timestamp, Rate.rate)
+                .where(*conditions)
+                .order_by(Rate.base, Rate.quote, Rate.timestamp)
+                .limit(self.page_size)
+            )
+
+        bucket = func.date_trunc(self.interval, Rate.timestamp).label("bucket")
+        if after is not None:
+            # Следующая страница начинается с первой корзины после последней выгруженной
+            base, quote, last_bucket = after
+            next_bucket = literal(last_bucket) + text(f"interval '{INTERVALS[self.interval]}'")
+            conditions.append(key >= tuple_(literal(base), literal(quote), next_bucket))
+        return (
+            select(
+                Rate.base,
+                Rate.quote,
+                bucket,
+                func.array_agg(aggregate_order_by(Rate.rate, Rate.timestamp.asc()))[1].label("open"),
+                func.max(Rate.rate).label("high"),
+                func.min(Rate.rate).label("low"),
+                func.array_agg(aggregate_order_by(Rate.rate, Rate.timestamp.desc()))[1].label("close"),
+                func.count().label("count"),
+            )
+            .where(*conditions)
+            .group_by(Rate.base, Rate.quote, bucket)
+            .order_by(Rate.base, Rate.quote, bucket)
+            .limit(self.page_size)
+        )
+
+    async def rows(self, session: AsyncSession) -> AsyncIterator[list]:
+        after = None
+        while True:
+            result = await session.stream(self._query(after).execution_options(yield_per=self.batch_size))
+            fetched = 0
+            async for partition in result.partitions():
+                fetched += len(partition)
+                after = tuple(partition[-1][:3])
+                yield partition
+            if fetched < self.page_size:
+                return
+
+    def _format(self, partition: list) -> str:
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(
+                [value.isoformat() if isinstance(value, datetime) else value for value in row]
+                for row in partition
+            )
+            return buffer.getvalue()
+        return "".join(
+            json.dumps(dict(zip(self.columns, row)), default=datetime.isoformat) + "\n"
+            for row in partition
+        )
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(self.columns)
+            yield buffer.getvalue().encode()
+        # Сессия живет столько же, сколько поток ответа, а не только обработчик маршрута
+        async for session in get_async_session():
+            async for partition in self.rows(session):
+                yield self._format(partition).encode()
@@ -0,0 +1,345 @@
+import math
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from src.rates.providers import Quotes
+from src.rates.table import RateTable
+
+Edge = Tuple[int, int]
+
+
+class RateGraph:
+    """
+    Граф курсов: вершины - валюты, ребра - котировки пар от одного или нескольких источников.
+
+    Кросс-курс пары считается по пути с лучшей свежестью - пути, у которого самая старая котировка
+    новее, чем у любого другого. Такие пути для всех пар сразу дает максимальное остовное дерево
+    по времени котировки, поэтому граф хранит дерево и курс каждой валюты относительно корня
+    ее компоненты (value): курс i->j = value[j] / value[i].
+
+    Новая котировка меняет дерево не больше чем на одно ребро. Пересчитываются только строки
+    и столбцы матриц для валют с меньшей стороны этого ребра: у остальных пар путь через него не идет.
+    """
+
+    def __init__(self, base: str = "USD", max_deviation: float = 0.01, capacity: int = 256):
+        self.base = base
+        self.max_deviation = max_deviation
+        self.codes: List[str] = []
+        self.index: Dict[str, int] = {}
+        # Пара (i < j) -> {источник: (курс i->j, время котировки)}
+        self.quotes: Dict[Edge, Dict[str, Tuple[float, float]]] = {}
+        # Пара (i < j) -> самая свежая котировка среди источников: (курс i->j, время, источник)
+        self.edges: Dict[Edge, Tuple[float, float, str]] = {}
+        self.adjacency: List[Set[int]] = []
+        self.tree: List[Set[int]] = []
+        self.value = np.ones(capacity)
+        self.component = np.arange(capacity)
+        # matrix[i, j] - кросс-курс, freshness[i, j] - время самой старой котировки на пути (epoch sec);
+        # для валют из разных компонент nan и -inf
+        self.matrix = np.full((capacity, capacity), np.nan)
+        self.freshness = np.full((capacity, capacity), -np.inf)
+        self.inconsistencies: List[dict] = []
+        self.updates = 0
+        self.tree_changes = 0
+        self.rows_updated = 0
+        # Номера компонент, появившихся при разрыве дерева, отрицательные и не совпадают с индексами валют
+        self._components = 0
+        self._table: Optional[RateTable] = None
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def _node(self, code: str) -> int:
+        i = self.index.get(code)
+        if i is not None:
+            return i
+        i = len(self.codes)
+        if i == len(self.value):
+            self._grow(2 * i)
+        self.codes.append(code)
+        self.index[code] = i
+        self.adjacency.append(set())
+        self.tree.append(set())
+        self.value[i] = 1.0
+        self.component[i] = i
+        self.matrix[i, i] = 1.0
+        self.freshness[i, i] = np.inf
+        return i
+
+    def _grow(self, capacity: int):
+        size = len(self.value)
+        self.value = np.concatenate([self.value, np.ones(capacity - size)])
+        self.component = np.concatenate([self.component, np.arange(size, capacity)])
+        matrix = np.full((capacity, capacity), np.nan)
+        matrix[:size, :size] = self.matrix
+        freshness = np.full((capacity, capacity), -np.inf)
+        freshness[:size, :size] = self.freshness
+        self.matrix, self.freshness = matrix, freshness
+
+    def _rate(self, i: int, j: int) -> float:
+        if i < j:
+            return self.edges[i, j][0]
+        return 1.0 / self.edges[j, i][0]
+
+    def _time(self, i: int, j: int) -> float:
+        return self.edges[min(i, j), max(i, j)][1]
+
+    def update(self, from_: str, to: str, rate: float, as_of: datetime, source: str = "manual"):
+        """
+        Котировка одной пары: сколько единиц to дают за единицу from_ на момент as_of.
+        """
+        i, j = self._node(from_), self._node(to)
+        if i == j:
+            return
+        key, rate = ((i, j), rate) if i < j else ((j, i), 1.0 / rate)
+        sources = self.quotes.setdefault(key, {})
+        sources[source] = (float(rate), as_of.timestamp())
+        best = max(sources, key=lambda name: sources[name][1])
+        self.edges[key] = (*sources[best], best)
+        self.adjacency[i].add(j)
+        self.adjacency[j].add(i)
+        self.updates += 1
+        self._table = None
+
+        if j in self.tree[i]:
+            # Ребро дерева: его курс или время изменились, при устаревании его может заменить другое ребро
+            self._reconnect(i, j)
+        elif self.component[i] != self.component[j]:
+            side = self._smaller_side(i, j)
+            self._link(*((j, i) if i in side else (i, j)), side)
+        else:
+            weakest = self._weakest_on_path(i, j)
+            if self._time(*weakest) < self.edges[key][1]:
+                self._reconnect(*weakest)
+
+    def update_quotes(self, quotes: Quotes):
+        for pair, rate in quotes.quotes.items():
+            self.update(quotes.source, pair[len(quotes.source):], rate, quotes.as_of, quotes.provider)
+
+    def _side(self, start: int, without: Edge) -> List[int]:
+        # Вершины дерева, достижимые из start без ребра without
+        cut = set(without)
+        seen = {start}
+        stack = [start]
+        while stack:
+            u = stack.pop()
+            for v in self.tree[u]:
+                if v not in seen and {u, v} != cut:
+                    seen.add(v)
+                    stack.append(v)
+        return list(seen)
+
+    def _smaller_side(self, i: int, j: int) -> List[int]:
+        # Для разных компонент - меньшая из них, для ребра дерева - меньшая сторона после его удаления
+        if self.component[i] != self.component[j]:
+            sizes = [np.count_nonzero(self.component[:len(self.codes)] == self.component[k]) for k in (i, j)]
+            start = i if sizes[0] <= sizes[1] else j
+            return self._side(start, (-1, -1))
+        side = self._side(j, (i, j))
+        size = np.count_nonzero(self.component[:len(self.codes)] == self.component[i])
+        return side if 2 * len(side) <= size else self._side(i, (i, j))
+
+    def _weakest_on_path(self, i: int, j: int) -> Edge:
+        parent = {i: None}
+        stack = [i]
+        while j not in parent:
+            u = stack.pop()
+            for v in self.tree[u]:
+                if v not in parent:
+                    parent[v] = u
+                    stack.append(v)
+        weakest, v = None, j
+        while parent[v] is not None:
+            u = parent[v]
+            if weakest is None or self._time(u, v) < self._time(*weakest):
+                weakest = (u, v)
+            v = u
+        return weakest
+
+    def _reconnect(self, i: int, j: int):
+        """
+        Убирает ребро дерева (i, j) и соединяет стороны самым свежим ребром между ними
+        (им может оказаться то же ребро с новой котировкой).
+        """
+        side = self._smaller_side(i, j)
+        self.tree[i].discard(j)
+        self.tree[j].discard(i)
+        inside = set(side)
+        best, best_key = None, None
+        for u in side:
+            for v in self.adjacency[u]:
+                if v in inside:
+                    continue
+                # При равном времени остается прежнее ребро, чтобы дерево не менялось без причины
+                key = (self._time(u, v), {u, v} == {i, j})
+                if best_key is None or key > best_key:
+                    best, best_key = (v, u), key
+        if best is None:
+            # Сторона отделилась от остального графа и стала отдельной компонентой с новым номером
+            self._components -= 1
+            for u in side:
+                self.component[u] = self._components
+            self._place(side[0], None, side)
+        else:
+            if set(best) != {i, j}:
+                self.tree_changes += 1
+            self._link(*best, side)
+
+    def _link(self, outer: int, inner: int, side: List[int]):
+        # Присоединяет вершины side (в них входит inner) к компоненте outer через ребро (outer, inner)
+        self.tree[outer].add(inner)
+        self.tree[inner].add(outer)
+        for u in side:
+            self.component[u] = self.component[outer]
+        self._place(inner, outer, side)
+
+    def _place(self, start: int, parent: Optional[int], side: List[int], full: bool = False):
+        """
+        Курсы вершин side относительно корня компоненты - обходом дерева от точки присоединения start.
+
+        Внутри side дерево не менялось, поэтому свежесть пар внутри side прежняя, а для пары с валютой
+        снаружи это минимум из свежести пути до start, ребра (parent, start) и уже известной строки parent.
+        full - пересчитать строки side целиком (после rebuild, когда прежних значений нет).
+        """
+        self.value[start] = 1.0 if parent is None else self.value[parent] * self._rate(parent, start)
+        oldest = {start: np.inf}
+        if parent is not None:
+            oldest[parent] = np.inf
+        stack = [start]
+        while stack:
+            u = stack.pop()
+            for v in self.tree[u]:
+                if v not in oldest:
+                    oldest[v] = min(oldest[u], self._time(u, v))
+                    self.value[v] = self.value[u] * self._rate(u, v)
+                    stack.append(v)
+
+        n = len(self.codes)
+        rows = np.array(side)
+        same = self.component[:n][None, :] == self.component[rows][:, None]
+        cross = np.where(same, self.value[:n][None, :] / self.value[rows][:, None], np.nan)
+        self.matrix[rows, :n] = cross
+        self.matrix[:n, rows] = 1.0 / cross.T
+        if full:
+            fresh = np.array([self._freshness_row(u) for u in side])
+        else:
+            fresh = self.freshness[rows, :n]
+            outside = np.ones(n, dtype=bool)
+            outside[rows] = False
+            if parent is None:
+                fresh[:, outside] = -np.inf
+            else:
+                to_start = np.minimum(np.array([oldest[u] for u in side]), self._time(parent, start))
+                fresh[:, outside] = np.minimum(to_start[:, None], self.freshness[parent, :n][outside][None, :])
+        self.freshness[rows, :n] = fresh
+        self.freshness[:n, rows] = fresh.T
+        self.rows_updated += len(side)
+
+    def _freshness_row(self, start: int) -> np.ndarray:
+        row = np.full(len(self.codes), -np.inf)
+        oldest = {start: np.inf}
+        stack = [start]
+        while stack:
+            u = stack.pop()
+            for v in self.tree[u]:
+                if v not in oldest:
+                    oldest[v] = min(oldest[u], self._time(u, v))
+                    stack.append(v)
+        row[list(oldest)] = list(oldest.values())
+        return row
+
+    def rebuild(self):
+        """
+        Полный пересчет дерева и матриц (Kruskal по убыванию времени котировок).
+        """
+        n = len(self.codes)
+        self.tree = [set() for _ in range(n)]
+        self.component[:n] = np.arange(n)
+        self.matrix[:n, :n] = np.nan
+        self.freshness[:n, :n] = -np.inf
+        parent = list(range(n))
+
+        def find(u):
+            while parent[u] != u:
+                parent[u] = parent[parent[u]]
+                u = parent[u]
+            return u
+
+        for (i, j), _ in sorted(self.edges.items(), key=lambda item: item[1][1], reverse=True):
+            a, b = find(i), find(j)
+            if a != b:
+                parent[a] = b
+                self.tree[i].add(j)
+                self.tree[j].add(i)
+        components: Dict[int, List[int]] = {}
+        for u in range(n):
+            components.setdefault(find(u), []).append(u)
+        for members in components.values():
+            for u in members:
+                self.component[u] = members[0]
+            self._place(members[0], None, members, full=True)
+        self._table = None
+
+    def rate(self, from_: str, to: str) -> float:
+        return float(self.matrix[self.index[from_], self.index[to]])
+
+    def as_of(self, from_: str, to: str) -> Optional[datetime]:
+        oldest = self.freshness[self.index[from_], self.index[to]]
+        return datetime.fromtimestamp(oldest, tz=timezone.utc) if math.isfinite(oldest) else None
+
+    def table(self) -> Optional[RateTable]:
+        """
+        Снимок компоненты базовой валюты для маршрутов конвертации. Валюты, не связанные
+        с базовой ни одной цепочкой котировок, в него не входят.
+        """
+        if self._table is None and self.base in self.index:
+            n = len(self.codes)
+            members = np.flatnonzero(self.component[:n] == self.component[self.index[self.base]])
+            order = sorted(members, key=lambda u: self.codes[u])
+            grid = np.ix_(order, order)
+            freshness = self.freshness[grid]
+            finite = freshness[np.isfinite(freshness)]
+            as_of = datetime.fromtimestamp(finite.min(), tz=timezone.utc) if finite.size else \
+                datetime.now(timezone.utc)
+            self._table = RateTable(
+                self.base, tuple(self.codes[u] for u in order), self.matrix[grid], as_of, freshness=freshness,
+            )
+        return self._table
+
+    def check_consistency(self, threshold: Optional[float] = None) -> List[dict]:
+        """
+        Треугольники из прямых котировок, у которых произведение курсов по кругу
+        отличается от 1 больше чем на threshold (по умолчанию max_deviation).
+        """
+        threshold = self.max_deviation if threshold is None else threshold
+        found = []
+        for i, j in self.edges:
+            for k in self.adjacency[i] & self.adjacency[j]:
+                if k > j:
+                    deviation = abs(self._rate(i, j) * self._rate(j, k) * self._rate(k, i) - 1.0)
+                    if deviation > threshold:
+                        found.append({
+                            "currencies": [self.codes[i], self.codes[j], self.codes[k]],
+                            "deviation": deviation,
+                            "sources": [self.edges[i, j][2], self.edges[min(j, k), max(j, k)][2],
+                                        self.edges[i, k][2]],
+                        })
+        found.sort(key=lambda item: item["deviation"], reverse=True)
+        self.inconsistencies = found
+        return found
+
+    def stats(self) -> dict:
+        return {
+            "base": self.base,
+            "currencies": len(self.codes),
+            "quotes": len(self.edges),
+            "sources": sorted({source for sources in self.quotes.values() for source in sources}),
+            "reachable": len(self._table.codes) if self._table is not None else None,
+            "updates": self.updates,
+            "tree_changes": self.tree_changes,
+            "rows_updated": self.rows_updated,
+            "inconsistent_triangles": len(self.inconsistencies),
+            "worst_triangles": self.inconsistencies[:10],
+        }
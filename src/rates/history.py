@@ -0,0 +1,117 @@
+from datetime import datetime, time, timezone
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from src.rates.models import Rate
+from src.rates.service import build_result, normalize_code, parse_amount
+from src.rates.table import RateTable
+
+RateRow = Tuple[str, str, datetime, float]
+
+COLUMNS = ("base", "quote", "timestamp", "rate")
+
+
+def to_utc_naive(moment: datetime) -> datetime:
+    # В таблице хранится TIMESTAMP без часового пояса в UTC, как registered_at у пользователей
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def parse_moment(value: str) -> datetime:
+    """
+    Дата без времени (2024-01-31) означает конец этого дня, т.е. последний курс за день.
+    """
+    value = value.strip()
+    if len(value) == 10:
+        return datetime.combine(datetime.fromisoformat(value).date(), time.max)
+    return to_utc_naive(datetime.fromisoformat(value))
+
+
+def table_rows(table: RateTable) -> list:
+    # Живая таблица хранится как котировки к валюте-источнику, кросс-курсы считаются при чтении
+    source = table.source
+    row = table.matrix[table.index[source]].tolist()
+    moment = to_utc_naive(table.as_of)
+    return [(source, code, moment, row[i]) for i, code in enumerate(table.codes) if code != source]
+
+
+async def ingest_rates(engine: AsyncEngine, rows: Iterable[RateRow]) -> int:
+    """
+    Массовая загрузка курсов. Для asyncpg используется COPY во временную таблицу и
+    INSERT ... ON CONFLICT DO NOTHING, для остальных драйверов - executemany.
+
+    :return:
+        number of rows passed for ingest
+    """
+    records = [(normalize_code(base), normalize_code(quote), to_utc_naive(moment), float(rate))
+               for base, quote, moment, rate in rows]
+    if not records:
+        return 0
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection
+        if hasattr(driver, "copy_records_to_table"):
+            async with driver.transaction():
+                await driver.execute(
+                    "CREATE TEMP TABLE rate_ingest (LIKE rate INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                await driver.copy_records_to_table("rate_ingest", records=records, columns=COLUMNS)
+                await driver.execute(
+                    "INSERT INTO rate (base, quote, timestamp, rate) "
+                    "SELECT base, quote, timestamp, rate FROM rate_ingest ON CONFLICT DO NOTHING"
+                )
+        else:
+            await conn.execute(
+                insert(Rate).on_conflict_do_nothing(),
+                [dict(zip(COLUMNS, record)) for record in records],
+            )
+            await conn.commit()
+    return len(records)
+
+
+async def _latest(session: AsyncSession, base: str, quote: str, at: datetime) -> Optional[Tuple[float, datetime]]:
+    # Последний курс пары не позже at: один проход по индексу (base, quote, timestamp)
+    row = (await session.execute(
+        select(Rate.rate, Rate.timestamp)
+        .where(Rate.base == base, Rate.quote == quote, Rate.timestamp <= at)
+        .order_by(Rate.timestamp.desc())
+        .limit(1)
+    )).first()
+    return (row.rate, row.timestamp) if row else None
+
+
+async def rate_as_of(session: AsyncSession, from_: str, to: str, at: datetime, source: str) -> Tuple[float, datetime]:
+    """
+    Курс пары на момент at: прямая котировка, обратная или кросс-курс через валюту-источник.
+
+    :return:
+        (rate, as_of) - курс и момент самой старой из использованных котировок
+    """
+    if from_ == to:
+        return 1.0, at
+    direct = await _latest(session, from_, to, at)
+    if direct:
+        return direct
+    inverse = await _latest(session, to, from_, at)
+    if inverse:
+        return 1.0 / inverse[0], inverse[1]
+
+    legs = []
+    for code in (from_, to):
+        leg = (1.0, at) if code == source else await _latest(session, source, code, at)
+        if leg is None:
+            raise ValueError(f"No rate for {from_}/{to} at {at.isoformat()}")
+        legs.append(leg)
+    (from_rate, from_at), (to_rate, to_at) = legs
+    return to_rate / from_rate, min(from_at, to_at)
+
+
+async def convert_at(session: AsyncSession, from_: str, to: str, amount: str, at: datetime, source: str) -> dict:
+    from_, to = normalize_code(from_), normalize_code(to)
+    value = parse_amount(amount)
+    rate, as_of = await rate_as_of(session, from_, to, at, source)
+    return build_result(from_, to, value, rate, int(as_of.replace(tzinfo=timezone.utc).timestamp()))
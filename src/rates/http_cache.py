@@ -0,0 +1,41 @@
+from email.utils import format_datetime, parsedate_to_datetime
+
+from starlette.requests import Request
+
+from src.rates.table import RateTable
+
+
+def snapshot_headers(table: RateTable, max_age: float) -> dict:
+    """
+    Заголовки кэширования ответа, посчитанного по снимку курсов table.
+
+    :param max_age:
+        Seconds until the next scheduled refresh of the table; 0 for a stale table.
+    """
+    return {
+        "ETag": f'"{table.version}"',
+        # По самой свежей котировке: с графом курсов as_of - самая старая, и 304 отдавался бы после изменений
+        "Last-Modified": format_datetime(table.modified_at, usegmt=True),
+        # Ответ зависит от пользователя (маршрут требует входа), поэтому кэшируется только в браузере
+        "Cache-Control": f"private, max-age={max(0, int(max_age))}",
+    }
+
+
+def not_modified(request: Request, headers: dict) -> bool:
+    """
+    Проверка условного запроса (If-None-Match, иначе If-Modified-Since) против заголовков снимка.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return headers["ETag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]).timestamp() <= since.timestamp()
+    return False
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from sqlalchemy import TIMESTAMP, BigInteger, Float, Identity, Index, Integer, PrimaryKeyConstraint, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.database import Base
+
+
+class Rate(Base):
+    """
+    История курсов: сколько единиц quote дают за одну единицу base на момент timestamp.
+
+    Составной первичный ключ (base, quote, timestamp) одновременно служит индексом
+    для поиска последнего курса пары на момент времени.
+    """
+    __tablename__ = "rate"
+    __table_args__ = (
+        PrimaryKeyConstraint("base", "quote", "timestamp", name="pk_rate_base_quote_timestamp"),
+    )
+
+    base: Mapped[str] = mapped_column(String(3), nullable=False)
+    quote: Mapped[str] = mapped_column(String(3), nullable=False)
+    timestamp: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)
+    rate: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class ConversionAudit(Base):
+    """
+    Журнал конвертаций: кто, какую пару, какую сумму и по какому курсу конвертировал.
+
+    Записи добавляются пачками в фоне (src/rates/audit.py), поэтому у таблицы нет внешних ключей
+    и только один индекс - для выборки конвертаций пользователя за период.
+    """
+    __tablename__ = "conversion_audit"
+    __table_args__ = (
+        Index("ix_conversion_audit_user_id_created_at", "user_id", "created_at"),
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger, Identity(), primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    base: Mapped[str] = mapped_column(String(3), nullable=False)
+    quote: Mapped[str] = mapped_column(String(3), nullable=False)
+    amount: Mapped[float] = mapped_column(Float, nullable=False)
+    rate: Mapped[float] = mapped_column(Float, nullable=False)
+    result: Mapped[float] = mapped_column(Float, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False)
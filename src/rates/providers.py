@@ -0,0 +1,266 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from src.metrics import upstream_request_duration
+from src.rates.breaker import CircuitBreaker, CircuitOpenError
+
+
+class RateRequestError(ValueError):
+    """
+    Провайдер ответил, но отказал в запросе (например, неизвестная валюта).
+    """
+
+
+@dataclass
+class Quotes:
+    source: str
+    quotes: Dict[str, float]
+    as_of: datetime
+    provider: str = "provider"
+    # Котировки прочитаны из сохраненного снимка, а не получены от провайдера сейчас
+    replayed: bool = False
+
+
+class RateProvider(ABC):
+    """
+    Источник курсов валют. Новый провайдер реализует fetch_rate и fetch_table
+    и регистрируется в PROVIDERS (src/rates/client.py) под своим именем.
+    Без любого из этих методов провайдер не создается (TypeError), а не падает в цикле обновления.
+    """
+
+    name = "provider"
+
+    @abstractmethod
+    async def fetch_rate(self, from_: str, to: str) -> float:
+        """
+        Курс одной пары: сколько единиц to дают за единицу from_.
+        """
+
+    @abstractmethod
+    async def fetch_table(self, source: str) -> Quotes:
+        """
+        Все котировки относительно source в виде {"USDEUR": 0.92, ...}.
+        """
+
+    async def fetch_tables(self, source: str) -> List[Quotes]:
+        """
+        Котировки для графа курсов (RateGraph); у одиночного провайдера - одна таблица.
+        """
+        return [await self.fetch_table(source)]
+
+    async def aclose(self):
+        pass
+
+
+class ProviderStats:
+    """
+    Задержки и ошибки провайдера в скользящем окне последних window запросов.
+    """
+
+    def __init__(self, window: int = 200):
+        self.latencies: deque = deque(maxlen=window)
+        self.outcomes: deque = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.last_error: Optional[str] = None
+
+    def record(self, latency: float, error: Optional[BaseException] = None):
+        self.requests += 1
+        self.outcomes.append(error is not None)
+        if error is None:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+            self.last_error = str(error) or type(error).__name__
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.error_rate,
+            "cancelled": self.cancelled,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "last_error": self.last_error,
+        }
+
+
+class ProviderRouter(RateProvider):
+    """
+    Несколько провайдеров за одним интерфейсом RateProvider.
+
+    Провайдеры опрашиваются в порядке приоритета; провайдер, у которого доля ошибок в окне
+    выше max_error_rate, уходит в конец очереди. Если ответ не пришел за p95 задержки
+    провайдера (до набора min_samples - за hedge_delay), параллельно отправляется
+    страхующий запрос следующему провайдеру и берется первый успешный ответ.
+    При ошибке запрос сразу уходит следующему провайдеру.
+
+    Каждый провайдер закрыт своим CircuitBreaker: пока цепь разомкнута, провайдер пропускается,
+    а если разомкнуты все, запрос сразу завершается CircuitOpenError без обращения к сети.
+    """
+
+    name = "router"
+
+    def __init__(
+            self,
+            providers: List[RateProvider],
+            hedge: bool = True,
+            hedge_delay: float = 0.5,
+            min_samples: int = 20,
+            max_error_rate: float = 0.5,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30.0,
+    ):
+        if not providers:
+            raise ValueError("At least one rate provider is required")
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.provider_stats: Dict[str, ProviderStats] = {provider.name: ProviderStats() for provider in providers}
+        self.breakers: Dict[str, CircuitBreaker] = {
+            provider.name: CircuitBreaker(failure_threshold, reset_timeout) for provider in providers
+        }
+
+    def order(self) -> List[RateProvider]:
+        return sorted(
+            self.providers,
+            key=lambda provider: self.provider_stats[provider.name].error_rate > self.max_error_rate,
+        )
+
+    def hedge_after(self, provider: RateProvider) -> float:
+        stats = self.provider_stats[provider.name]
+        if len(stats.latencies) < self.min_samples:
+            return self.hedge_delay
+        return stats.percentile(0.95)
+
+    async def _timed(self, provider: RateProvider, method: str, *args):
+        stats = self.provider_stats[provider.name]
+        breaker = self.breakers[provider.name]
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            result = await getattr(provider, method)(*args)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            stats.cancelled += 1
+            breaker.record_cancel()
+            raise
+        except RateRequestError:
+            # Отказ в запросе не говорит о неисправности провайдера и не размыкает цепь
+            outcome = "rejected"
+            stats.record(time.perf_counter() - started)
+            breaker.record_success()
+            raise
+        except Exception as error:
+            outcome = "error"
+            stats.record(time.perf_counter() - started, error)
+            breaker.record_failure()
+            raise
+        finally:
+            upstream_request_duration.observe(time.perf_counter() - started, provider.name, method, outcome)
+        stats.record(time.perf_counter() - started)
+        breaker.record_success()
+        return result
+
+    async def _call(self, method: str, *args):
+        queue = self.order()
+        pending: Dict[asyncio.Task, RateProvider] = {}
+        hedged = set()
+        last_error: Optional[BaseException] = None
+
+        def launch(hedge: bool = False) -> bool:
+            # Следующий провайдер по очереди, чья цепь замкнута (или готова к пробному запросу)
+            while queue:
+                provider = queue.pop(0)
+                if not self.breakers[provider.name].allow():
+                    continue
+                task = asyncio.ensure_future(self._timed(provider, method, *args))
+                pending[task] = provider
+                if hedge:
+                    hedged.add(task)
+                    self.provider_stats[provider.name].hedges += 1
+                return True
+            return False
+
+        if not launch():
+            raise CircuitOpenError("All rate providers are unavailable")
+        try:
+            while pending:
+                # Страхующий запрос отправляется один раз и только пока основной еще в работе
+                timeout = None
+                if self.hedge and queue and not hedged and len(pending) == 1:
+                    timeout = self.hedge_after(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(hedge=True)
+                    continue
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if task in hedged:
+                            self.provider_stats[provider.name].hedge_wins += 1
+                        return task.result()
+                    last_error = task.exception()
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_error
+
+    async def fetch_rate(self, from_: str, to: str) -> float:
+        return await self._call("fetch_rate", from_, to)
+
+    async def fetch_table(self, source: str) -> Quotes:
+        return await self._call("fetch_table", source)
+
+    async def fetch_tables(self, source: str) -> List[Quotes]:
+        """
+        Котировки сразу от всех доступных провайдеров, для графа курсов (RateGraph).
+        Ошибка одного провайдера не мешает остальным; исключение - только если не ответил ни один.
+        """
+        providers = [provider for provider in self.order() if self.breakers[provider.name].allow()]
+        if not providers:
+            raise CircuitOpenError("All rate providers are unavailable")
+        results = await asyncio.gather(
+            *(self._timed(provider, "fetch_table", source) for provider in providers), return_exceptions=True,
+        )
+        tables = [result for result in results if isinstance(result, Quotes)]
+        if not tables:
+            raise results[0]
+        return tables
+
+    async def aclose(self):
+        for provider in self.providers:
+            await provider.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "order": [provider.name for provider in self.order()],
+            "providers": {
+                name: {**stats.as_dict(), "circuit": self.breakers[name].stats()}
+                for name, stats in self.provider_stats.items()
+            },
+        }
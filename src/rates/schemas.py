@@ -0,0 +1,43 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, field_validator
+
+# Модели Pydantic для пакетной конвертации (DTO).
+
+
+class ConversionItem(BaseModel):
+    from_: str = Field(alias="from")
+    to: str
+    amount: float
+
+
+class BatchConvertRequest(BaseModel):
+    items: List[ConversionItem]
+
+
+class ConversionResult(BaseModel):
+    from_: str = Field(alias="from")
+    to: str
+    amount: Optional[float] = None  # None, если сумма в запросе - NaN или бесконечность
+    rate: Optional[float] = None
+    result: Optional[float] = None
+    error: Optional[str] = None  # Ошибка по конкретной строке, например неизвестная валюта
+
+
+class BatchConvertResponse(BaseModel):
+    results: List[ConversionResult]
+
+
+class RateHistoryItem(BaseModel):
+    # Колонки Rate.base/quote - String(3): неверный код должен давать 422, а не ошибку БД
+    base: str = Field(pattern=r"^[A-Z]{3}$")
+    quote: str = Field(pattern=r"^[A-Z]{3}$")
+    timestamp: datetime
+    rate: float
+
+    @field_validator("base", "quote", mode="before")
+    @classmethod
+    def normalize_code(cls, code):
+        # Как normalize_code в конвертации: " usd" -> "USD"
+        return code.strip().upper() if isinstance(code, str) else code
@@ -0,0 +1,138 @@
+import asyncio
+import math
+from typing import Optional
+
+import numpy as np
+
+from src.rates.cache import RateCache
+from src.rates.table import RateTable
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper()
+
+
+def parse_amount(amount) -> float:
+    """
+    Сумма из запроса: float("nan") и float("inf") разбираются без ошибки, но сконвертировать
+    и записать в журнал такую сумму нельзя.
+
+    :raises ValueError: amount is not a number or is not finite
+    """
+    value = float(amount)
+    if not math.isfinite(value):
+        raise ValueError(f"Invalid amount: {amount}")
+    return value
+
+
+def build_result(from_: str, to: str, amount: float, rate: float, timestamp: Optional[int] = None,
+                 stale: bool = False, age: Optional[float] = None) -> dict:
+    # Ответ в том же формате, что и convert у apilayer, чтобы шаблоны не менялись
+    info = {"quote": rate}
+    if timestamp is not None:
+        info["timestamp"] = timestamp
+    if stale:
+        # Курс взят из последних известных: провайдер недоступен или обновление еще идет
+        info["stale"] = True
+        info["age"] = round(age, 3)
+    return {
+        "success": True,
+        "query": {"from": from_, "to": to, "amount": amount},
+        "info": info,
+        "result": amount * rate,
+    }
+
+
+async def convert(cache: RateCache, from_: str, to: str, amount: str, table: Optional[RateTable] = None,
+                  max_age: Optional[float] = None) -> dict:
+    """
+    Конвертация по таблице курсов из памяти. Пока таблица еще не загружена, курс пары берется
+    через кэш; после загрузки валюта, которой нет в таблице, - ошибка без похода к провайдеру
+    (как в пакетной конвертации). Сумма в любом случае умножается локально.
+    Таблица старше max_age секунд и просроченный курс из кэша помечаются в ответе как stale.
+    """
+    from_, to = normalize_code(from_), normalize_code(to)
+    value = parse_amount(amount)
+    if table is not None:
+        for code in (from_, to):
+            if code not in table:
+                raise ValueError(f"Unknown currency: {code}")
+        age = table.age()
+        stale = max_age is not None and age > max_age
+        return build_result(from_, to, value, table.rate(from_, to), table.timestamp(from_, to), stale, age)
+    if from_ == to:
+        return build_result(from_, to, value, 1.0)
+    lookup = await cache.lookup(from_, to)
+    return build_result(from_, to, value, lookup.rate, stale=lookup.stale, age=lookup.age)
+
+
+async def _pair_rate(cache: RateCache, table: Optional[RateTable], from_: str, to: str):
+    if table is not None:
+        # Таблица загружена - неизвестная ей валюта считается ошибкой строки без похода к провайдеру
+        for code in (from_, to):
+            if code not in table:
+                return None, f"Unknown currency: {code}"
+        try:
+            return table.rate(from_, to), None
+        except ValueError as error:
+            # Снимок в общей памяти сменился на таблицу без этой валюты
+            return None, str(error)
+    try:
+        return (1.0 if from_ == to else await cache.get_rate(from_, to)), None
+    except Exception as error:
+        return None, str(error)
+
+
+async def rates_for_rows(cache: RateCache, froms: list, tos: list, table: Optional[RateTable] = None):
+    """
+    Курсы для набора строк: каждая различная пара запрашивается один раз.
+
+    :return:
+        (rates, pair_index, pair_errors) - курс для каждой строки (nan при ошибке),
+        номер пары каждой строки и ошибка по каждой паре (None, если ошибки нет)
+    """
+    pair_ids = {}
+    pair_index = np.fromiter(
+        (pair_ids.setdefault(pair, len(pair_ids)) for pair in zip(froms, tos)),
+        dtype=np.intp,
+        count=len(froms),
+    )
+    looked_up = await asyncio.gather(*(_pair_rate(cache, table, from_, to) for from_, to in pair_ids))
+    pair_rates = np.array([np.nan if rate is None else rate for rate, _ in looked_up], dtype=np.float64)
+    pair_errors = [error for _, error in looked_up]
+    return pair_rates[pair_index], pair_index, pair_errors
+
+
+async def convert_batch(cache: RateCache, items: list, table: Optional[RateTable] = None) -> list:
+    """
+    Пакетная конвертация: курс запрашивается один раз на каждую различную пару,
+    а суммы пересчитываются одной векторной операцией по всему пакету.
+    Строки с NaN или бесконечной суммой получают ошибку "Invalid amount" (такие числа не сериализуются в JSON).
+    """
+    froms = [normalize_code(item.from_) for item in items]
+    tos = [normalize_code(item.to) for item in items]
+    rates, pair_index, pair_errors = await rates_for_rows(cache, froms, tos, table)
+
+    amounts = np.fromiter((item.amount for item in items), dtype=np.float64, count=len(items))
+    results = amounts * rates
+
+    finite = np.isfinite(amounts)
+    has_errors = any(pair_errors) or not finite.all()
+    rates_list, results_list = rates.tolist(), results.tolist()
+    rows = [
+        {
+            "from": from_,
+            "to": to,
+            "amount": amount,
+            "rate": None if has_errors and pair_errors[pair] else rate,
+            "result": None if has_errors and pair_errors[pair] else result,
+            "error": pair_errors[pair] if has_errors else None,
+        }
+        for from_, to, amount, rate, result, pair in zip(
+            froms, tos, amounts.tolist(), rates_list, results_list, pair_index.tolist()
+        )
+    ]
+    if has_errors:
+        for i in np.flatnonzero(~finite).tolist():
+            rows[i].update(amount=None, rate=None, result=None, error=f"Invalid amount: {items[i].amount}")
+    return rows
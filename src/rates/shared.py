@@ -0,0 +1,381 @@
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+from src.rates.table import RateRefresher, RateTable, newest_quote
+
+MAGIC = b"RATESHM1"
+
+# Заголовок файла: magic, capacity (макс. число валют), номер активного слота
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+ACTIVE_OFFSET = 12
+
+# Заголовок слота: seq (нечетный, пока слот пишется), generation, число валют, as_of, время записи,
+# базовая валюта и версия снимка (RateTable.version)
+SLOT_HEADER = struct.Struct("<QQI4xdd8s16s")
+SLOT_HEADER_SIZE = 64
+SEQ = struct.Struct("<Q")
+ACTIVE = struct.Struct("<I")
+CODE_SIZE = 8
+
+
+def slot_size(capacity: int) -> int:
+    return SLOT_HEADER_SIZE + capacity * CODE_SIZE + 2 * capacity * capacity * 8
+
+
+def file_size(capacity: int) -> int:
+    return HEADER_SIZE + 2 * slot_size(capacity)
+
+
+class SharedTableView:
+    """
+    Снимок курсов прямо в общей памяти - тот же интерфейс, что у RateTable, без копирования матрицы.
+
+    Слотов два: публикация пишет в неактивный, поэтому снимок, взятый читателем, перезаписывается
+    только через одну публикацию. rate и timestamp проверяют seq слота после чтения и, если слот уже
+    переписан (seqlock), берут значение из актуального снимка; валюты, которой в нем нет, - ValueError.
+    """
+
+    def __init__(self, shared: "SharedRateFile", slot: int, seq: int, generation: int, codes: tuple,
+                 matrix: np.ndarray, freshness: np.ndarray, as_of: datetime, written_at: float,
+                 source: str, version: str):
+        self.shared = shared
+        self.slot = slot
+        self.seq = seq
+        self.generation = generation
+        self.source = source
+        self.codes = codes
+        self.index: Dict[str, int] = {code: i for i, code in enumerate(codes)}
+        self.matrix = matrix
+        self.freshness = freshness
+        self.as_of = as_of
+        self.written_at = written_at
+        self.version = version
+        self.modified_at = newest_quote(as_of, freshness)
+
+    def age(self) -> float:
+        # Снимок мог записать другой процесс, поэтому возраст считается по wall clock, а не monotonic
+        return time.time() - self.written_at
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def valid(self) -> bool:
+        return self.shared.slot_seq(self.slot) == self.seq
+
+    def _current(self, from_: str, to: str) -> "SharedTableView":
+        # Слот уже переписан: актуальный снимок мог прийти с другим набором валют
+        current = self.shared.read()
+        for code in (from_, to):
+            if current is None or code not in current:
+                raise ValueError(f"Unknown currency: {code}")
+        return current
+
+    def rate(self, from_: str, to: str) -> float:
+        value = float(self.matrix[self.index[from_], self.index[to]])
+        if not self.valid():
+            return self._current(from_, to).rate(from_, to)
+        return value
+
+    def timestamp(self, from_: str, to: str) -> int:
+        value = RateTable.timestamp(self, from_, to)
+        if not self.valid():
+            return self._current(from_, to).timestamp(from_, to)
+        return value
+
+
+class SharedRateFile:
+    """
+    Таблица курсов в файле, отображенном в память (mmap), с фиксированной разметкой:
+    заголовок и два слота, в каждом коды валют, матрица кросс-курсов и матрица свежести
+    размера capacity x capacity. Пишет один процесс (publish), читают все воркеры хоста (read).
+    """
+
+    def __init__(self, path: str, capacity: int = 256):
+        self.path = path
+        self.capacity = capacity
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._view: Optional[SharedTableView] = None
+        self._offsets = (0, 0)
+        self.generation = 0
+        self.retries = 0
+
+    def _open(self, create: bool) -> bool:
+        if self._map is not None:
+            return True
+        flags = os.O_RDWR | (os.O_CREAT if create else 0)
+        try:
+            fd = os.open(self.path, flags, 0o644)
+        except FileNotFoundError:
+            return False
+        size = os.fstat(fd).st_size
+        if size >= HEADER_SIZE:
+            magic, capacity, _ = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            if magic == MAGIC and size == file_size(capacity):
+                # Разметку задает уже созданный файл: читатели с другим capacity не должны его ломать
+                self.capacity = capacity
+            elif not create:
+                os.close(fd)
+                return False
+            else:
+                size = 0
+        elif not create:
+            os.close(fd)
+            return False
+        if size == 0:
+            # Новый файл или чужая разметка - размечаем заново с нулевыми слотами
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, file_size(self.capacity))
+            os.pwrite(fd, HEADER.pack(MAGIC, self.capacity, 0), 0)
+        self._file = fd
+        self._map = mmap.mmap(fd, file_size(self.capacity))
+        self._offsets = (HEADER_SIZE, HEADER_SIZE + slot_size(self.capacity))
+        return True
+
+    def close(self):
+        # Виды (SharedTableView) ссылаются на память mmap, поэтому отображение закрывается только вместе с файлом
+        self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+        if self._file is not None:
+            os.close(self._file)
+            self._file = None
+
+    def _slot_offset(self, slot: int) -> int:
+        return self._offsets[slot]
+
+    def _arrays(self, slot: int):
+        offset = self._slot_offset(slot) + SLOT_HEADER_SIZE
+        capacity = self.capacity
+        codes = np.ndarray((capacity,), dtype=f"S{CODE_SIZE}", buffer=self._map, offset=offset)
+        offset += capacity * CODE_SIZE
+        matrix = np.ndarray((capacity, capacity), dtype=np.float64, buffer=self._map, offset=offset)
+        offset += capacity * capacity * 8
+        freshness = np.ndarray((capacity, capacity), dtype=np.float64, buffer=self._map, offset=offset)
+        return codes, matrix, freshness
+
+    def slot_seq(self, slot: int) -> int:
+        return SEQ.unpack_from(self._map, self._offsets[slot])[0]
+
+    def active_slot(self) -> int:
+        return ACTIVE.unpack_from(self._map, ACTIVE_OFFSET)[0]
+
+    def publish(self, table: RateTable) -> int:
+        """
+        Записывает снимок в неактивный слот и делает его активным.
+
+        :return:
+            generation of the published snapshot
+        """
+        self._open(create=True)
+        n = len(table.codes)
+        if n > self.capacity:
+            raise ValueError(f"Rate table has {n} currencies, shared table holds {self.capacity}")
+        slot = 1 - self.active_slot()
+        offset = self._slot_offset(slot)
+        seq = self.slot_seq(slot)
+        if seq % 2:
+            seq += 1  # предыдущий писатель упал посреди записи
+        SEQ.pack_into(self._map, offset, seq + 1)
+        codes, matrix, freshness = self._arrays(slot)
+        codes[:n] = [code.encode() for code in table.codes]
+        matrix[:n, :n] = table.matrix
+        freshness[:n, :n] = table.freshness if table.freshness is not None else np.nan
+        self.generation = max(self.generation, self._generation(1 - slot)) + 1
+        SLOT_HEADER.pack_into(
+            # Время загрузки таблицы, а не записи: таблица из снимка на диске не должна молодеть при публикации
+            self._map, offset, seq + 1, self.generation, n, table.as_of.timestamp(), time.time() - table.age(),
+            table.source.encode(), table.version.encode(),
+        )
+        SEQ.pack_into(self._map, offset, seq + 2)
+        ACTIVE.pack_into(self._map, ACTIVE_OFFSET, slot)
+        return self.generation
+
+    def _generation(self, slot: int) -> int:
+        return SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))[1]
+
+    def read(self) -> Optional[SharedTableView]:
+        """
+        Актуальный снимок; пока таблица не опубликована, None. Пока слот не переписан,
+        возвращается один и тот же вид - на горячем пути это два struct.unpack_from.
+        """
+        if not self._open(create=False):
+            return None
+        for _ in range(100):
+            slot = self.active_slot()
+            view = self._view
+            if view is not None and view.slot == slot and view.seq == self.slot_seq(slot):
+                return view
+            offset = self._slot_offset(slot)
+            seq, generation, n, as_of, written_at, source, version = SLOT_HEADER.unpack_from(self._map, offset)
+            if seq % 2:
+                self.retries += 1
+                continue
+            if generation == 0:
+                return None
+            codes, matrix, freshness = self._arrays(slot)
+            view = SharedTableView(
+                self, slot, seq, generation, tuple(code.decode() for code in codes[:n]),
+                matrix[:n, :n], freshness[:n, :n], datetime.fromtimestamp(as_of, tz=timezone.utc), written_at,
+                source.rstrip(b"\0").decode(), version.rstrip(b"\0").decode(),
+            )
+            if self.slot_seq(slot) == seq:
+                self._view = view
+                self.generation = generation
+                return view
+            self.retries += 1
+        return self._view
+
+
+class SharedRateRefresher:
+    """
+    Одна таблица курсов на хост для всех воркеров gunicorn/uvicorn.
+
+    Воркер, захвативший flock на lock_path, становится писателем: работает обычный RateRefresher,
+    и каждая новая таблица публикуется в SharedRateFile. Остальные воркеры к провайдеру не ходят
+    и читают опубликованный снимок без копирования; раз в poll_interval они проверяют, не появился ли
+    новый снимок (для подписчиков потока курсов через on_update) и не освободилась ли блокировка
+    после падения писателя.
+    """
+
+    def __init__(self, refresher: RateRefresher, path: str, capacity: int = 256, poll_interval: float = 1.0,
+                 on_update: Optional[Callable[[RateTable], Awaitable[None]]] = None):
+        self.refresher = refresher
+        self.shared = SharedRateFile(path, capacity)
+        self.lock_path = path + ".lock"
+        self.poll_interval = poll_interval
+        self.on_update = on_update
+        self.leader = False
+        self.publish_errors = 0
+        self._lock_fd: Optional[int] = None
+        self._seen = 0
+        self._task: Optional[asyncio.Task] = None
+        on_refresh = refresher.on_refresh
+
+        async def publish(table: RateTable):
+            try:
+                self.shared.publish(table)
+            except Exception as error:
+                self.publish_errors += 1
+                print(f"Ошибка публикации таблицы курсов в общую память: {error}")
+            if on_refresh is not None:
+                await on_refresh(table)
+
+        refresher.on_refresh = publish
+
+    @property
+    def table(self):
+        if self.leader:
+            return self.refresher.table
+        # Пока писатель ничего не опубликовал, читатель отвечает из снимка на диске
+        return self.shared.read() or self.refresher.table
+
+    @property
+    def max_age(self) -> float:
+        return self.refresher.max_age
+
+    @property
+    def interval(self) -> float:
+        return self.refresher.interval
+
+    async def restore(self, table: RateTable):
+        # Писатель еще не выбран: в общую память снимок публикует тот, кто возьмет блокировку (try_lead),
+        # а подписчики потока этого воркера получают его через on_update, как таблицу от писателя
+        if self.refresher.table is not None:
+            return
+        self.refresher.table = table
+        self.refresher.refreshed_at = time.time() - table.age()
+        if self.on_update is not None:
+            try:
+                await self.on_update(table)
+            except Exception as error:
+                print(f"Ошибка обработки новой таблицы курсов: {error}")
+
+    def try_lead(self) -> bool:
+        if self.leader:
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Блокировка снимается ядром при завершении процесса, поэтому упавший писатель ее не удержит
+        self._lock_fd = fd
+        self.leader = True
+        if self.refresher.table is not None and self.shared.read() is None:
+            # Снимок с диска сразу виден всем воркерам, не дожидаясь провайдера
+            try:
+                self.shared.publish(self.refresher.table)
+            except Exception as error:
+                self.publish_errors += 1
+                print(f"Ошибка публикации таблицы курсов в общую память: {error}")
+        self.refresher.start()
+        return True
+
+    async def follow(self):
+        while not self.leader:
+            if self.try_lead():
+                print(f"Воркер {os.getpid()} обновляет общую таблицу курсов")
+                return
+            table = self.shared.read()
+            if table is not None and table.generation != self._seen:
+                self._seen = table.generation
+                if self.on_update is not None:
+                    try:
+                        await self.on_update(table)
+                    except Exception as error:
+                        print(f"Ошибка обработки новой таблицы курсов: {error}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if not self.try_lead():
+            self._task = asyncio.create_task(self.follow())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.refresher.stop()
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self.leader = False
+        self.shared.close()
+
+    def stats(self) -> dict:
+        stats = self.refresher.stats()
+        table = None if self.leader else self.shared.read()
+        if table is not None:
+            stats.update({
+                "rates_as_of": table.as_of.isoformat(),
+                "refreshed_at": datetime.fromtimestamp(table.written_at, tz=timezone.utc).isoformat(),
+                "currencies": len(table.codes),
+                "stale": table.age() > self.max_age,
+            })
+        stats.update({
+            "shared": self.shared.path,
+            "role": "writer" if self.leader else "reader",
+            "generation": self.shared.generation,
+            "read_retries": self.shared.retries,
+            "publish_errors": self.publish_errors,
+        })
+        return stats
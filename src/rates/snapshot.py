@@ -0,0 +1,225 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+import numpy as np
+
+from src.rates.providers import Quotes, RateProvider, RateRequestError
+from src.rates.table import RateTable
+
+MAGIC = b"RATESNAP"
+# Версия формата файла: меняется при любом изменении разметки, старые снимки тогда не читаются
+FORMAT_VERSION = 1
+
+# Заголовок: magic, версия формата, флаги, число валют, as_of, время загрузки таблицы от провайдера,
+# время записи снимка (все epoch sec), базовая валюта и CRC32 заголовка (с нулевым полем CRC) и данных
+HEADER = struct.Struct("<8sHHIddd8sI12x")
+CRC_OFFSET = HEADER.size - 16
+# За кодами валют идет матрица кросс-курсов, с флагом HAS_FRESHNESS - еще матрица свежести (RateGraph)
+HAS_FRESHNESS = 1
+CODE_SIZE = 8
+
+
+class SnapshotError(Exception):
+    """
+    Файл снимка поврежден, обрезан или записан в другом формате.
+    """
+
+
+def encode_snapshot(table: RateTable) -> bytes:
+    n = len(table.codes)
+    flags = HAS_FRESHNESS if table.freshness is not None else 0
+    # Таблица из общей памяти (SharedTableView) считает возраст по wall clock, RateTable - по monotonic
+    refreshed_at = time.time() - table.age()
+    payload = [
+        np.array(table.codes, dtype=f"S{CODE_SIZE}").tobytes(),
+        np.ascontiguousarray(table.matrix, dtype=np.float64).tobytes(),
+    ]
+    if flags & HAS_FRESHNESS:
+        payload.append(np.ascontiguousarray(table.freshness, dtype=np.float64).tobytes())
+    header = [MAGIC, FORMAT_VERSION, flags, n, table.as_of.timestamp(), refreshed_at, time.time(),
+              table.source.encode()]
+    crc = zlib.crc32(HEADER.pack(*header, 0))
+    for chunk in payload:
+        crc = zlib.crc32(chunk, crc)
+    return b"".join([HEADER.pack(*header, crc), *payload])
+
+
+def save_snapshot(table: RateTable, path: str) -> int:
+    """
+    Атомарно записывает таблицу в файл снимка: данные пишутся во временный файл рядом
+    и подменяют старый снимок через os.replace, поэтому читатель видит либо старый, либо новый файл целиком.
+
+    :return:
+        snapshot size in bytes
+    """
+    data = encode_snapshot(table)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    return len(data)
+
+
+def load_snapshot(path: str) -> RateTable:
+    """
+    Читает снимок через mmap: матрицы таблицы - массивы numpy прямо поверх отображения файла,
+    без копирования; отображение живет, пока жива таблица.
+    Возраст таблицы (age) отсчитывается от самой свежей котировки (modified_at), а не от чтения файла.
+
+    :raises FileNotFoundError: snapshot file does not exist
+    :raises SnapshotError: bad magic, unsupported format version, wrong size or checksum mismatch
+    """
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < HEADER.size:
+            raise SnapshotError(f"Rate snapshot {path} is truncated")
+        data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+    magic, version, flags, n, as_of, _, _, source, crc = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise SnapshotError(f"{path} is not a rate snapshot")
+    if version != FORMAT_VERSION:
+        raise SnapshotError(f"Rate snapshot {path} has format version {version}, expected {FORMAT_VERSION}")
+    matrices = 2 if flags & HAS_FRESHNESS else 1
+    if size != HEADER.size + n * CODE_SIZE + matrices * n * n * 8:
+        raise SnapshotError(f"Rate snapshot {path} is truncated")
+    view = memoryview(data)
+    header = bytearray(view[:HEADER.size])
+    header[CRC_OFFSET:CRC_OFFSET + 4] = bytes(4)
+    valid = zlib.crc32(view[HEADER.size:], zlib.crc32(header)) == crc
+    view.release()
+    if not valid:
+        raise SnapshotError(f"Rate snapshot {path} checksum mismatch")
+
+    offset = HEADER.size
+    codes = np.frombuffer(data, dtype=f"S{CODE_SIZE}", count=n, offset=offset)
+    offset += n * CODE_SIZE
+    matrix = np.frombuffer(data, dtype=np.float64, count=n * n, offset=offset).reshape(n, n)
+    offset += n * n * 8
+    freshness = None
+    if flags & HAS_FRESHNESS:
+        freshness = np.frombuffer(data, dtype=np.float64, count=n * n, offset=offset).reshape(n, n)
+    table = RateTable(
+        source.rstrip(b"\0").decode(), tuple(code.decode() for code in codes), matrix,
+        datetime.fromtimestamp(as_of, tz=timezone.utc), freshness,
+    )
+    table.age_from(table.modified_at)
+    return table
+
+
+class RateSnapshots:
+    """
+    Последняя удачная таблица курсов на диске: при старте приложение отвечает из снимка,
+    не дожидаясь провайдера, а save сохраняет новую таблицу не чаще раза в interval секунд.
+    """
+
+    def __init__(self, path: str, interval: float = 300.0, read_only: bool = False):
+        self.path = path
+        self.interval = interval
+        # В офлайн-режиме снимок только читается: перезаписывать его нечем
+        self.read_only = read_only
+        self.saves = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.loaded_version: Optional[str] = None
+        self.saved_version: Optional[str] = None
+        self.saved_at: Optional[float] = None
+        self.size = 0
+
+    def load(self) -> Optional[RateTable]:
+        """
+        Таблица из снимка; None, если снимка нет или он поврежден (ошибка печатается и попадает в stats).
+        """
+        try:
+            table = load_snapshot(self.path)
+        except FileNotFoundError:
+            return None
+        except (OSError, SnapshotError) as error:
+            self.errors += 1
+            self.last_error = str(error)
+            print(f"Ошибка чтения снимка курсов: {error}")
+            return None
+        # Эта таблица уже лежит на диске, переписывать ее тем же содержимым незачем
+        self.loaded_version = self.saved_version = table.version
+        return table
+
+    async def save(self, table: RateTable, force: bool = False) -> bool:
+        if self.read_only or table.version == self.saved_version:
+            return False
+        if not force and self.saved_at is not None and time.monotonic() - self.saved_at < self.interval:
+            return False
+        try:
+            # Запись с fsync не должна держать event loop
+            self.size = await asyncio.to_thread(save_snapshot, table, self.path)
+        except OSError as error:
+            self.errors += 1
+            self.last_error = str(error)
+            print(f"Ошибка записи снимка курсов: {error}")
+            return False
+        self.saves += 1
+        self.saved_version = table.version
+        self.saved_at = time.monotonic()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "read_only": self.read_only,
+            "interval": self.interval,
+            "saves": self.saves,
+            "size": self.size,
+            "loaded_version": self.loaded_version,
+            "saved_version": self.saved_version,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class SnapshotProvider(RateProvider):
+    """
+    Провайдер офлайн-режима: курсы только из файла снимка, без сети.
+    Файл перечитывается, когда его подменили (новый снимок подкладывают тем же os.replace).
+    """
+
+    name = "snapshot"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._table: Optional[RateTable] = None
+        self._stamp = None
+
+    def table(self) -> RateTable:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise SnapshotError(f"No rate snapshot at {self.path}") from None
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            self._table = load_snapshot(self.path)
+            self._stamp = stamp
+        return self._table
+
+    @classmethod
+    def from_settings(cls, settings) -> "SnapshotProvider":
+        return cls(settings.RATE_SNAPSHOT_PATH)
+
+    async def fetch_rate(self, from_: str, to: str) -> float:
+        table = self.table()
+        for code in (from_, to):
+            if code not in table:
+                raise RateRequestError(f"No snapshot rate for currency: {code}")
+        return table.rate(from_, to)
+
+    async def fetch_table(self, source: str) -> Quotes:
+        table = self.table()
+        if source not in table:
+            raise RateRequestError(f"No snapshot rate for currency: {source}")
+        quotes = {source + code: table.rate(source, code) for code in table.codes if code != source}
+        return Quotes(source, quotes, table.as_of, provider=self.name, replayed=True)
@@ -0,0 +1,118 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set, Tuple
+
+import orjson
+
+from src.rates.table import RateTable
+
+Pair = Tuple[str, str]
+
+
+class Subscription:
+    """
+    Подписка одного клиента на набор пар.
+
+    Очередь хранит ссылки на общие снимки RateTable, а не готовые сообщения: курсы пар клиента
+    считаются только для тех снимков, которые он действительно получит. При переполнении
+    очереди из нее выбрасывается самый старый снимок, поэтому медленный клиент
+    пропускает промежуточные обновления, но всегда получает последнее.
+    """
+
+    __slots__ = ("pairs", "queue", "dropped")
+
+    def __init__(self, pairs: List[Pair], queue_size: int = 1):
+        self.pairs = pairs
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def offer(self, table: RateTable):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(table)
+
+    def message(self, table: RateTable) -> dict:
+        rates = {}
+        for from_, to in self.pairs:
+            if from_ in table and to in table:
+                try:
+                    rates[from_ + to] = table.rate(from_, to)
+                except ValueError:
+                    # Снимок в общей памяти сменился на таблицу без этой валюты
+                    continue
+        return {"as_of": table.as_of.isoformat(), "rates": rates}
+
+
+class RateBroadcaster:
+    """
+    Раздача обновлений таблицы курсов подписчикам потока.
+
+    Источник обновлений один - RateRefresher, поэтому число запросов к провайдеру
+    не зависит от числа открытых вкладок. publish только кладет ссылку на снимок
+    в очередь каждого подписчика и не ждет медленных клиентов.
+    """
+
+    def __init__(self, queue_size: int = 1, max_subscribers: int = 10000):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers: Set[Subscription] = set()
+        self.table: Optional[RateTable] = None
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, pairs: List[Pair]) -> Subscription:
+        if len(self.subscribers) >= self.max_subscribers:
+            raise OverflowError("Too many rate stream subscribers")
+        subscription = Subscription(pairs, self.queue_size)
+        if self.table is not None:
+            # Новый подписчик сразу получает текущие курсы
+            subscription.offer(self.table)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+        self.dropped += subscription.dropped
+
+    def publish(self, table: RateTable):
+        self.table = table
+        self.published += 1
+        for subscription in self.subscribers:
+            subscription.offer(table)
+
+    async def events(
+            self,
+            subscription: Subscription,
+            heartbeat: float = 15.0,
+            is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        Сообщения Server-Sent Events для подписки; без обновлений раз в heartbeat секунд
+        отправляется комментарий, чтобы прокси не закрывали соединение.
+
+        Сервер может молча отбрасывать запись в закрытое соединение, поэтому отключение
+        клиента проверяется через is_disconnected перед каждым сообщением.
+        """
+        try:
+            while True:
+                try:
+                    table = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    table = None
+                if is_disconnected is not None and await is_disconnected():
+                    return
+                if table is None:
+                    yield b": keep-alive\n\n"
+                else:
+                    yield b"event: rates\ndata: " + orjson.dumps(subscription.message(table)) + b"\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "max_subscribers": self.max_subscribers,
+            "queue_size": self.queue_size,
+            "published": self.published,
+            "dropped": self.dropped + sum(subscription.dropped for subscription in self.subscribers),
+        }
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import random
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+from src.rates.providers import RateProvider
+
+
+def newest_quote(as_of: datetime, freshness: Optional[np.ndarray]) -> datetime:
+    """
+    Время самой свежей котировки таблицы (Last-Modified): as_of таблицы из графа курсов - самая старая.
+    """
+    if freshness is not None:
+        finite = freshness[np.isfinite(freshness)]
+        if finite.size and finite.max() > as_of.timestamp():
+            return datetime.fromtimestamp(float(finite.max()), tz=timezone.utc)
+    return as_of
+
+
+class RateTable:
+    """
+    Неизменяемый снимок курсов: плотная матрица кросс-курсов, индексированная кодом валюты.
+
+    matrix[i, j] - сколько единиц валюты codes[j] дают за одну единицу codes[i].
+    Таблица из графа курсов (RateGraph) хранит еще freshness[i, j] - время самой старой котировки
+    на пути пары (epoch sec); as_of тогда - самая старая котировка во всей таблице,
+    а modified_at - самая свежая.
+    """
+
+    def __init__(self, source: str, codes: tuple, matrix: np.ndarray, as_of: datetime,
+                 freshness: Optional[np.ndarray] = None):
+        self.source = source
+        self.codes = codes
+        self.index: Dict[str, int] = {code: i for i, code in enumerate(codes)}
+        self.matrix = matrix
+        self.freshness = freshness
+        self.as_of = as_of
+        self.loaded_at = time.monotonic()
+        # Версия снимка - хеш всей матрицы и свежести: в таблице из графа курсов котировка
+        # может обновиться без изменения первой строки
+        digest = hashlib.blake2b(",".join(codes).encode(), digest_size=8)
+        digest.update(np.ascontiguousarray(matrix).data)
+        if freshness is not None:
+            digest.update(np.ascontiguousarray(freshness).data)
+        self.version = digest.hexdigest() if codes else "empty"
+        self.modified_at = newest_quote(as_of, freshness)
+
+    @classmethod
+    def from_quotes(cls, source: str, quotes: Dict[str, float], as_of: datetime) -> "RateTable":
+        """
+        :param source:
+            Currency all quotes are given against, e.g. USD.
+
+        :param quotes:
+            Provider "live" quotes in the form {"USDEUR": 0.92, ...}.
+
+        :param as_of:
+            Moment the provider quoted the rates.
+        """
+        rates = {source: 1.0}
+        for pair, value in quotes.items():
+            rates[pair[len(source):]] = float(value)
+        codes = tuple(sorted(rates))
+        vector = np.array([rates[code] for code in codes], dtype=np.float64)
+        # Кросс-курс from->to = (source->to) / (source->from)
+        matrix = np.outer(1.0 / vector, vector)
+        return cls(source, codes, matrix, as_of)
+
+    def age(self) -> float:
+        """
+        Сколько секунд прошло с загрузки таблицы от провайдера.
+        """
+        return time.monotonic() - self.loaded_at
+
+    def age_from(self, moment: datetime):
+        """
+        Возраст таблицы, прочитанной из сохраненных данных (снимка на диске), отсчитывается
+        от времени котировок, а не от момента чтения: иначе курсы многодневной давности выглядели бы свежими.
+        """
+        self.loaded_at = time.monotonic() - max(0.0, time.time() - moment.timestamp())
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.index
+
+    def rate(self, from_: str, to: str) -> float:
+        return float(self.matrix[self.index[from_], self.index[to]])
+
+    def timestamp(self, from_: str, to: str) -> int:
+        """
+        Время котировки, по которой посчитан курс пары (unix time).
+        """
+        if self.freshness is not None:
+            oldest = self.freshness[self.index[from_], self.index[to]]
+            if np.isfinite(oldest):
+                return int(oldest)
+        return int(self.as_of.timestamp())
+
+
+class RateRefresher:
+    """
+    Фоновая задача, которая по расписанию забирает у провайдера полную таблицу
+    котировок и атомарно подменяет текущий RateTable.
+
+    Интервал размывается случайным jitter, чтобы воркеры не ходили к провайдеру одновременно,
+    а после ошибок задержка растет экспоненциально до max_backoff.
+    """
+
+    def __init__(
+            self,
+            provider: RateProvider,
+            source: str = "USD",
+            interval: float = 60.0,
+            jitter: float = 0.1,
+            max_backoff: float = 300.0,
+            on_refresh: Optional[Callable[["RateTable"], Awaitable[None]]] = None,
+            graph=None,
+    ):
+        self.provider = provider
+        # С графом курсов (RateGraph) котировки всех провайдеров объединяются, а кросс-курсы
+        # считаются по самым свежим цепочкам котировок
+        self.graph = graph
+        self.on_refresh = on_refresh
+        self.source = source
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.table: Optional[RateTable] = None
+        # Таблица, не обновлявшаяся два интервала подряд, отдается с пометкой stale
+        self.max_age = interval * 2
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> RateTable:
+        if self.graph is None:
+            quotes = await self.provider.fetch_table(self.source)
+            table = RateTable.from_quotes(quotes.source, quotes.quotes, quotes.as_of)
+            replayed = quotes.replayed
+        else:
+            tables = await self.provider.fetch_tables(self.source)
+            for quotes in tables:
+                self.graph.update_quotes(quotes)
+            inconsistent = self.graph.check_consistency()
+            if inconsistent:
+                print(f"Несогласованные котировки: {len(inconsistent)} треугольников, "
+                      f"худший {inconsistent[0]['currencies']} ({inconsistent[0]['deviation']:.2%})")
+            table = self.graph.table()
+            replayed = all(quotes.replayed for quotes in tables)
+        if replayed:
+            table.age_from(table.modified_at)
+        self.table = table
+        self.refreshed_at = time.time()
+        if self.on_refresh is not None:
+            try:
+                await self.on_refresh(self.table)
+            except Exception as error:
+                # Ошибка подписчика (например, записи истории) не должна считаться ошибкой обновления
+                print(f"Ошибка обработки новой таблицы курсов: {error}")
+        return self.table
+
+    async def restore(self, table: RateTable):
+        """
+        Таблица из снимка на диске до первого обновления: convert-маршруты отвечают сразу после старта.
+        Она проходит через тот же on_refresh, что и обновление, поэтому подписчики потока курсов
+        получают ее, не дожидаясь провайдера (в офлайн-режиме его может не быть вовсе).
+        """
+        if self.table is not None:
+            return
+        self.table = table
+        self.refreshed_at = time.time() - table.age()
+        if self.on_refresh is not None:
+            try:
+                await self.on_refresh(table)
+            except Exception as error:
+                print(f"Ошибка обработки новой таблицы курсов: {error}")
+
+    def next_delay(self) -> float:
+        delay = self.interval
+        if self.failures:
+            delay = min(self.max_backoff, self.interval / 10 * 2 ** (self.failures - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+                self.failures = 0
+                self.last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.failures += 1
+                self.last_error = str(error)
+                print(f"Ошибка обновления таблицы курсов ({self.failures} подряд): {error}")
+            await asyncio.sleep(self.next_delay())
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        table = self.table
+        return {
+            "source": self.source,
+            "rates_as_of": table.as_of.isoformat() if table else None,
+            "refreshed_at": datetime.fromtimestamp(self.refreshed_at, tz=timezone.utc).isoformat()
+            if self.refreshed_at else None,
+            "currencies": len(table.codes) if table else 0,
+            "stale": table.age() > self.max_age if table else False,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
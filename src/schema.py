@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import TIMESTAMP, Column, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+# Ключ pg_advisory_xact_lock: миграцию схемы выполняет только один процесс
+SCHEMA_LOCK_ID = 7305218
+
+# Отдельные метаданные: таблица версии не входит в схему приложения и в ее версию
+schema_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    schema_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", String(32), nullable=False),
+    Column("applied_at", TIMESTAMP, nullable=False),
+)
+
+
+class SchemaMismatchError(RuntimeError):
+    """
+    Существующие таблицы БД расходятся с моделями: create_all не меняет готовые таблицы,
+    поэтому такую схему нужно мигрировать вручную.
+    """
+
+
+def metadata_version(metadata: MetaData) -> str:
+    """
+    Версия схемы - хеш DDL всех таблиц и индексов моделей, поэтому новая модель или колонка
+    меняет версию без ручного учета.
+    """
+    dialect = postgresql.dialect()
+    digest = hashlib.md5()
+    for table in metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    return digest.hexdigest()
+
+
+def ensure_database(url):
+    # sqlalchemy_utils и синхронный драйвер нужны только при первом запуске на пустом сервере
+    from sqlalchemy import create_engine
+    from sqlalchemy_utils import create_database, database_exists
+
+    sync_engine = create_engine(url.set(drivername="postgresql+psycopg2"))
+    try:
+        if not database_exists(sync_engine.url):
+            create_database(sync_engine.url)
+    finally:
+        sync_engine.dispose()
+
+
+def schema_mismatches(conn, metadata: MetaData) -> List[str]:
+    """
+    Сравнивает таблицы в БД с моделями: отсутствующие таблицы, колонки и индексы,
+    другой тип или nullable колонки. Лишние колонки и индексы в БД не мешают приложению и не проверяются.
+
+    :return:
+        human-readable differences, empty if the database matches the models
+    """
+    inspector = inspect(conn)
+    problems = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name, schema=table.schema):
+            problems.append(f"table {table.name} is missing")
+            continue
+        columns = {column["name"]: column for column in inspector.get_columns(table.name, schema=table.schema)}
+        for column in table.columns:
+            live = columns.get(column.name)
+            if live is None:
+                problems.append(f"column {table.name}.{column.name} is missing")
+                continue
+            # Сравнивается семейство типа: Float модели отражается как DOUBLE PRECISION
+            if live["type"]._type_affinity is not column.type._type_affinity:
+                problems.append(f"column {table.name}.{column.name} is {live['type']}, expected {column.type}")
+            if live["nullable"] != column.nullable:
+                problems.append(f"column {table.name}.{column.name} has nullable={live['nullable']}, "
+                                f"expected {column.nullable}")
+        indexes = {index["name"] for index in inspector.get_indexes(table.name, schema=table.schema)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                problems.append(f"index {index.name} on {table.name} is missing")
+    return problems
+
+
+async def read_version(conn: AsyncConnection) -> Optional[str]:
+    try:
+        return await conn.scalar(select(schema_version.c.version).where(schema_version.c.id == 1))
+    except ProgrammingError:
+        # Таблицы версии еще нет - первый запуск на этой БД
+        await conn.rollback()
+        return None
+
+
+async def bootstrap_schema(engine: AsyncEngine, metadata: MetaData) -> bool:
+    """
+    Подготовка схемы при старте процесса.
+
+    Если версия в schema_version совпадает с версией моделей, выполняется один SELECT и никакого DDL.
+    Иначе create_all выполняется под pg_advisory_xact_lock: из нескольких одновременно
+    стартующих воркеров миграцию делает первый, остальные дожидаются блокировки
+    и видят уже записанную версию.
+
+    create_all только создает недостающие таблицы, поэтому перед записью новой версии
+    таблицы в БД сверяются с моделями. При расхождении транзакция откатывается и версия не меняется.
+
+    :return:
+        True if this process applied the schema
+    :raises SchemaMismatchError: existing tables differ from the models and need a manual migration
+    """
+    version = metadata_version(metadata)
+    try:
+        async with engine.connect() as conn:
+            if await read_version(conn) == version:
+                return False
+    except Exception:
+        # Подключиться не удалось - возможно, базы еще нет
+        await asyncio.to_thread(ensure_database, engine.url)
+
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+        await conn.run_sync(schema_metadata.create_all)
+        if await read_version(conn) == version:
+            return False
+        await conn.run_sync(metadata.create_all)
+        problems = await conn.run_sync(schema_mismatches, metadata)
+        if problems:
+            raise SchemaMismatchError("Database schema differs from the models: " + "; ".join(problems))
+        statement = insert(schema_version).values(id=1, version=version, applied_at=datetime.utcnow())
+        await conn.execute(statement.on_conflict_do_update(
+            index_elements=[schema_version.c.id],
+            set_={"version": statement.excluded.version, "applied_at": statement.excluded.applied_at},
+        ))
+    return True
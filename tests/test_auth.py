@@ -0,0 +1,256 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+import pytest_asyncio
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from fastapi_users import schemas
+from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase
+from sqlalchemy import delete, event, update
+
+from src.auth.auth_config import current_user
+from src.auth.hashing import HashingPool
+from src.auth.manager import UserManager, user_cache
+from src.auth.models import Role, User
+from src.auth.rbac import PermissionIndex, require_permission
+from src.auth.user_cache import UserCache
+from src.database import async_session_maker, engine
+
+
+@pytest_asyncio.fixture
+async def hashing():
+    # Минимальная стоимость bcrypt, чтобы тесты не ждали секунды на каждый хеш
+    pool = HashingPool(rounds=4, workers=2, max_pending=4)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_hashing_pool_hash_and_verify(hashing):
+    hashed = await hashing.hash("secret")
+    assert hashed.startswith("$2b$04$")
+    assert await hashing.verify_and_update("secret", hashed) == (True, None)
+    verified, _ = await hashing.verify_and_update("wrong", hashed)
+    assert not verified
+    assert hashing.stats()["completed"] == 3
+    assert hashing.stats()["pending"] == 0
+
+    # Ошибка в процессе пула (здесь - неверный формат хеша) считается в failed, а не в completed
+    with pytest.raises(Exception):
+        await hashing.verify_and_update("secret", "not-a-bcrypt-hash")
+    assert (hashing.stats()["completed"], hashing.stats()["failed"]) == (3, 1)
+
+
+def test_hashing_pool_default_workers_split_cores():
+    # Процессы не создаются до первого хеша, поэтому пул можно собрать без shutdown
+    with patch("src.auth.hashing.os.cpu_count", return_value=8):
+        assert HashingPool().workers == 8
+        assert HashingPool(web_workers=4).workers == 2
+        assert HashingPool(web_workers=16).workers == 1
+        assert HashingPool(workers=3, web_workers=4).workers == 3
+        assert HashingPool(web_workers=4).max_pending == 8
+
+
+@pytest.mark.asyncio
+async def test_hashing_pool_rejects_when_saturated(hashing):
+    results = await asyncio.gather(*(hashing.hash("secret") for _ in range(6)), return_exceptions=True)
+    rejected = [result for result in results if isinstance(result, HTTPException)]
+    assert len(rejected) == 2
+    assert rejected[0].status_code == 503
+    assert rejected[0].headers["Retry-After"] == "1"
+    assert hashing.stats()["rejected"] == 2
+
+
+@pytest.mark.asyncio
+async def test_authenticate_uses_hashing_pool(hashing, monkeypatch):
+    monkeypatch.setattr("src.auth.manager.hashing_pool", hashing)
+    user = MagicMock(hashed_password=await hashing.hash("secret"))
+    user_db = MagicMock(get_by_email=AsyncMock(return_value=user), update=AsyncMock())
+    manager = UserManager(user_db)
+
+    assert await manager.authenticate({"email": "test@example.com", "password": "secret"}) is user
+    with pytest.raises(HTTPException) as error:
+        await manager.authenticate({"email": "test@example.com", "password": "wrong"})
+    assert error.value.status_code == 401
+
+    # Для несуществующего пользователя хеш все равно считается (защита от timing-атак)
+    user_db.get_by_email.return_value = None
+    completed = hashing.completed
+    with pytest.raises(HTTPException):
+        await manager.authenticate({"email": "missing@example.com", "password": "secret"})
+    assert hashing.completed == completed + 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_user(user_id: int, role_id: int = 1, role_name: str = "user") -> User:
+    user = User(id=user_id, email=f"user{user_id}@example.com", username=f"user{user_id}",
+                hashed_password="hashed", role_id=role_id, is_active=True, is_superuser=False, is_verified=False)
+    user.role = Role(id=role_id, name=role_name, permissions={})
+    return user
+
+
+def test_user_cache_ttl_lru_and_invalidation():
+    clock = FakeClock()
+    cache = UserCache(ttl=10, max_size=2, clock=clock)
+    assert cache.get(1) is None
+
+    cache.put(make_user(1, role_id=2, role_name="admin"))
+    cache.put(make_user(2))
+    first, second = cache.get(1), cache.get(1)
+    assert first.role.name == "admin" and first.email == "user1@example.com"
+    assert first is not second  # каждый запрос получает свой экземпляр
+
+    cache.put(make_user(3))  # вытесняет давно не использованного пользователя 2
+    assert cache.get(2) is None
+    cache.invalidate_role(2)
+    assert cache.get(1) is None
+
+    clock.now = 11
+    assert cache.get(3) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["invalidations"]) == (2, 4, 1, 1)
+    assert stats["hit_ratio"] == pytest.approx(2 / 6)
+
+
+@pytest_asyncio.fixture
+async def user_session():
+    async with engine.begin() as conn:
+        await conn.run_sync(Role.__table__.create, checkfirst=True)
+        await conn.run_sync(User.__table__.create, checkfirst=True)
+        await conn.execute(delete(User).where(User.id == 9001))
+        await conn.execute(delete(Role).where(Role.id == 9001))
+    user_cache.clear()
+    async with async_session_maker() as session:
+        session.add(Role(id=9001, name="admin", permissions={}))
+        session.add(User(id=9001, email="cached@example.com", username="cached", hashed_password="hashed",
+                         role_id=9001))
+        await session.commit()
+    async with async_session_maker() as session:
+        yield session
+    async with engine.begin() as conn:
+        await conn.execute(delete(User).where(User.id == 9001))
+        await conn.execute(delete(Role).where(Role.id == 9001))
+    user_cache.clear()
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_user_manager_get_is_served_from_cache(user_session):
+    manager = UserManager(SQLAlchemyUserDatabase(user_session, User))
+    queries = []
+
+    def record(conn, cursor, statement, *args):
+        queries.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        user = await manager.get(9001)
+        assert user.role.name == "admin"
+        loaded = len(queries)
+        assert loaded >= 1
+
+        user_session.expunge_all()  # как в новом запросе: в сессии еще нет этого пользователя
+        cached = await manager.get(9001)
+        assert cached.role.name == "admin"
+        assert len(queries) == loaded  # повторный запрос обходится без БД
+
+        # Деактивация через менеджер сбрасывает снимок
+        await manager.update(schemas.BaseUserUpdate(is_active=False), cached)
+        assert user_cache.get(9001) is None
+        assert (await manager.get(9001)).is_active is False
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
+
+
+def test_permission_index_compiles_roles_to_bitsets():
+    index = PermissionIndex()
+    changed = index.compile([
+        Role(id=1, name="user", permissions=None),
+        Role(id=2, name="admin", permissions=["*"]),
+        Role(id=3, name="analyst", permissions={"rates:export": True, "convert:batch": False}),
+    ])
+    assert changed == [1, 2, 3]
+    assert index.has(1, "convert:batch") and not index.has(1, "rates:ingest")
+    assert index.has(2, "rates:ingest")  # "*" дает и права, которых еще нет в индексе
+    assert index.has(3, "rates:export") and not index.has(3, "convert:batch")
+    assert not index.has(4, "convert") and not index.has(None, "convert")
+
+    bits = dict(index.bits)
+    changed = index.compile([
+        Role(id=1, name="user", permissions=None),
+        Role(id=3, name="analyst", permissions=["convert:batch"]),
+    ])
+    assert changed == [2, 3]
+    assert index.bits == bits  # номера битов сохраняются между перезагрузками
+    assert index.has(3, "convert:batch") and not index.has(3, "rates:export")
+
+
+def test_permission_index_empty_permissions_use_defaults():
+    # Существующие строки role хранят {} - такие роли сохраняют прежний доступ
+    index = PermissionIndex()
+    index.compile([Role(id=1, name="user", permissions={}), Role(id=2, name="admin", permissions=[]),
+                   Role(id=3, name="viewer", permissions={})])
+    assert index.has(1, "convert") and not index.has(1, "rates:ingest")
+    assert index.has(2, "rates:ingest")
+    # Прочие роли без прав сохраняют доступ к форме конвертера, но не к новым маршрутам
+    assert index.has(3, "convert") and not index.has(3, "convert:batch")
+
+
+def test_permission_index_skips_malformed_role():
+    index = PermissionIndex()
+    index.compile([Role(id=1, name="analyst", permissions=["rates:export"])])
+    changed = index.compile([
+        Role(id=1, name="analyst", permissions="rates:export"),
+        Role(id=2, name="support", permissions="oops"),
+        Role(id=3, name="viewer", permissions=["rates:stream"]),
+    ])
+    # Испорченная роль сохраняет прежнюю маску, новая получает права user, остальные компилируются
+    assert changed == [2, 3]
+    assert index.has(1, "rates:export") and not index.has(1, "convert")
+    assert index.has(2, "convert:batch") and not index.has(2, "rates:ingest")
+    assert index.has(3, "rates:stream")
+    assert [error.split(":")[0] for error in index.stats()["invalid_roles"]] == ["role 1", "role 2"]
+
+
+def test_require_permission_dependency():
+    index = PermissionIndex()
+    index.compile([Role(id=1, name="viewer", permissions=[]), Role(id=2, name="user", permissions=None)])
+    app = FastAPI()
+    app.state.permission_index = index
+
+    @app.get("/batch", dependencies=[Depends(require_permission("convert:batch"))])
+    async def batch():
+        return {"ok": True}
+
+    client = TestClient(app)
+    app.dependency_overrides[current_user] = lambda: make_user(1, role_id=1)
+    assert client.get("/batch").status_code == 403
+    app.dependency_overrides[current_user] = lambda: make_user(2, role_id=2)
+    assert client.get("/batch").json() == {"ok": True}
+
+
+@pytest.mark.asyncio
+async def test_permission_index_hot_reload(user_session):
+    # Пустые права роли admin дали бы ей "*", поэтому права задаются явно
+    await user_session.execute(update(Role).where(Role.id == 9001).values(permissions=["convert"]))
+    await user_session.commit()
+    changes = []
+    index = PermissionIndex(on_change=changes.extend)
+    assert await index.reload()
+    assert not index.has(9001, "convert:batch")
+    assert not await index.reload()  # таблица role не менялась
+
+    await user_session.execute(update(Role).where(Role.id == 9001).values(permissions=["convert:batch"]))
+    await user_session.commit()
+    changes.clear()
+    assert await index.reload()
+    assert changes == [9001]
+    assert index.has(9001, "convert:batch")
@@ -1,12 +1,34 @@
+import asyncio
+import sys
+import time
+from datetime import datetime, timezone
+
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from starlette.datastructures import State
+from sqlalchemy import Column, Integer, MetaData, String, Table, delete, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
-from unittest.mock import patch, MagicMock
-from src.auth.models import User, Role
+from unittest.mock import patch, MagicMock, AsyncMock
+from src.auth.auth_config import current_user, get_access_strategy, get_refresh_strategy, revocation_list
+from src.auth.models import RevokedToken, User, Role
+from src.auth.rbac import PermissionIndex
+from src.auth.revocation import BloomFilter, RevocableJWTStrategy, RevocationList
 from src.auth.schemas import UserCreate
-from src.database import get_async_session
-from src.main import app, lifespan, create_clients_db
+from src.database import Base, engine, get_async_session, pool_stats
+from src.main import app, is_admin, lifespan, create_clients_db, profiler, templates
+from src.metrics import Histogram, http_request_duration, template_render_duration
+from src.pages import PageRenderer
+from src.profiling import ProfileSession
+from src.rates.audit import AuditLog
+from src.rates.cache import RateCache
+from src.rates.graph import RateGraph
+from src.rates.providers import RateRequestError
+from src.rates.service import build_result
+from src.rates.snapshot import save_snapshot
+from src.rates.stream import RateBroadcaster
+from src.rates.table import RateRefresher, RateTable
+from src.schema import SchemaMismatchError, bootstrap_schema, metadata_version, schema_version
 
 
 @pytest.fixture
@@ -64,8 +86,8 @@ async def test_admin(async_session: AsyncSession):
 
 @pytest.fixture
 def mock_currency_api():
-    with patch('main.requests.get') as mock_get:
-        yield mock_get
+    with patch('src.rates.client.UpstreamClient.fetch_rate', new_callable=AsyncMock) as mock_fetch_rate:
+        yield mock_fetch_rate
 
 
 @pytest.fixture
@@ -91,24 +113,84 @@ def mock_refresh_backend():
 
 @pytest.mark.asyncio
 async def test_create_clients_db():
-    # Мокируем все внешние зависимости
-    with patch('main.database_exists', return_value=False) as mock_db_exists, \
-            patch('main.create_database') as mock_create_db, \
-            patch('main.Base.metadata.create_all') as mock_create_all:
-        await create_clients_db()  # Вызываем тестируемую функцию
-        # Проверяем, что все моки были вызваны
-        mock_db_exists.assert_called_once()
-        mock_create_db.assert_called_once()
+    await create_clients_db()
+    # Версия схемы совпадает - старт без DDL и без проверки существования БД
+    with patch("src.schema.ensure_database") as mock_ensure_db, \
+            patch.object(Base.metadata, "create_all") as mock_create_all:
+        assert await bootstrap_schema(engine, Base.metadata) is False
+        mock_ensure_db.assert_not_called()
+        mock_create_all.assert_not_called()
+
+    # Модели изменились: из одновременно стартующих воркеров схему обновляет только один
+    async with engine.begin() as conn:
+        await conn.execute(delete(schema_version))
+    with patch.object(Base.metadata, "create_all", wraps=Base.metadata.create_all) as mock_create_all:
+        applied = await asyncio.gather(*(bootstrap_schema(engine, Base.metadata) for _ in range(4)))
+        assert sorted(applied) == [False, False, False, True]
         mock_create_all.assert_called_once()
+    async with engine.connect() as conn:
+        assert await conn.scalar(select(schema_version.c.version)) == metadata_version(Base.metadata)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_bootstrap_schema_rejects_changed_tables():
+    await create_clients_db()
+    # Колонка добавлена в модель уже существующей таблицы: create_all ее не добавит
+    metadata = MetaData()
+    Table("schema_check", metadata, Column("id", Integer, primary_key=True), Column("name", String(20)))
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE IF NOT EXISTS schema_check (id INTEGER PRIMARY KEY)"))
+    try:
+        with pytest.raises(SchemaMismatchError, match="schema_check.name is missing"):
+            await bootstrap_schema(engine, metadata)
+        async with engine.connect() as conn:
+            assert await conn.scalar(select(schema_version.c.version)) == metadata_version(Base.metadata)
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text("DROP TABLE schema_check"))
+        await engine.dispose()
 
 
 @pytest.mark.asyncio
 async def test_lifespan():
     mock_app = MagicMock(spec=FastAPI)
+    mock_app.state = State()  # lifespan складывает в state общие клиенты и кэши
     async with lifespan(mock_app) as _:
         pass
 
 
+@pytest.mark.asyncio
+async def test_lifespan_offline_from_snapshot(tmp_path):
+    # Офлайн-режим: таблица из снимка есть сразу после старта, к провайдерам запросов нет
+    path = str(tmp_path / "rates.snapshot")
+    save_snapshot(RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime(2024, 1, 1, tzinfo=timezone.utc)), path)
+    mock_app = MagicMock(spec=FastAPI)
+    mock_app.state = State()
+    with patch("src.main.settings.RATE_OFFLINE", True), patch("src.main.settings.RATE_SNAPSHOT_PATH", path):
+        async with lifespan(mock_app) as _:
+            assert mock_app.state.rate_refresher.table.rate("EUR", "USD") == 2.0
+            # Подписчики потока курсов получают таблицу из снимка сразу
+            assert mock_app.state.rate_broadcaster.table is mock_app.state.rate_refresher.table
+            assert await mock_app.state.rate_cache.get_rate("USD", "EUR") == 0.5
+            assert mock_app.state.rate_provider.stats()["order"] == ["snapshot"]
+            await asyncio.sleep(0.05)
+            assert mock_app.state.rate_refresher.stats()["failures"] == 0
+    assert mock_app.state.rate_snapshots.stats()["saves"] == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_stats():
+    async with engine.connect() as conn:
+        await conn.execute(text("select 1"))
+        stats = pool_stats()
+        assert stats["pool"] == "TimedAsyncQueuePool"
+        assert stats["checked_out"] == 1
+        assert stats["checkouts"] >= 1
+    assert pool_stats()["checked_out"] == 0
+    await engine.dispose()
+
+
 # Тесты для маршрутов
 
 
@@ -127,18 +209,14 @@ def test_protected_admin_route(client, test_admin):
 
 """
 
-url = f"https://api.apilayer.com/currency_data/convert?to={to}&from={from_}&amount={amount}"
-headers = {"apikey": settings.CURRENCY_API_KEY}
-response = requests.get(url, headers=headers)
-result = response.json()
+result = await convert(rate_cache, from_, to, amount)
 
 """
 
 def test_convert_for_user(client, test_user, mock_currency_api):
 
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"result": 100}
-    mock_currency_api.return_value = mock_response  # Когда тестируемый код вызовет requests.get() - получит mock_response
+    # Когда кэш курсов запросит курс у провайдера - получит это значение
+    mock_currency_api.return_value = 0.92
 
     with patch('main.current_user', return_value=test_user):
         response = client.post("/convert-for-user", data={"from_": "USD", "to": "EUR", "amount": "100"})
@@ -147,9 +225,7 @@ def test_convert_for_user(client, test_user, mock_currency_api):
 
 
 def test_convert_for_admin(client, test_admin, mock_currency_api):
-    mock_response = MagicMock()
-    mock_response.json.return_value = {"result": 100}
-    mock_currency_api.return_value = mock_response
+    mock_currency_api.return_value = 0.92
 
     with patch('main.current_user', return_value=test_admin), \
             patch('main.is_admin', return_value=True):
@@ -207,6 +283,332 @@ def test_protected_admin_unauthorized(client, test_user):
         assert response.status_code == 403
 
 
+@pytest.fixture
+def json_client():
+    # Приложение без lifespan: таблица курсов и права задаются напрямую, пользователь подменяется
+    refresher = RateRefresher(provider=None, interval=60)
+    refresher.table = RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    app.state.rate_refresher = refresher
+    app.state.rate_cache = RateCache(loader=AsyncMock(return_value=2.0))
+    app.state.permission_index = PermissionIndex()
+    app.state.permission_index.compile([Role(id=1, name="user", permissions=None)])
+    app.state.rate_broadcaster = RateBroadcaster(max_subscribers=1)
+    app.state.audit_log = AuditLog(engine=None)
+    app.state.page_renderer = PageRenderer(templates, ("converter.html", "converter_for_admin.html"))
+    app.dependency_overrides[current_user] = lambda: User(id=1, email="json@example.com", role_id=1, is_active=True)
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+
+
+def test_convert_json_conditional_requests(json_client):
+    response = json_client.get("/convert", params={"from": "usd", "to": "EUR", "amount": 10})
+    assert response.status_code == 200
+    assert response.json()["result"] == 5.0
+    etag = response.headers["etag"]
+    assert response.headers["last-modified"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+    assert response.headers["cache-control"].startswith("private, max-age=")
+    assert app.state.audit_log.queue.get_nowait()[:6] == (1, "USD", "EUR", 10.0, 0.5, 5.0)
+
+    with patch("src.main.convert") as mock_convert:
+        response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10},
+                                   headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10},
+                                   headers={"If-Modified-Since": "Tue, 02 Jan 2024 00:00:00 GMT"})
+        assert response.status_code == 304
+        mock_convert.assert_not_called()
+
+    # Новый снимок курсов - новый ETag
+    app.state.rate_refresher.table = RateTable.from_quotes(
+        "USD", {"USDEUR": 0.6}, datetime(2024, 1, 1, tzinfo=timezone.utc)
+    )
+    response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10},
+                               headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
+def test_convert_json_conditional_requests_graph_table(json_client):
+    # В таблице из графа курсов as_of - самая старая котировка, Last-Modified - самая свежая
+    graph = RateGraph(base="USD")
+    graph.update("USD", "EUR", 0.5, datetime(2024, 1, 10, tzinfo=timezone.utc))
+    graph.update("USD", "GBP", 0.8, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    app.state.rate_refresher.table = graph.table()
+    response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10})
+    assert response.headers["last-modified"] == "Wed, 10 Jan 2024 00:00:00 GMT"
+    etag = response.headers["etag"]
+    since = {"If-Modified-Since": "Thu, 11 Jan 2024 00:00:00 GMT"}
+    assert json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10},
+                           headers=since).status_code == 304
+
+    # Обновилась не самая старая котировка: as_of прежний, но ответ уже не 304
+    graph.update("USD", "EUR", 0.6, datetime(2024, 1, 20, tzinfo=timezone.utc))
+    app.state.rate_refresher.table = graph.table()
+    assert app.state.rate_refresher.table.as_of == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 10}, headers=since)
+    assert response.status_code == 200
+    assert response.json()["result"] == 6.0
+    assert response.headers["etag"] != etag
+    assert response.headers["last-modified"] == "Sat, 20 Jan 2024 00:00:00 GMT"
+
+
+def test_convert_form_without_permission(json_client):
+    app.state.permission_index.compile([Role(id=1, name="viewer", permissions=["rates:export"])])
+    response = json_client.post("/convert-for-user", data={"from_": "USD", "to": "EUR", "amount": "10"})
+    assert response.status_code == 403
+    assert response.headers["content-type"].startswith("text/html")
+
+
+def test_convert_json_errors(json_client):
+    # Таблица загружена: неизвестная ей валюта - 400 без запроса к провайдеру
+    for _ in range(3):
+        response = json_client.get("/convert", params={"from": "USD", "to": "ZZZ", "amount": 1})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Unknown currency: ZZZ"
+    app.state.rate_cache.loader.assert_not_called()
+
+    # До первой загрузки таблицы курс берется через кэш, без валидаторов снимка
+    app.state.rate_refresher.table = None
+    response = json_client.get("/convert", params={"from": "USD", "to": "XXX", "amount": 1})
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-cache"
+    assert "etag" not in response.headers
+    app.state.rate_cache.loader.side_effect = RateRequestError("Unknown currency: XXY")
+    response = json_client.get("/convert", params={"from": "USD", "to": "XXY", "amount": 1})
+    assert response.status_code == 400
+    assert json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": "x"}).status_code == 422
+    for amount in ("nan", "inf", "1e999"):
+        response = json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": amount})
+        assert response.status_code == 400
+        assert response.json()["detail"].startswith("Invalid amount")
+
+
+def test_convert_batch_rejects_non_finite_amounts(json_client):
+    body = '{"items": [{"from": "USD", "to": "EUR", "amount": "NaN"}, {"from": "USD", "to": "EUR", "amount": 1e999},' \
+           ' {"from": "USD", "to": "EUR", "amount": 2}]}'
+    response = json_client.post("/convert-batch", content=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [item["error"] for item in results] == ["Invalid amount: nan", "Invalid amount: inf", None]
+    assert results[0]["amount"] is None and results[0]["result"] is None
+    # В журнал попадает только строка с конечной суммой
+    assert app.state.audit_log.queue.qsize() == 1
+
+
+def test_page_renderer_matches_full_render():
+    pages = PageRenderer(templates, ("converter.html", "converter_for_admin.html"), max_size=4)
+    user = User(id=1, username="<b>ob", email="bob@example.com")
+    results = [None, build_result("USD", "EUR", 10.0, 0.5, 1704067200),
+               build_result("USD", "EUR", 10.0, 0.5, stale=True, age=12.6)]
+    for name in pages.pages:
+        for result in results:
+            expected = templates.get_template(name).render(user=user, result=result).encode()
+            assert pages.render_body(name, user, result) == expected
+            assert pages.render_body(name, user, result) == expected
+    assert b"&lt;b&gt;ob" in pages.render_body("converter.html", user)
+    assert pages.stats()["hits"] > 0
+    assert len(pages.cache) == 4
+
+
+def test_page_renderer_caches_stale_results_regardless_of_age():
+    pages = PageRenderer(templates, ("converter.html",))
+    user = User(id=1, username="bob", email="bob@example.com")
+    for age in (12.6, 13.6, 14.6):
+        result = build_result("USD", "EUR", 10.0, 0.5, stale=True, age=age)
+        body = pages.render_body("converter.html", user, result)
+        assert f"{round(age)} s old".encode() in body
+    # Блок result один на все три возраста, строка с возрастом в кэш не попадает
+    assert len(pages.cache) == 2
+    assert pages.stats()["hits"] == 4
+
+
+def test_protected_page_conditional_and_compressed(json_client):
+    response = json_client.get("/protected-user", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "<h1>No result</h1>" in response.text
+    etag = response.headers["etag"]
+
+    response = json_client.get("/protected-user", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = json_client.post("/convert-for-user", data={"from_": "USD", "to": "EUR", "amount": "10"},
+                                headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert "USD to EUR: 5.0" in response.text
+
+
+def test_token_routes_set_cookies(json_client):
+    refresh = asyncio.run(get_refresh_strategy().write_token(User(id=1)))
+    json_client.cookies.set("refresh_token", refresh)
+    with patch.object(revocation_list, "revoke", AsyncMock()) as revoke:
+        response = json_client.post("/auth/refresh")
+    assert response.status_code == 200
+    cookies = response.headers.get_list("set-cookie")
+    assert [cookie.split("=")[0] for cookie in cookies] == ["access_token", "refresh_token"]
+    # Использованный refresh токен отозван
+    revoke.assert_awaited_once()
+    assert revoke.await_args.args[0] == get_refresh_strategy().decode(refresh)["jti"]
+    json_client.cookies.clear()
+
+    response = json_client.post("/auth/access-token")
+    assert response.status_code == 200
+    assert response.headers["set-cookie"].startswith("access_token=")
+
+
+def test_logout_revokes_both_tokens(json_client):
+    user = User(id=1)
+    access = asyncio.run(get_access_strategy().write_token(user))
+    refresh = asyncio.run(get_refresh_strategy().write_token(user))
+    with patch.object(revocation_list, "revoke", AsyncMock()) as revoke:
+        json_client.cookies.update({"access_token": access, "refresh_token": refresh})
+        response = json_client.post("/auth/logout")
+    assert response.status_code == 200
+    assert [cookie.split("=")[0] for cookie in response.headers.get_list("set-cookie")] == \
+           ["access_token", "refresh_token"]
+    jtis = [get_access_strategy().decode(access)["jti"], get_refresh_strategy().decode(refresh)["jti"]]
+    assert [call.args[0] for call in revoke.await_args_list] == jtis
+
+
+# Тесты для отзыва токенов
+
+
+def test_revocation_list_bloom_filter_and_prune():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    keys = [f"key{n}" for n in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    assert sum(f"other{n}" in bloom for n in range(10000)) < 300
+
+    now = [1000.0]
+    revocations = RevocationList(capacity=2, clock=lambda: now[0])
+    assert not revocations.add("expired", 999.0)
+    for n in range(5):
+        revocations.add(f"jti{n}", 1000.0 + n + 1)
+    # Фильтр перестроен под выросшее число токенов
+    assert revocations.bloom.capacity >= 5
+    assert revocations.is_revoked("jti0") and not revocations.is_revoked("fresh") and not revocations.is_revoked(None)
+    now[0] = 1003.0
+    assert revocations.prune() == 3
+    assert not revocations.is_revoked("jti0") and revocations.is_revoked("jti4")
+    assert revocations.stats()["revoked"] == 2
+
+
+@pytest.mark.asyncio
+async def test_revoked_token_rejected_and_synced_to_other_workers():
+    async with engine.begin() as conn:
+        await conn.run_sync(RevokedToken.__table__.create, checkfirst=True)
+        await conn.execute(delete(RevokedToken))
+    user = User(id=7)
+    user_manager = MagicMock(parse_id=int, get=AsyncMock(return_value=user))
+    worker, other = RevocationList(), RevocationList()
+    await other.sync()
+    strategy = RevocableJWTStrategy(secret="secret", lifetime_seconds=60, revocations=worker)
+    token = await strategy.write_token(user)
+    assert await strategy.read_token(token, user_manager) is user
+
+    await strategy.destroy_token(token, user)
+    assert await strategy.read_token(token, user_manager) is None
+    # Другой воркер узнает об отзыве при следующей синхронизации
+    assert await other.sync() == 1
+    assert await RevocableJWTStrategy(secret="secret", lifetime_seconds=60, revocations=other) \
+        .read_token(token, user_manager) is None
+    assert other.stats()["bloom_hits"] == 1
+
+    await worker.revoke("expired", time.time() - 1, user.id)
+    assert await worker.prune_expired() == 1
+    await engine.dispose()
+
+
+def test_stream_rates_rejects_bad_requests(json_client):
+    assert json_client.get("/rates/stream", params={"pairs": "USDEU"}).status_code == 400
+    app.state.rate_broadcaster.subscribe([("USD", "EUR")])
+    assert json_client.get("/rates/stream", params={"pairs": "USDEUR"}).status_code == 503
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "Test", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(0.1, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5.0, "/a")
+    assert list(histogram.render()) == [
+        "# HELP test_seconds Test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1.0"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_sum{route="/a"} 5.6',
+        'test_seconds_count{route="/a"} 3',
+    ]
+
+
+def test_metrics_endpoint(json_client):
+    json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 1})
+    json_client.get("/protected-user")
+    json_client.get("/no-such-page")
+    # Метка маршрута - шаблон пути, а не строка запроса
+    assert http_request_duration.series[("GET", "/convert", 200)][-1] > 0
+    assert ("GET", "unmatched", 404) in http_request_duration.series
+    assert ("converter.html",) in template_render_duration.series
+
+    response = json_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_request_duration_seconds_count{method="GET",route="/convert",status="200"}' in response.text
+    assert "# TYPE rate_cache_hits gauge" in response.text
+    assert "pages_misses " in response.text
+    assert "bulk_convert_rows_per_second " in response.text
+
+    with patch("src.main.settings.METRICS_TOKEN", "secret"):
+        assert json_client.get("/metrics").status_code == 401
+        assert json_client.get("/metrics", headers={"Authorization": "Bearer secret"}).status_code == 200
+
+
+def test_profiler_trace_window(json_client):
+    assert json_client.post("/profiler/start").status_code == 403
+    app.dependency_overrides[is_admin] = lambda: True
+    response = json_client.post("/profiler/start", params={"mode": "trace", "route": "/convert"})
+    assert response.status_code == 200
+    assert json_client.post("/profiler/start").status_code == 409
+
+    json_client.get("/convert", params={"from": "USD", "to": "EUR", "amount": 1})
+    json_client.get("/protected-user")
+    assert json_client.post("/profiler/stop").json()["requests"] == 1
+    assert profiler.session is None
+
+    report = json_client.get("/profiler/report").text.splitlines()
+    assert report and all(line.startswith("GET /convert") for line in report)
+    assert any("convert_json_route (src/main.py:" in line for line in report)
+    assert json_client.post("/profiler/start", params={"route": "/nope"}).status_code == 400
+
+
+def test_profiler_sampling_selected_frames():
+    session = ProfileSession("sample", rate=0.5, duration=5, interval=0.001)
+
+    def busy():
+        deadline = time.perf_counter() + 0.1
+        while time.perf_counter() < deadline:
+            pass
+
+    def profiled():
+        session.enter(sys._getframe(), "GET /busy")
+        try:
+            busy()
+        finally:
+            session.leave(sys._getframe())
+
+    profiled()
+    busy()  # без отметки запроса в отчет не попадает
+    session.close()
+    lines = session.collapsed().splitlines()
+    assert lines and all(line.startswith("GET /busy") for line in lines)
+    assert any("test_profiler_sampling_selected_frames.<locals>.busy" in line for line in lines)
+    assert session.stats()["samples"] > 10
+    assert not session.stats()["active"]
+
+
 # Тесты для UserManager
 
 
@@ -0,0 +1,1147 @@
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import numpy as np
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from pydantic import ValidationError
+from aiohttp.test_utils import TestServer
+from sqlalchemy import delete, func, select
+from starlette.requests import Request
+
+from src.database import async_session_maker, engine
+from src.rates.audit import BLOCK, DROP, AuditLog
+from src.rates.breaker import CircuitBreaker, CircuitOpenError
+from src.rates.bulk import BulkConverter, BulkStats
+from src.rates.cache import RateCache
+from src.rates.client import UpstreamClient
+from src.rates.export import RateExporter, parse_pairs
+from src.rates.graph import RateGraph
+from src.rates.history import convert_at, ingest_rates, parse_moment, rate_as_of, table_rows
+from src.rates.models import ConversionAudit, Rate
+from src.rates.providers import ProviderRouter, Quotes, RateProvider, RateRequestError
+from src.rates.schemas import ConversionItem, RateHistoryItem
+from src.rates.service import convert, convert_batch
+from src.rates.shared import SharedRateFile, SharedRateRefresher
+from src.rates.snapshot import FORMAT_VERSION, RateSnapshots, SnapshotError, SnapshotProvider, load_snapshot, \
+    save_snapshot
+from src.rates.stream import RateBroadcaster
+from src.rates.table import RateRefresher, RateTable
+
+
+@pytest_asyncio.fixture
+async def fake_upstream():
+    # Локальная заглушка apilayer: /convert отвечает с задержкой и считает одновременные запросы
+    state = {"in_flight": 0, "max_in_flight": 0, "delay": 0.05}
+
+    async def convert(request):
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(state["delay"])
+        state["in_flight"] -= 1
+        amount = float(request.query["amount"])
+        return web.json_response({
+            "query": {"from": request.query["from"], "to": request.query["to"], "amount": amount},
+            "apikey": request.headers.get("apikey"),
+            "result": amount * 0.5,
+        })
+
+    app = web.Application()
+    app.router.add_get("/convert", convert)
+    server = TestServer(app)
+    await server.start_server()
+    state["url"] = str(server.make_url(""))
+    yield state
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_upstream_client_convert(fake_upstream):
+    client = UpstreamClient(base_url=fake_upstream["url"], api_key="secret")
+    try:
+        result = await client.convert("USD", "EUR", "100")
+    finally:
+        await client.aclose()
+    assert result["query"] == {"from": "USD", "to": "EUR", "amount": 100.0}
+    assert result["apikey"] == "secret"
+    assert result["result"] == 50.0
+
+
+@pytest.mark.asyncio
+async def test_upstream_client_bounded_concurrency(fake_upstream):
+    client = UpstreamClient(base_url=fake_upstream["url"], api_key="secret", max_concurrency=3)
+    try:
+        await asyncio.gather(*(client.convert("USD", "EUR", "1") for _ in range(10)))
+    finally:
+        await client.aclose()
+    assert fake_upstream["max_in_flight"] == 3
+
+
+@pytest.mark.asyncio
+async def test_upstream_client_timeout(fake_upstream):
+    fake_upstream["delay"] = 1
+    client = UpstreamClient(base_url=fake_upstream["url"], api_key="secret")
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await client.get_json("/convert", {"from": "USD", "to": "EUR", "amount": "1"}, timeout=0.05)
+    finally:
+        await client.aclose()
+
+
+# Тесты для нескольких провайдеров курсов
+
+
+class FakeProvider(RateProvider):
+    # Провайдер с настраиваемой задержкой и ошибками; failures - сколько первых запросов завершатся ошибкой
+    def __init__(self, name: str, rate: float, delay: float = 0.0, failures: int = 0):
+        self.name = name
+        self.rate = rate
+        self.delay = delay
+        self.failures = failures
+        self.calls = 0
+
+    async def fetch_rate(self, from_, to):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError(f"{self.name} is down")
+        return self.rate
+
+    async def fetch_table(self, source):
+        rate = await self.fetch_rate(source, "EUR")
+        return Quotes(source=source, quotes={f"{source}EUR": rate}, as_of=datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+
+@pytest.mark.asyncio
+async def test_provider_router_uses_priority_order():
+    primary, secondary = FakeProvider("primary", 0.9), FakeProvider("secondary", 0.8)
+    router = ProviderRouter([primary, secondary], hedge_delay=1)
+
+    assert await router.fetch_rate("USD", "EUR") == 0.9
+    assert (primary.calls, secondary.calls) == (1, 0)
+
+
+@pytest.mark.asyncio
+async def test_provider_router_fails_over():
+    primary, secondary = FakeProvider("primary", 0.9, failures=1), FakeProvider("secondary", 0.8)
+    router = ProviderRouter([primary, secondary], hedge_delay=1)
+
+    assert await router.fetch_rate("USD", "EUR") == 0.8
+    stats = router.stats()["providers"]
+    assert stats["primary"]["errors"] == 1
+    assert stats["primary"]["last_error"] == "primary is down"
+    assert stats["secondary"]["requests"] == 1
+
+
+@pytest.mark.asyncio
+async def test_provider_router_raises_when_all_fail():
+    router = ProviderRouter([FakeProvider("a", 1, failures=1), FakeProvider("b", 1, failures=1)])
+    with pytest.raises(ConnectionError, match="b is down"):
+        await router.fetch_rate("USD", "EUR")
+
+
+@pytest.mark.asyncio
+async def test_provider_router_hedges_slow_requests():
+    primary, secondary = FakeProvider("primary", 0.9, delay=1), FakeProvider("secondary", 0.8, delay=0.01)
+    router = ProviderRouter([primary, secondary], hedge_delay=0.05)
+
+    started = asyncio.get_running_loop().time()
+    assert await router.fetch_rate("USD", "EUR") == 0.8
+    assert asyncio.get_running_loop().time() - started < 0.5
+    await asyncio.sleep(0)  # отмененный основной запрос успевает завершиться
+    stats = router.stats()["providers"]
+    assert stats["primary"]["cancelled"] == 1
+    assert (stats["secondary"]["hedges"], stats["secondary"]["hedge_wins"]) == (1, 1)
+
+    # Без страховки ждем медленного провайдера
+    router = ProviderRouter([FakeProvider("primary", 0.9, delay=0.1), secondary], hedge=False)
+    assert await router.fetch_rate("USD", "EUR") == 0.9
+
+
+@pytest.mark.asyncio
+async def test_provider_router_hedge_budget_and_demotion():
+    primary, secondary = FakeProvider("primary", 0.9), FakeProvider("secondary", 0.8)
+    router = ProviderRouter([primary, secondary], hedge_delay=0.5, min_samples=5, max_error_rate=0.5)
+    assert router.hedge_after(primary) == 0.5
+    for latency in (0.01, 0.02, 0.03, 0.04, 0.2):
+        router.provider_stats["primary"].record(latency)
+    assert router.hedge_after(primary) == 0.2  # p95 последних запросов
+
+    for _ in range(10):
+        router.provider_stats["primary"].record(0.01, ConnectionError("down"))
+    assert router.stats()["order"] == ["secondary", "primary"]
+    assert await router.fetch_rate("USD", "EUR") == 0.8
+
+
+def test_circuit_breaker_states():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    clock.now = 30
+    assert breaker.allow()  # пробный запрос
+    assert not breaker.allow()  # второй запрос ждет результата пробного
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now = 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+    assert breaker.stats()["opens"] == 2
+
+
+@pytest.mark.asyncio
+async def test_provider_router_skips_open_circuits():
+    primary, secondary = FakeProvider("primary", 0.9, failures=100), FakeProvider("secondary", 0.8, failures=100)
+    router = ProviderRouter([primary, secondary], failure_threshold=2, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await router.fetch_rate("USD", "EUR")
+    assert (primary.calls, secondary.calls) == (2, 2)
+
+    # Все цепи разомкнуты: запрос завершается сразу, провайдеры не вызываются
+    with pytest.raises(CircuitOpenError):
+        await router.fetch_rate("USD", "EUR")
+    assert (primary.calls, secondary.calls) == (2, 2)
+    assert router.stats()["providers"]["primary"]["circuit"]["state"] == "open"
+
+
+@pytest.mark.asyncio
+async def test_provider_router_rejection_keeps_circuit_closed():
+    class RejectingProvider(FakeProvider):
+        async def fetch_rate(self, from_, to):
+            raise RateRequestError(f"Unknown currency: {to}")
+
+    router = ProviderRouter([RejectingProvider("primary", 0)], failure_threshold=1)
+    for _ in range(3):
+        with pytest.raises(RateRequestError):
+            await router.fetch_rate("USD", "XXX")
+    assert router.breakers["primary"].state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_convert_flags_stale_rates():
+    clock = FakeClock()
+    cache = RateCache(AsyncMock(return_value=0.5), ttl=60, clock=clock)
+    await cache.get_rate("USD", "EUR")
+    clock.now = 90
+    result = await convert(cache, "usd", "eur", "10")
+    assert result["result"] == 5.0
+    assert result["info"] == {"quote": 0.5, "stale": True, "age": 90}
+
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    assert "stale" not in (await convert(cache, "USD", "EUR", "1", table, max_age=120))["info"]
+    table.loaded_at -= 300
+    assert (await convert(cache, "USD", "EUR", "1", table, max_age=120))["info"]["stale"]
+
+
+@pytest.mark.asyncio
+async def test_rate_refresher_uses_provider_router():
+    router = ProviderRouter([FakeProvider("primary", 0.9, failures=1), FakeProvider("secondary", 0.8)])
+    refresher = RateRefresher(router, jitter=0)
+    table = await refresher.refresh()
+    assert table.rate("USD", "EUR") == 0.8
+
+
+# Тесты для кэша курсов
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_ttl():
+    clock = FakeClock()
+    loader = AsyncMock(return_value=0.9)
+    cache = RateCache(loader, ttl=60, stale_ttl=0, clock=clock)
+
+    assert await cache.get_rate("USD", "EUR") == 0.9
+    assert await cache.get_rate("USD", "EUR") == 0.9
+    loader.assert_awaited_once_with("USD", "EUR")
+
+    clock.now = 61
+    await cache.get_rate("USD", "EUR")
+    assert loader.await_count == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_serves_stale_while_revalidating():
+    clock = FakeClock()
+    loader = AsyncMock(return_value=0.9)
+    cache = RateCache(loader, ttl=60, stale_ttl=600, clock=clock)
+    await cache.get_rate("USD", "EUR")
+
+    # Провайдер недоступен: просроченный курс отдается сразу, обновление идет в фоне
+    clock.now = 100
+    loader.side_effect = CircuitOpenError("All rate providers are unavailable")
+    lookup = await cache.lookup("USD", "EUR")
+    assert (lookup.rate, lookup.age, lookup.stale) == (0.9, 100, True)
+    await asyncio.sleep(0.01)
+    assert loader.await_count == 2
+    assert cache.stats()["revalidation_errors"] == 1
+
+    # Провайдер восстановился: фоновое обновление подменяет курс
+    loader.side_effect = None
+    loader.return_value = 0.95
+    assert (await cache.lookup("USD", "EUR")).stale
+    await asyncio.sleep(0.01)
+    lookup = await cache.lookup("USD", "EUR")
+    assert (lookup.rate, lookup.stale) == (0.95, False)
+    assert cache.stats()["stale_hits"] == 2
+
+    # Слишком старый курс не отдается
+    clock.now = 1000
+    loader.side_effect = CircuitOpenError("All rate providers are unavailable")
+    with pytest.raises(CircuitOpenError):
+        await cache.get_rate("USD", "EUR")
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_lru_eviction():
+    loader = AsyncMock(return_value=1.0)
+    cache = RateCache(loader, max_size=2)
+
+    await cache.get_rate("USD", "EUR")
+    await cache.get_rate("USD", "GBP")
+    await cache.get_rate("USD", "EUR")  # USD/EUR становится самой свежей парой
+    await cache.get_rate("USD", "JPY")  # вытесняет USD/GBP
+
+    assert cache.stats()["evictions"] == 1
+    await cache.get_rate("USD", "EUR")
+    assert loader.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_single_flight():
+    release = asyncio.Event()
+
+    async def loader(from_, to):
+        await release.wait()
+        return 0.9
+
+    cache = RateCache(loader)
+    waiters = [asyncio.ensure_future(cache.get_rate("USD", "EUR")) for _ in range(100)]
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*waiters) == [0.9] * 100
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["coalesced"] == 99
+
+
+@pytest.mark.asyncio
+async def test_rate_cache_does_not_store_errors():
+    loader = AsyncMock(side_effect=[ValueError("upstream down"), 0.9])
+    cache = RateCache(loader)
+
+    with pytest.raises(ValueError):
+        await cache.get_rate("USD", "EUR")
+    assert await cache.get_rate("USD", "EUR") == 0.9
+
+
+@pytest.mark.asyncio
+async def test_convert_multiplies_locally():
+    loader = AsyncMock(return_value=0.5)
+    cache = RateCache(loader)
+
+    result = await convert(cache, "usd", "eur", "10")
+    assert result["query"] == {"from": "USD", "to": "EUR", "amount": 10.0}
+    assert result["result"] == 5.0
+    loader.assert_awaited_once_with("USD", "EUR")
+
+
+# Тесты для таблицы курсов и фонового обновления
+
+
+def test_rate_table_cross_rates():
+    as_of = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5, "USDJPY": 150.0}, as_of)
+
+    assert table.codes == ("EUR", "JPY", "USD")
+    assert table.rate("USD", "EUR") == 0.5
+    assert table.rate("EUR", "USD") == 2.0
+    assert table.rate("EUR", "JPY") == pytest.approx(300.0)
+    assert "GBP" not in table
+
+
+@pytest.mark.asyncio
+async def test_convert_prefers_rate_table():
+    loader = AsyncMock(return_value=0.1)
+    cache = RateCache(loader)
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime.now(timezone.utc))
+
+    result = await convert(cache, "EUR", "USD", "10", table)
+    assert result["result"] == 20.0
+    loader.assert_not_awaited()
+
+    # Валюты нет в загруженной таблице - ошибка без запроса к провайдеру
+    with pytest.raises(ValueError, match="Unknown currency: GBP"):
+        await convert(cache, "USD", "GBP", "10", table)
+    loader.assert_not_awaited()
+
+    # Таблица еще не загружена - курс берется через кэш
+    result = await convert(cache, "USD", "GBP", "10")
+    assert result["result"] == 1.0
+    loader.assert_awaited_once_with("USD", "GBP")
+
+
+@pytest.mark.asyncio
+async def test_rate_refresher_refresh_and_backoff():
+    upstream = UpstreamClient(base_url="http://upstream", api_key="key")
+    upstream.get_json = AsyncMock(return_value={
+        "success": True, "timestamp": 1704067200, "source": "USD", "quotes": {"USDEUR": 0.5},
+    })
+    refresher = RateRefresher(upstream, interval=60, jitter=0)
+
+    table = await refresher.refresh()
+    upstream.get_json.assert_awaited_once_with("/live", {"source": "USD"})
+    assert refresher.table is table
+    assert refresher.stats()["rates_as_of"] == "2024-01-01T00:00:00+00:00"
+    assert refresher.next_delay() == 60
+
+    refresher.failures = 1
+    assert refresher.next_delay() == 6
+    refresher.failures = 3
+    assert refresher.next_delay() == 24
+    refresher.failures = 20
+    assert refresher.next_delay() == refresher.max_backoff
+
+
+@pytest.mark.asyncio
+async def test_rate_refresher_keeps_last_table_on_failure():
+    upstream = UpstreamClient(base_url="http://upstream", api_key="key")
+    responses = [{"success": True, "timestamp": 1704067200, "source": "USD", "quotes": {"USDEUR": 0.5}}]
+
+    async def get_json(path, params):
+        if responses:
+            return responses.pop()
+        raise ValueError("upstream down")
+
+    upstream.get_json = get_json
+    refresher = RateRefresher(upstream, interval=0.01, jitter=0)
+    refresher.start()
+    await asyncio.sleep(0.05)
+    await refresher.stop()
+
+    assert refresher.table.rate("USD", "EUR") == 0.5
+    assert refresher.failures >= 1
+    assert refresher.last_error == "upstream down"
+
+
+# Тесты для графа курсов
+
+
+def at(seconds: int) -> datetime:
+    return datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=seconds)
+
+
+def test_rate_graph_uses_freshest_path():
+    graph = RateGraph(base="USD")
+    graph.update("USD", "EUR", 0.5, at(10))
+    graph.update("EUR", "XAU", 0.001, at(10))
+    graph.update("USD", "GBP", 0.8, at(1))
+    graph.update("EUR", "GBP", 1.5, at(9))
+
+    # XAU котируется только к EUR, GBP свежее через EUR, чем напрямую
+    assert graph.rate("USD", "XAU") == pytest.approx(0.0005)
+    assert graph.rate("USD", "GBP") == pytest.approx(0.75)
+    assert graph.as_of("USD", "GBP") == at(9)
+    assert graph.rate("XAU", "USD") == pytest.approx(2000)
+
+    graph.update("USD", "GBP", 0.7, at(20))
+    assert graph.rate("USD", "GBP") == pytest.approx(0.7)
+    assert graph.rate("EUR", "GBP") == pytest.approx(1.4)
+    assert graph.stats()["tree_changes"] == 2
+
+    graph.update("JPY", "CHF", 0.006, at(30))
+    table = graph.table()
+    assert table.codes == ("EUR", "GBP", "USD", "XAU")
+    assert table.rate("GBP", "XAU") == pytest.approx(0.001 / 1.4)
+    assert table.timestamp("USD", "GBP") == int(at(20).timestamp())
+    assert table.as_of == at(10)
+
+
+def test_rate_graph_incremental_updates_match_rebuild():
+    rng = random.Random(1)
+    codes = [f"C{i:02d}" for i in range(40)]
+    true = {code: rng.uniform(0.1, 10) for code in codes}
+    graph = RateGraph(base="C00", capacity=8)
+    for _ in range(600):
+        from_, to = rng.sample(codes[:15] if rng.random() < 0.7 else codes, 2)
+        graph.update(from_, to, true[to] / true[from_], at(rng.randint(0, 1000)), rng.choice(["a", "b"]))
+    n = len(graph.codes)
+    matrix, freshness = graph.matrix[:n, :n].copy(), graph.freshness[:n, :n].copy()
+    assert graph.rows_updated < 600 * n
+
+    graph.rebuild()
+    np.testing.assert_allclose(matrix, graph.matrix[:n, :n], rtol=1e-9)
+    np.testing.assert_array_equal(freshness, graph.freshness[:n, :n])
+    assert graph.rate("C03", "C07") == pytest.approx(true["C07"] / true["C03"])
+
+
+def test_rate_graph_flags_inconsistent_triangles():
+    graph = RateGraph(base="USD", max_deviation=0.01)
+    graph.update_quotes(Quotes("USD", {"USDEUR": 0.5, "USDGBP": 0.4, "USDJPY": 150.0}, at(0), provider="a"))
+    graph.update_quotes(Quotes("EUR", {"EURGBP": 0.8, "EURJPY": 306.0}, at(0), provider="b"))
+
+    assert graph.check_consistency() == [
+        {"currencies": ["USD", "EUR", "JPY"], "deviation": pytest.approx(0.02), "sources": ["a", "b", "a"]},
+    ]
+    assert graph.stats()["sources"] == ["a", "b"]
+
+
+class TableProvider(RateProvider):
+    def __init__(self, name: str, source: str, quotes: dict):
+        self.name = name
+        self.quotes = Quotes(source, quotes, at(0), provider=name)
+
+    async def fetch_rate(self, from_, to):
+        return self.quotes.quotes[from_ + to]
+
+    async def fetch_table(self, source):
+        return self.quotes
+
+
+@pytest.mark.asyncio
+async def test_rate_provider_interface():
+    class RateOnlyProvider(RateProvider):
+        async def fetch_rate(self, from_, to):
+            return 1.0
+
+    # Провайдер без fetch_table не создается, а не падает при первом обновлении
+    with pytest.raises(TypeError):
+        RateOnlyProvider()
+
+    # Одиночный провайдер отдает графу курсов свою единственную таблицу
+    refresher = RateRefresher(TableProvider("usd", "USD", {"USDEUR": 0.5}), jitter=0, graph=RateGraph(base="USD"))
+    await refresher.refresh()
+    assert refresher.table.rate("EUR", "USD") == pytest.approx(2.0)
+
+
+@pytest.mark.asyncio
+async def test_rate_refresher_merges_providers_into_graph():
+    router = ProviderRouter([
+        TableProvider("usd", "USD", {"USDEUR": 0.5}),
+        TableProvider("eur", "EUR", {"EURXAU": 0.001}),
+        FakeProvider("down", 0.9, failures=1),
+    ])
+    refresher = RateRefresher(router, jitter=0, graph=RateGraph(base="USD"))
+    table = await refresher.refresh()
+    assert table.rate("USD", "XAU") == pytest.approx(0.0005)
+    assert router.stats()["providers"]["down"]["errors"] == 1
+
+
+# Тесты для общей таблицы курсов
+
+
+def test_shared_rate_file_publish_and_read(tmp_path):
+    path = str(tmp_path / "rates")
+    writer, reader = SharedRateFile(path, capacity=4), SharedRateFile(path, capacity=16)
+    assert reader.read() is None
+
+    writer.publish(RateTable.from_quotes("USD", {"USDEUR": 0.5, "USDJPY": 150.0}, at(0)))
+    view = reader.read()
+    assert reader.capacity == 4
+    assert view.codes == ("EUR", "JPY", "USD")
+    assert view.rate("EUR", "JPY") == pytest.approx(300.0)
+    assert view.timestamp("USD", "EUR") == int(at(0).timestamp())
+    assert not view.matrix.flags.owndata
+    assert reader.read() is view
+
+    writer.publish(RateTable.from_quotes("USD", {"USDEUR": 0.6}, at(1)))
+    assert reader.read().rate("USD", "EUR") == 0.6
+    assert view.rate("USD", "EUR") == 0.5
+    # Через две публикации слот старого снимка переписан - курс берется из актуального
+    writer.publish(RateTable.from_quotes("USD", {"USDEUR": 0.7}, at(2)))
+    assert not view.valid()
+    assert view.rate("USD", "EUR") == 0.7
+    assert view.timestamp("USD", "EUR") == int(at(2).timestamp())
+    # В актуальном снимке JPY уже нет: ошибка неизвестной валюты, а не KeyError
+    with pytest.raises(ValueError, match="Unknown currency: JPY"):
+        view.rate("USD", "JPY")
+    with pytest.raises(ValueError, match="Unknown currency: JPY"):
+        view.timestamp("JPY", "EUR")
+    assert reader.read().generation == 3
+
+    with pytest.raises(ValueError):
+        writer.publish(RateTable.from_quotes("USD", {f"USD{code}": 1.0 for code in ("A", "B", "C", "D")}, at(3)))
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_refresher_elects_one_writer(tmp_path):
+    path = str(tmp_path / "rates")
+    updates = []
+
+    async def on_update(table):
+        updates.append(table.rate("USD", "EUR"))
+
+    providers = [FakeProvider("first", 0.9), FakeProvider("second", 0.8)]
+    workers = [
+        SharedRateRefresher(RateRefresher(provider, interval=60, jitter=0), path, poll_interval=0.01,
+                            on_update=on_update)
+        for provider in providers
+    ]
+    for worker in workers:
+        worker.start()
+    await asyncio.sleep(0.05)
+    assert [worker.leader for worker in workers] == [True, False]
+    assert workers[1].table.rate("USD", "EUR") == 0.9
+    assert updates == [0.9]
+    assert (providers[0].calls, providers[1].calls) == (1, 0)
+
+    # Писатель остановился - блокировку забирает другой воркер и начинает обновлять таблицу сам
+    await workers[0].stop()
+    await asyncio.sleep(0.05)
+    assert workers[1].leader
+    assert workers[1].table.rate("USD", "EUR") == 0.8
+    assert workers[1].stats()["role"] == "writer"
+    await workers[1].stop()
+
+
+@pytest.mark.asyncio
+async def test_shared_rate_refresher_restores_snapshot(tmp_path):
+    path = str(tmp_path / "rates")
+    updates = []
+
+    async def on_update(table):
+        updates.append(table.rate("USD", "EUR"))
+
+    # Провайдер отвечает дольше теста: до первого обновления есть только таблица из снимка
+    worker = SharedRateRefresher(RateRefresher(FakeProvider("slow", 0.9, delay=60), interval=60, jitter=0), path,
+                                 on_update=on_update)
+    await worker.restore(make_table(0.5))
+    assert updates == [0.5]
+    worker.start()
+    assert worker.leader
+    assert worker.shared.read().rate("USD", "EUR") == 0.5
+    await worker.stop()
+
+
+# Тесты для снимков курсов на диске
+
+
+def test_rate_snapshot_round_trip_and_corruption(tmp_path):
+    path = str(tmp_path / "rates.snapshot")
+    graph = RateGraph(base="USD")
+    graph.update_quotes(Quotes("USD", {"USDEUR": 0.5, "USDGBP": 0.4}, at(0), provider="a"))
+    graph.update_quotes(Quotes("EUR", {"EURXAU": 0.001}, at(60), provider="b"))
+    table = graph.table()
+    table.loaded_at -= 100
+
+    save_snapshot(table, path)
+    loaded = load_snapshot(path)
+    assert (loaded.source, loaded.codes, loaded.as_of, loaded.version) == \
+           (table.source, table.codes, table.as_of, table.version)
+    np.testing.assert_array_equal(loaded.matrix, table.matrix)
+    assert loaded.timestamp("USD", "XAU") == table.timestamp("USD", "XAU")
+    # Возраст считается от самой свежей котировки, а не от чтения снимка
+    assert loaded.modified_at == at(60)
+    assert loaded.age() == pytest.approx(time.time() - at(60).timestamp(), abs=1)
+
+    data = bytearray(open(path, "rb").read())
+    for offset, value, message in ((len(data) - 1, data[-1] ^ 1, "checksum"), (8, FORMAT_VERSION + 1, "format")):
+        broken = bytearray(data)
+        broken[offset] = value
+        open(path, "wb").write(broken)
+        with pytest.raises(SnapshotError, match=message):
+            load_snapshot(path)
+    open(path, "wb").write(data[:-8])
+    with pytest.raises(SnapshotError, match="truncated"):
+        load_snapshot(path)
+    assert RateSnapshots(path).load() is None
+
+
+@pytest.mark.asyncio
+async def test_rate_snapshots_save_interval_and_offline_provider(tmp_path):
+    path = str(tmp_path / "rates.snapshot")
+    snapshots = RateSnapshots(path, interval=60)
+    assert snapshots.load() is None
+    assert await snapshots.save(make_table(0.5))
+    assert not await snapshots.save(make_table(0.6))
+    assert await snapshots.save(make_table(0.7), force=True)
+    assert snapshots.stats()["saves"] == 2
+    assert not await RateSnapshots(path, read_only=True).save(make_table(0.8), force=True)
+
+    # Офлайн-режим: обычный RateRefresher, но котировки берутся из файла снимка
+    provider = SnapshotProvider(path)
+    refresher = RateRefresher(provider, jitter=0)
+    table = await refresher.refresh()
+    assert table.rate("USD", "EUR") == pytest.approx(0.7)
+    # Перечитанный снимок не молодеет: котировки 2024 года помечаются как stale
+    assert table.age() > refresher.max_age
+    assert refresher.stats()["stale"]
+    assert await provider.fetch_rate("EUR", "USD") == pytest.approx(1 / 0.7)
+    with pytest.raises(RateRequestError):
+        await provider.fetch_rate("USD", "JPY")
+    save_snapshot(make_table(0.9), path)
+    assert await provider.fetch_rate("USD", "EUR") == pytest.approx(0.9)
+
+
+# Тесты для пакетной конвертации
+
+
+@pytest.mark.asyncio
+async def test_convert_batch_looks_up_each_pair_once():
+    loader = AsyncMock(side_effect=lambda from_, to: {("USD", "EUR"): 0.5, ("EUR", "USD"): 2.0}[(from_, to)])
+    cache = RateCache(loader)
+    items = [ConversionItem(**{"from": "usd", "to": "eur", "amount": n}) for n in range(1, 4)]
+    items.append(ConversionItem(**{"from": "EUR", "to": "USD", "amount": 10}))
+
+    results = await convert_batch(cache, items)
+
+    assert [row["result"] for row in results] == [0.5, 1.0, 1.5, 20.0]
+    assert results[0] == {"from": "USD", "to": "EUR", "amount": 1.0, "rate": 0.5, "result": 0.5, "error": None}
+    assert loader.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_convert_batch_unknown_currency():
+    cache = RateCache(AsyncMock())
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime.now(timezone.utc))
+    items = [
+        ConversionItem(**{"from": "USD", "to": "EUR", "amount": 2}),
+        ConversionItem(**{"from": "USD", "to": "XXX", "amount": 2}),
+    ]
+
+    results = await convert_batch(cache, items, table)
+
+    assert results[0]["result"] == 1.0 and results[0]["error"] is None
+    assert results[1]["result"] is None
+    assert results[1]["error"] == "Unknown currency: XXX"
+    cache.loader.assert_not_awaited()
+
+
+# Тесты для потока курсов
+
+
+def make_table(rate: float) -> RateTable:
+    return RateTable.from_quotes("USD", {"USDEUR": rate, "USDGBP": rate / 2}, datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+
+@pytest.mark.asyncio
+async def test_rate_broadcaster_skips_ticks_for_slow_subscribers():
+    broadcaster = RateBroadcaster(queue_size=1)
+    broadcaster.publish(make_table(0.5))
+    subscription = broadcaster.subscribe([("USD", "EUR"), ("EUR", "GBP"), ("USD", "XXX")])
+    assert subscription.queue.qsize() == 1  # текущие курсы сразу после подписки
+
+    for rate in (0.6, 0.7, 0.8):
+        broadcaster.publish(make_table(rate))
+    table = subscription.queue.get_nowait()
+    assert subscription.message(table)["rates"] == {"USDEUR": 0.8, "EURGBP": 0.5}
+    assert broadcaster.stats()["dropped"] == 3
+
+
+@pytest.mark.asyncio
+async def test_rate_broadcaster_events():
+    broadcaster = RateBroadcaster()
+    subscription = broadcaster.subscribe([("USD", "EUR")])
+    events = broadcaster.events(subscription, heartbeat=0.01)
+
+    assert await events.__anext__() == b": keep-alive\n\n"
+    broadcaster.publish(make_table(0.5))
+    event = await events.__anext__()
+    assert event.startswith(b"event: rates\ndata: ")
+    assert json.loads(event.split(b"data: ")[1]) == {"as_of": "2024-01-01T00:00:00+00:00", "rates": {"USDEUR": 0.5}}
+
+    await events.aclose()  # клиент отключился
+    assert broadcaster.stats()["subscribers"] == 0
+
+    # Сервер не сообщил об ошибке записи, но запрос знает об отключении клиента
+    subscription = broadcaster.subscribe([("USD", "EUR")])
+    events = broadcaster.events(subscription, heartbeat=0.01, is_disconnected=AsyncMock(return_value=True))
+    assert [event async for event in events] == []
+    assert broadcaster.stats()["subscribers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_broadcaster_thousands_of_subscribers():
+    subscribers, ticks = 5000, 20
+    broadcaster = RateBroadcaster(max_subscribers=subscribers)
+    received = [0] * subscribers
+    pairs = [("USD", "EUR"), ("USD", "GBP")]
+
+    async def consume(index, events):
+        async for _ in events:
+            received[index] += 1
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    consumers = [
+        asyncio.create_task(consume(i, broadcaster.events(broadcaster.subscribe(pairs), heartbeat=60)))
+        for i in range(subscribers)
+    ]
+    await asyncio.sleep(0)
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / subscribers
+    tracemalloc.stop()
+
+    publish_time = 0.0
+    for tick in range(ticks):
+        started = time.perf_counter()
+        broadcaster.publish(make_table(0.5 + tick / 100))
+        publish_time += time.perf_counter() - started
+        # Каждый второй тик публикуется до того, как подписчики успели его прочитать
+        if tick % 2:
+            await asyncio.sleep(0)
+
+    await asyncio.sleep(0.1)
+    assert all(0 < count <= ticks for count in received)
+    assert min(received) < ticks  # промежуточные тики пропущены, а не накоплены
+    assert broadcaster.stats()["subscribers"] == subscribers
+    print(f"{per_connection:.0f} bytes per subscriber, "
+          f"{publish_time / ticks / subscribers * 1e6:.2f} us per subscriber per publish")
+    assert per_connection < 16 * 1024
+    assert publish_time / ticks / subscribers < 50e-6
+
+    for consumer in consumers:
+        consumer.cancel()
+    await asyncio.gather(*consumers, return_exceptions=True)
+    assert broadcaster.stats()["subscribers"] == 0
+
+    broadcaster = RateBroadcaster(max_subscribers=1)
+    broadcaster.subscribe(pairs)
+    with pytest.raises(OverflowError):
+        broadcaster.subscribe(pairs)
+
+
+# Тесты для потоковой конвертации выгрузок
+
+
+def make_upload_request(*chunks: bytes, disconnect_after: int = None) -> Request:
+    # Request, тело которого приходит кусками, как при загрузке большого файла
+    messages = [{"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+    if disconnect_after is not None:
+        messages = messages[:disconnect_after] + [{"type": "http.disconnect"}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    return Request({"type": "http", "method": "POST", "headers": []}, receive)
+
+
+def make_bulk_converter(request: Request, fmt: str, chunk_rows: int = 2, audit_log: AuditLog = None,
+                        throughput: BulkStats = None) -> BulkConverter:
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5, "USDGBP": 0.25}, datetime.now(timezone.utc))
+    return BulkConverter(request, RateCache(AsyncMock()), table, ["EUR", "GBP"], fmt=fmt, chunk_rows=chunk_rows,
+                         audit_log=audit_log, user_id=7, throughput=throughput or BulkStats())
+
+
+async def collect(converter: BulkConverter) -> str:
+    return b"".join([chunk async for chunk in converter.stream()]).decode()
+
+
+@pytest.mark.asyncio
+async def test_bulk_convert_csv():
+    request = make_upload_request(
+        b"id,currency,amount\r\n1,USD,10\r\n2,u",
+        b'sd,4\r\n3,XXX,1\r\n"4\nmultiline",USD,abc\r\n',
+        "5 \x0b\x1c\u2028,USD,2\r\n".encode(),
+    )
+    converter = make_bulk_converter(request, "csv")
+    await converter.start()
+
+    assert await collect(converter) == (
+        "id,currency,amount,amount_EUR,amount_GBP,conversion_error\r\n"
+        "1,USD,10,5.0,2.5,\r\n"
+        "2,usd,4,2.0,1.0,\r\n"
+        "3,XXX,1,,,Unknown currency: XXX\r\n"
+        '"4\nmultiline",USD,abc,,,Invalid amount: abc\r\n'
+        # Разделители строк Unicode внутри значения не разрывают запись
+        "5 \x0b\x1c\u2028,USD,2,1.0,0.5,\r\n"
+    )
+    assert converter.rows == 5
+
+
+@pytest.mark.asyncio
+async def test_bulk_convert_records_audit():
+    audit_log = AuditLog(engine=None)
+    request = make_upload_request(b'{"currency": "USD", "amount": 10}\n{"currency": "XXX", "amount": 1}\n'
+                                  b'{"currency": "USD", "amount": 4}\n{"currency": "USD", "amount": "inf"}\n')
+    converter = make_bulk_converter(request, "ndjson", audit_log=audit_log)
+    await converter.start()
+    await collect(converter)
+
+    # Строки с ошибкой (валюта, бесконечная сумма) в журнал не попадают, остальные - по записи на каждую валюту
+    records = [audit_log.queue.get_nowait()[:6] for _ in range(audit_log.queue.qsize())]
+    assert sorted(records) == [
+        (7, "USD", "EUR", 4.0, 0.5, 2.0), (7, "USD", "EUR", 10.0, 0.5, 5.0),
+        (7, "USD", "GBP", 4.0, 0.25, 1.0), (7, "USD", "GBP", 10.0, 0.25, 2.5),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_bulk_convert_csv_missing_column():
+    converter = make_bulk_converter(make_upload_request(b"id,sum\r\n1,10\r\n"), "csv")
+    with pytest.raises(ValueError, match="Column not found: currency"):
+        await converter.start()
+
+
+@pytest.mark.asyncio
+async def test_bulk_convert_ndjson():
+    request = make_upload_request(b'{"currency": "USD", "amount": 10}\n{"currency": "EUR", "amo', b'unt": 1}\n'
+                                  b'{"currency": "USD", amount: 1}\r\n[1]\n')
+    converter = make_bulk_converter(request, "ndjson")
+    await converter.start()
+
+    lines = [json.loads(line) for line in (await collect(converter)).split("\n") if line]
+    assert lines[0] == {"currency": "USD", "amount": 10, "amount_EUR": 5.0, "amount_GBP": 2.5, "conversion_error": None}
+    assert lines[1]["amount_GBP"] == 0.5
+    # Неразобранная строка возвращается как есть с ошибкой разбора
+    assert lines[2]["raw"] == '{"currency": "USD", amount: 1}'
+    assert lines[2]["conversion_error"].startswith("Invalid JSON line: Expecting property name")
+    assert lines[3] == {"raw": "[1]", "amount_EUR": None, "amount_GBP": None,
+                        "conversion_error": "Invalid JSON line: expected an object"}
+
+
+@pytest.mark.asyncio
+async def test_bulk_convert_stops_on_disconnect():
+    rows = b"".join(b'{"currency": "USD", "amount": %d}\n' % i for i in range(10))
+    request = make_upload_request(rows, rows, rows, disconnect_after=2)
+    throughput = BulkStats()
+    converter = make_bulk_converter(request, "ndjson", chunk_rows=5, throughput=throughput)
+    await converter.start()
+
+    output = await collect(converter)
+    assert converter.rows == 20
+    assert len(output.splitlines()) == 20
+    stats = throughput.stats()
+    assert (stats["conversions"], stats["disconnected"], stats["rows"], stats["last_rows"]) == (1, 1, 20, 20)
+    assert stats["rows_per_second"] > 0
+
+
+# Тесты для истории курсов (нужна тестовая БД)
+
+
+@pytest_asyncio.fixture
+async def rate_history():
+    async with engine.begin() as conn:
+        await conn.run_sync(Rate.__table__.create, checkfirst=True)
+        await conn.execute(delete(Rate))
+    async with async_session_maker() as session:
+        yield session
+    # Соединения пула привязаны к event loop теста, следующему тесту нужны новые
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_ingest_rates_skips_duplicates(rate_history):
+    moment = datetime(2024, 1, 1, 12)
+    rows = [("usd", "eur", moment, 0.9), ("USD", "GBP", moment, 0.8)]
+
+    assert await ingest_rates(engine, rows) == 2
+    await ingest_rates(engine, rows + [("USD", "EUR", moment, 0.5)])
+
+    count = await rate_history.scalar(select(func.count()).select_from(Rate))
+    assert count == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_as_of(rate_history):
+    await ingest_rates(engine, [
+        ("USD", "EUR", datetime(2024, 1, 1), 0.90),
+        ("USD", "EUR", datetime(2024, 1, 2), 0.92),
+        ("USD", "GBP", datetime(2024, 1, 1), 0.80),
+    ])
+
+    rate, as_of = await rate_as_of(rate_history, "USD", "EUR", parse_moment("2024-01-01"), "USD")
+    assert (rate, as_of) == (0.90, datetime(2024, 1, 1))
+
+    rate, _ = await rate_as_of(rate_history, "EUR", "USD", datetime(2024, 1, 3), "USD")
+    assert rate == pytest.approx(1 / 0.92)
+
+    # Кросс-курс через валюту-источник, момент - самая старая из двух котировок
+    rate, as_of = await rate_as_of(rate_history, "EUR", "GBP", datetime(2024, 1, 3), "USD")
+    assert rate == pytest.approx(0.80 / 0.92)
+    assert as_of == datetime(2024, 1, 1)
+
+    with pytest.raises(ValueError):
+        await rate_as_of(rate_history, "USD", "EUR", datetime(2023, 12, 31), "USD")
+
+    result = await convert_at(rate_history, "usd", "eur", "10", datetime(2024, 1, 3), "USD")
+    assert result["result"] == pytest.approx(9.2)
+    # Конвертация на дату отклоняет NaN и бесконечность так же, как по текущим курсам
+    for amount in ("nan", "inf", "-1e999"):
+        with pytest.raises(ValueError, match="Invalid amount"):
+            await convert_at(rate_history, "USD", "EUR", amount, datetime(2024, 1, 3), "USD")
+
+
+def test_rate_history_item_validates_codes():
+    item = RateHistoryItem(base=" usd", quote="eur", timestamp=datetime(2024, 1, 1), rate=0.9)
+    assert (item.base, item.quote) == ("USD", "EUR")
+    for code in ("USDT", "US", "U$D", 840):
+        with pytest.raises(ValidationError):
+            RateHistoryItem(base=code, quote="EUR", timestamp=datetime(2024, 1, 1), rate=0.9)
+
+
+def test_table_rows():
+    table = RateTable.from_quotes("USD", {"USDEUR": 0.5}, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    assert table_rows(table) == [("USD", "EUR", datetime(2024, 1, 1), 0.5)]
+
+
+# Тесты для выгрузки истории курсов
+
+
+async def export(exporter: RateExporter) -> str:
+    return b"".join([chunk async for chunk in exporter.stream()]).decode()
+
+
+@pytest.mark.asyncio
+async def test_export_rate_history_keyset_pages(rate_history):
+    start = datetime(2024, 1, 1)
+    await ingest_rates(engine, [
+        ("USD", quote, start + timedelta(minutes=10 * i), 1 + i / 100)
+        for quote in ("EUR", "GBP", "JPY") for i in range(12)
+    ])
+
+    # Размер страницы не кратен числу строк пары - страницы переходят через границу пар
+    exporter = RateExporter(parse_pairs("USDEUR,usd/gbp"), start, start + timedelta(hours=1),
+                            page_size=5, batch_size=2)
+    rows = [json.loads(line) for line in (await export(exporter)).splitlines()]
+
+    assert len(rows) == 14
+    assert rows[0] == {"base": "USD", "quote": "EUR", "timestamp": "2024-01-01T00:00:00", "rate": 1.0}
+    assert [(row["quote"], row["timestamp"]) for row in rows] == sorted((row["quote"], row["timestamp"]) for row in rows)
+    assert rows[-1]["quote"] == "GBP" and rows[-1]["timestamp"] == "2024-01-01T01:00:00"
+
+
+@pytest.mark.asyncio
+async def test_export_rate_history_ohlc(rate_history):
+    start = datetime(2024, 1, 1)
+    await ingest_rates(engine, [("USD", "EUR", start + timedelta(minutes=10 * i), 1 + i / 100) for i in range(18)])
+
+    exporter = RateExporter([("USD", "EUR")], start, start + timedelta(days=1), fmt="csv", interval="hour",
+                            page_size=1, batch_size=1)
+    assert (await export(exporter)).splitlines() == [
+        "base,quote,timestamp,open,high,low,close,count",
+        "USD,EUR,2024-01-01T00:00:00,1.0,1.05,1.0,1.05,6",
+        "USD,EUR,2024-01-01T01:00:00,1.06,1.11,1.06,1.11,6",
+        "USD,EUR,2024-01-01T02:00:00,1.12,1.17,1.12,1.17,6",
+    ]
+
+
+def test_export_rejects_bad_parameters():
+    with pytest.raises(ValueError):
+        parse_pairs("USDEURO")
+    with pytest.raises(ValueError):
+        RateExporter([("USD", "EUR")], datetime(2024, 1, 1), datetime(2024, 1, 2), interval="decade")
+
+
+# Тесты для журнала конвертаций
+
+
+def audit_result(amount: float = 10.0) -> dict:
+    return {"query": {"from": "USD", "to": "EUR", "amount": amount}, "info": {"quote": 0.5}, "result": amount / 2}
+
+
+@pytest.mark.asyncio
+async def test_audit_log_overflow_policies():
+    audit = AuditLog(engine=None, queue_size=2, overflow=DROP)
+    for _ in range(3):
+        await audit.record(1, audit_result())
+    assert (audit.enqueued, audit.dropped, audit.blocked) == (2, 1, 0)
+
+    # block: запрос ждет места в очереди, пока его не освободит запись в БД, иначе запись отбрасывается
+    audit = AuditLog(engine=None, queue_size=1, overflow=BLOCK, block_timeout=0.05)
+    await audit.record(1, audit_result())
+    started = time.perf_counter()
+    await audit.record(1, audit_result())
+    assert time.perf_counter() - started >= 0.05
+    assert (audit.enqueued, audit.dropped, audit.blocked) == (1, 1, 1)
+
+    asyncio.get_running_loop().call_later(0.01, audit.queue.get_nowait)
+    audit.block_timeout = 1.0
+    await audit.record(1, audit_result())
+    assert (audit.enqueued, audit.dropped) == (2, 1)
+
+    # Пакет ждет места не дольше одного block_timeout на весь пакет
+    audit.block_timeout = 0.05
+    started = time.perf_counter()
+    await audit.record_many(1, [{"from": "USD", "to": "EUR", "amount": 1.0, "rate": 0.5, "result": 0.5}] * 10)
+    assert time.perf_counter() - started < 0.5
+    assert audit.dropped == 11
+
+    with pytest.raises(ValueError):
+        AuditLog(engine=None, overflow="spill")
+
+
+@pytest.mark.asyncio
+async def test_audit_log_flushes_by_size_and_time_and_drains_on_stop():
+    batches = []
+
+    async def write(engine, records):
+        batches.append(len(records))
+
+    with patch("src.rates.audit.write_records", write):
+        audit = AuditLog(engine=None, batch_size=3, flush_interval=0.05)
+        audit.start()
+        for amount in range(7):
+            await audit.record(1, audit_result(amount))
+        await asyncio.sleep(0.01)
+        assert batches == [3, 3]  # полные пачки пишутся сразу, остаток ждет flush_interval
+        await asyncio.sleep(0.1)
+        assert batches == [3, 3, 1]
+
+        for amount in range(4):
+            await audit.record(1, audit_result(amount))
+        await audit.stop()
+        assert sum(batches) == 11
+        assert audit.stats()["written"] == 11
+
+        await audit.record(1, audit_result())
+        assert audit.dropped == 1  # после остановки записи некому сохранить
+
+
+@pytest.mark.asyncio
+async def test_audit_log_retries_failed_batches():
+    write = AsyncMock(side_effect=[ConnectionError("db is down"), None])
+    with patch("src.rates.audit.write_records", write):
+        audit = AuditLog(engine=None, flush_interval=0.01, retries=1)
+        await audit.flush([("row",)])
+        assert (audit.written, audit.failed) == (1, 0)
+
+        write.side_effect = ConnectionError("db is down")
+        await audit.flush([("row",), ("row",)])
+        assert (audit.written, audit.failed) == (1, 2)
+        assert audit.stats()["last_error"] == "db is down"
+
+
+@pytest.mark.asyncio
+async def test_audit_log_writes_with_copy(rate_history):
+    async with engine.begin() as conn:
+        await conn.run_sync(ConversionAudit.__table__.create, checkfirst=True)
+        await conn.execute(delete(ConversionAudit))
+    audit = AuditLog(engine, batch_size=100, flush_interval=0.01)
+    audit.start()
+    await audit.record(7, audit_result(10.0))
+    await audit.record_many(7, [
+        {"from": "USD", "to": "GBP", "amount": 4.0, "rate": 0.25, "result": 1.0},
+        {"from": "USD", "to": "XXX", "amount": 1.0, "rate": None, "result": None},
+    ])
+    await audit.stop()
+
+    rows = (await rate_history.execute(
+        select(ConversionAudit.base, ConversionAudit.quote, ConversionAudit.amount, ConversionAudit.result)
+        .where(ConversionAudit.user_id == 7).order_by(ConversionAudit.id)
+    )).all()
+    assert [tuple(row) for row in rows] == [("USD", "EUR", 10.0, 5.0), ("USD", "GBP", 4.0, 1.0)]